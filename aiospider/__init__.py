@@ -4,6 +4,22 @@
 '''
 '''
 from .spider import *
-from .taskqueue import TaskQueue, makeTask
+from .taskqueue import TaskQueue, Budget, makeTask
+from .seen import SeenSet, MemorySeenSet, BloomSeenSet, SqliteSeenSet
+from .metrics import Metrics
+from .response import Response, ResponseTooLarge
+from .linkextract import LinkExtractor
+from .httpcache import HttpCache
+from .archive import Archive
+from .castore import ContentStore
+from .retry import RetryPolicy
+from .shard import ShardedSpider
+from .backend import FrontierBackend, MemoryBackend, RedisBackend
+from .pipeline import ItemPipeline, Sink, JsonLinesSink, SqliteSink, CsvSink, require, Dedup
+from .log import LOGGING_FORMAT
 
-__all__ = ["Spider","TaskQueue", "makeTask"]
+__all__ = ["Spider", "make_session", "TaskQueue", "Budget", "makeTask",
+           "SeenSet", "MemorySeenSet", "BloomSeenSet", "SqliteSeenSet",
+           "Metrics", "Response", "ResponseTooLarge", "LinkExtractor", "HttpCache", "Archive", "ContentStore", "RetryPolicy",
+           "ShardedSpider", "FrontierBackend", "MemoryBackend", "RedisBackend",
+           "ItemPipeline", "Sink", "JsonLinesSink", "SqliteSink", "CsvSink", "require", "Dedup", "LOGGING_FORMAT"]
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+Adaptive concurrency.
+The right number of parallel requests depends on how loaded the target servers
+are, and that changes all the time. AIMDController changes the limits the way
+TCP does with its congestion window:
+ - every `window` responses, if the error rate (timeouts, 429, 503 and other
+   connection errors) is under `error_threshold` and the latency percentile is
+   under the target, the limit grows by `increase`.
+ - otherwise it is multiplied by `decrease`.
+There is one global limit and one limit per host, the host limits are fed only
+by the responses of their host.
+'''
+import collections
+
+__all__ = ["AIMDController"]
+
+# status codes meaning "too much load".
+OVERLOAD_STATUS = frozenset((429, 503))
+
+
+class _Window:
+    __slots__ = ("limit", "latencies", "errors", "baseline", "decreases")
+
+    def __init__(self, limit):
+        self.limit = float(limit)
+        self.latencies = []
+        self.errors = 0
+        # the lowest latency percentile seen, which stands for an idle server.
+        self.baseline = None
+        self.decreases = 0
+
+
+class AIMDController:
+
+    def __init__(self, initial=5, minimum=1, maximum=50, increase=1, decrease=0.5,
+                 window=20, percentile=0.9, target_latency=None, latency_factor=2.0,
+                 error_threshold=0.05, host_initial=None, host_maximum=None, max_hosts=10000):
+        '''
+        :param initial: global limit at start.
+        :param minimum, maximum: bounds of every limit.
+        :param window: number of responses between two adjustments.
+        :param percentile: which latency percentile is compared with the target.
+        :param target_latency: seconds. If None, the target is `latency_factor`
+            times the lowest percentile seen so far.
+        :param host_initial, host_maximum: bounds of host limits, the global ones by default.
+        '''
+        if not 0 < decrease < 1:
+            raise ValueError("decrease must be between 0 and 1")
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.window = window
+        self.percentile = percentile
+        self.target_latency = target_latency
+        self.latency_factor = latency_factor
+        self.error_threshold = error_threshold
+        self.host_initial = host_initial if host_initial is not None else initial
+        self.host_maximum = host_maximum if host_maximum is not None else maximum
+        self.max_hosts = max_hosts
+        self._global = _Window(initial)
+        self._hosts = collections.OrderedDict()
+        # called without argument after limits changed.
+        self.on_change = None
+
+    @property
+    def limit(self):
+        '''current global in-flight limit.'''
+        return int(self._global.limit)
+
+    def limit_of(self, host):
+        '''current in-flight limit of host.'''
+        state = self._hosts.get(host)
+        if state is None:
+            return int(self.host_initial)
+        return int(state.limit)
+
+    def _host(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = _Window(self.host_initial)
+            if len(self._hosts) > self.max_hosts:
+                self._hosts.popitem(last=False)
+        else:
+            self._hosts.move_to_end(host)
+        return state
+
+    def record(self, host, latency, status=None, error=False):
+        '''
+        Feed one finished request.
+        :param latency: seconds until the response(or the error) came.
+        :param status: status code of response.
+        :param error: True if the request failed without response, e.g. timeout.
+        '''
+        failed = error or status in OVERLOAD_STATUS
+        changed = self._feed(self._global, latency, failed, self.maximum)
+        changed = self._feed(self._host(host), latency, failed, self.host_maximum) or changed
+        if changed and self.on_change is not None:
+            self.on_change()
+
+    def _feed(self, state, latency, failed, maximum):
+        if failed:
+            state.errors += 1
+        else:
+            state.latencies.append(latency)
+        if len(state.latencies) + state.errors < self.window:
+            return False
+        old = int(state.limit)
+        if state.errors / self.window > self.error_threshold or self._too_slow(state):
+            state.limit = max(self.minimum, state.limit * self.decrease)
+            state.decreases += 1
+        else:
+            state.limit = min(maximum, state.limit + self.increase)
+        state.latencies = []
+        state.errors = 0
+        return int(state.limit) != old
+
+    def _too_slow(self, state):
+        if not state.latencies:
+            return False
+        latencies = sorted(state.latencies)
+        p = latencies[min(int(len(latencies) * self.percentile), len(latencies) - 1)]
+        target = self.target_latency
+        if target is None:
+            if state.baseline is None or p < state.baseline:
+                state.baseline = p
+            target = state.baseline * self.latency_factor
+        return p > target
+
+    def snapshot(self):
+        return {
+            "limit": self.limit,
+            "decreases": self._global.decreases,
+            "hosts": {host: int(state.limit) for host, state in self._hosts.items()},
+        }
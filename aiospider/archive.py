@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+Response archive, for recording a crawl and replaying it without network.
+Each request and its response are appended to one file as a length-prefixed
+record:
+
+    meta length (4 bytes) | request body length (8 bytes) | body length (8 bytes)
+    | meta (json) | request body | body
+
+meta holds the url, status, reason and headers of the response, and the method,
+url and headers of the request. Request bodies which can't be read (streams,
+FormData) are recorded empty. Bodies are copied from spooled files by parts,
+so a large one is never held in memory. Beside it, `path + ".idx"` is the
+offset index: one fixed size entry (16 bytes key, 8 bytes offset) per record,
+so the index of a large archive is loaded without reading the records.
+Keys are request fingerprints, the last record of a key wins.
+'''
+import json
+import os
+import shutil
+import struct
+import tempfile
+
+from .response import Response
+from .request import Request, _body_bytes
+
+__all__ = ["Archive", "NotInArchive"]
+
+INDEX_SUFFIX = ".idx"
+
+_HEADER = struct.Struct(">IQQ")
+_INDEX = struct.Struct(">16sQ")
+# bytes copied at once
+_CHUNK = 1024 * 1024
+
+
+class NotInArchive(Exception):
+    pass
+
+
+class Archive:
+
+    def __init__(self, path, mode="r", spool_size=1024 * 1024):
+        '''
+        :param mode: "r" to read, "w" to write a new archive, "a" to add to an archive.
+        :param spool_size: a body read larger than this is given in a temporary file, like `Response`'s.
+        '''
+        if mode not in ("r", "w", "a"):
+            raise ValueError("mode must be r, w or a, not {!r}".format(mode))
+        self.path = path
+        self.mode = mode
+        self.spool_size = spool_size
+        self._offsets = {}
+        if mode == "w":
+            for p in (path, path + INDEX_SUFFIX):
+                if os.path.exists(p):
+                    os.remove(p)
+        if os.path.exists(path):
+            self._load_index()
+        if mode == "r":
+            self._data = open(path, "rb")
+            self._index = None
+        else:
+            self._data = open(path, "ab")
+            self._index = open(path + INDEX_SUFFIX, "ab")
+
+    def _load_index(self):
+        size = os.path.getsize(self.path)
+        with open(self.path + INDEX_SUFFIX, "rb") as fd:
+            data = fd.read()
+        for key, offset in _INDEX.iter_unpack(data[:len(data) - len(data) % _INDEX.size]):
+            # records cut by a crash are ignored.
+            if offset < size:
+                self._offsets[key] = offset
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, key):
+        return key in self._offsets
+
+    def keys(self):
+        return self._offsets.keys()
+
+    def write(self, key, response, request=None):
+        '''
+        append request and response as the record of key.
+        :param request: the `Request` sent, `response.request` by default.
+        '''
+        request = request if request is not None else response.request
+        meta = {"url": str(response.url), "status": response.status, "reason": response.reason,
+                "headers": list(response.headers.items())}
+        data = b""
+        if request is not None:
+            meta["request"] = {"method": request.method, "url": request.url,
+                               "headers": list((request.header or {}).items())}
+            body = request.data
+            if body is None and request.kwargs and request.kwargs.get("json") is not None:
+                body = json.dumps(request.kwargs["json"])
+            data = _body_bytes(body) or b""
+        meta = json.dumps(meta).encode("utf-8")
+        offset = self._data.tell()
+        self._data.write(_HEADER.pack(len(meta), len(data), response.size))
+        self._data.write(meta)
+        self._data.write(data)
+        shutil.copyfileobj(response.file, self._data, _CHUNK)
+        self._index.write(_INDEX.pack(key, offset))
+        self._offsets[key] = offset
+
+    def _read_record(self, key):
+        '''
+        :return: (meta, request body), the file is at the response body then.
+        '''
+        offset = self._offsets.get(key)
+        if offset is None:
+            raise NotInArchive(key)
+        self._data.seek(offset)
+        meta_size, data_size, body_size = _HEADER.unpack(self._data.read(_HEADER.size))
+        meta = json.loads(self._data.read(meta_size).decode("utf-8"))
+        meta["body_size"] = body_size
+        return meta, self._data.read(data_size)
+
+    def read(self, key, request=None):
+        '''
+        :return: the `Response` recorded for key.
+        '''
+        meta, _ = self._read_record(key)
+        size = meta["body_size"]
+        body = file = None
+        if size > self.spool_size:
+            file = tempfile.TemporaryFile(prefix="aiospider-body-")
+            left = size
+            while left:
+                chunk = self._data.read(min(left, _CHUNK))
+                if not chunk:
+                    break
+                file.write(chunk)
+                left -= len(chunk)
+        else:
+            body = self._data.read(size)
+        return Response.from_parts(meta["url"], meta["status"], meta["headers"], body,
+                                   reason=meta["reason"], request=request, file=file, size=size)
+
+    def read_request(self, key):
+        '''
+        :return: the `Request` recorded for key, without callback. None if it wasn't recorded.
+        '''
+        meta, data = self._read_record(key)
+        request = meta.get("request")
+        if request is None:
+            return None
+        return Request(request["method"], request["url"], header=dict(request["headers"]),
+                       data=data or None)
+
+    def flush(self):
+        if self._index is not None:
+            self._data.flush()
+            self._index.flush()
+
+    def close(self):
+        if self._data is None:
+            return
+        # data before index, so that an index entry never points past the data.
+        self._data.close()
+        if self._index is not None:
+            self._index.close()
+        self._data = self._index = None
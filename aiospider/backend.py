@@ -0,0 +1,359 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+Frontier backends shared by several spiders, on one machine or many.
+`Spider.pending` and `Spider.visited` live in one process. With a backend passed
+by `frontier_backend`, a spider pushes the requests it finds to the backend,
+which drops the ones seen before by any spider, and leases requests from it
+when its own queue runs low. A leased request is acknowledged once it is done;
+if its spider dies first, the lease expires after `lease_time` seconds and the
+request is given to another spider. So each request is fetched once, unless a
+spider dies or takes longer than `lease_time` with it.
+
+Requests are pushed and leased in batches, pickled like spilled ones
+(callbacks by name), as `(fingerprint, data)` pairs.
+
+ 1. MemoryBackend : in this process, for tests and a single spider.
+ 2. RedisBackend  : a Redis server (or anything speaking its protocol, e.g.
+                    fakeredis' TcpFakeServer). A batch is one round trip: a Lua
+                    script dedups and pushes it, another one leases.
+
+    backend = RedisBackend("redis://10.0.0.5:6379/0", prefix="mycrawl")
+    with Spider(frontier_backend=backend) as ss:
+        ss.start(urls, parse)
+
+Every spider of the crawl uses the same prefix. Delete the keys of a prefix with
+`clear()` to start a crawl again.
+'''
+import asyncio
+import hashlib
+import heapq
+import math
+import time
+from collections import deque
+from urllib.parse import urlsplit, unquote
+
+__all__ = ["FrontierBackend", "MemoryBackend", "RedisBackend", "RedisError"]
+
+
+class FrontierBackend:
+    '''
+    Interface of frontier backends, every method is a coroutine.
+    Items are `(fingerprint, data)`, both bytes. A fingerprint of None is
+    never taken as a duplicate.
+    '''
+
+    async def push(self, items):
+        '''
+        add the items whose fingerprint wasn't pushed before.
+        :return: number of items added.
+        '''
+        raise NotImplementedError
+
+    async def lease(self, n):
+        '''
+        take up to n items, the ones of expired leases first.
+        :return: list of datas, each one must be acknowledged by `ack`.
+        '''
+        raise NotImplementedError
+
+    async def ack(self, datas):
+        '''
+        the leased datas are done.
+        '''
+        raise NotImplementedError
+
+    async def done(self):
+        '''
+        :return: True if nothing waits and nothing is leased, by any spider.
+        '''
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemoryBackend(FrontierBackend):
+    '''
+    Everything in this process, e.g. to try a crawl before using a server.
+    '''
+
+    def __init__(self, lease_time=300):
+        self.lease_time = lease_time
+        self._seen = set()
+        self._queue = deque()
+        # data -> deadline, and a heap of (deadline, data) to find expired ones.
+        self._leases = {}
+        self._deadlines = []
+
+    async def push(self, items):
+        added = 0
+        for fp, data in items:
+            if fp is not None:
+                if fp in self._seen:
+                    continue
+                self._seen.add(fp)
+            self._queue.append(data)
+            added += 1
+        return added
+
+    async def lease(self, n):
+        now = time.monotonic()
+        datas = []
+        while self._deadlines and self._deadlines[0][0] <= now and len(datas) < n:
+            deadline, data = heapq.heappop(self._deadlines)
+            if self._leases.get(data) == deadline:
+                datas.append(data)
+        while self._queue and len(datas) < n:
+            datas.append(self._queue.popleft())
+        deadline = now + self.lease_time
+        for data in datas:
+            self._leases[data] = deadline
+            heapq.heappush(self._deadlines, (deadline, data))
+        return datas
+
+    async def ack(self, datas):
+        for data in datas:
+            self._leases.pop(data, None)
+        if not self._leases:
+            self._deadlines = []
+
+    async def done(self):
+        return not self._queue and not self._leases
+
+
+class RedisError(Exception):
+    '''
+    an error reply of the server.
+    '''
+    pass
+
+
+class _RedisConnection:
+    '''
+    The part of the Redis protocol (RESP2) needed here: commands are sent in
+    pipelines, replies are read in order.
+    '''
+
+    def __init__(self, url="redis://localhost:6379/0"):
+        parts = urlsplit(url)
+        if parts.scheme not in ("redis", ""):
+            raise ValueError("Only redis:// urls are supported, not {}".format(url))
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 6379
+        self.password = unquote(parts.password) if parts.password else None
+        self.username = unquote(parts.username) if parts.username else None
+        self.db = int(parts.path.strip("/") or 0)
+        self._reader = self._writer = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _encode(args):
+        out = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if isinstance(arg, str):
+                arg = arg.encode("utf-8")
+            elif not isinstance(arg, bytes):
+                arg = str(arg).encode("ascii")
+            out.append(b"$%d\r\n" % len(arg))
+            out.append(arg)
+            out.append(b"\r\n")
+        return b"".join(out)
+
+    async def _read(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by the server.")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest
+        if kind == b"-":
+            return RedisError(rest.decode("utf-8", "replace"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            size = int(rest)
+            if size < 0:
+                return None
+            return (await self._reader.readexactly(size + 2))[:-2]
+        if kind == b"*":
+            size = int(rest)
+            if size < 0:
+                return None
+            return [await self._read() for _ in range(size)]
+        raise RedisError("Unknown reply {!r}".format(line))
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        setup = []
+        if self.password is not None:
+            setup.append(("AUTH", self.username, self.password) if self.username else ("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        if setup:
+            await self._send(setup)
+
+    async def _send(self, commands):
+        self._writer.write(b"".join(self._encode(command) for command in commands))
+        await self._writer.drain()
+        replies = [await self._read() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    async def pipeline(self, commands):
+        '''
+        send commands at once.
+        :return: their replies, the first error reply is raised.
+        '''
+        async with self._lock:
+            if self._writer is None:
+                await self._connect()
+            try:
+                return await self._send(commands)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # once again on a new connection, e.g. after the server restarted.
+                self._close()
+                await self._connect()
+                return await self._send(commands)
+
+    async def execute(self, *args):
+        return (await self.pipeline([args]))[0]
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def close(self):
+        async with self._lock:
+            self._close()
+
+
+# KEYS: queue, seen. ARGV: k, then for each item its fingerprint, its data and k bit positions.
+# k is 0 for a set of fingerprints, SETBIT returns the old bit, so an item is new if one was 0.
+_PUSH_SCRIPT = b'''
+local k = tonumber(ARGV[1])
+local added = 0
+local i = 2
+while i <= #ARGV do
+  local new = true
+  if ARGV[i] ~= "" then
+    if k == 0 then
+      new = redis.call("SADD", KEYS[2], ARGV[i]) == 1
+    else
+      new = false
+      for j = 1, k do
+        if redis.call("SETBIT", KEYS[2], ARGV[i + 1 + j], 1) == 0 then
+          new = true
+        end
+      end
+    end
+  end
+  if new then
+    redis.call("RPUSH", KEYS[1], ARGV[i + 1])
+    added = added + 1
+  end
+  i = i + 2 + k
+end
+return added
+'''
+
+# KEYS: queue, leases (a sorted set of datas by deadline). ARGV: n, lease_time.
+# The server's clock is used, the spiders' ones may differ.
+_LEASE_SCRIPT = b'''
+if redis.replicate_commands then pcall(redis.replicate_commands) end
+local n = tonumber(ARGV[1])
+local t = redis.call("TIME")
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local items = redis.call("ZRANGEBYSCORE", KEYS[2], "-inf", now, "LIMIT", 0, n)
+while #items < n do
+  local data = redis.call("LPOP", KEYS[1])
+  if not data then break end
+  items[#items + 1] = data
+end
+local deadline = tostring(now + tonumber(ARGV[2]))
+for _, data in ipairs(items) do
+  redis.call("ZADD", KEYS[2], deadline, data)
+end
+return items
+'''
+
+
+class RedisBackend(FrontierBackend):
+    '''
+    Keys used: `<prefix>:queue` (a list), `<prefix>:seen` (a set of fingerprints,
+    or a bitmap with `dedup="bloom"`) and `<prefix>:leases` (a sorted set).
+    '''
+
+    def __init__(self, url="redis://localhost:6379/0", prefix="aiospider", dedup="set",
+                 capacity=10000000, error_rate=0.001, lease_time=300):
+        '''
+        :param dedup: "set" keeps every fingerprint (16 bytes and Redis' overhead each),
+            "bloom" a bloom filter of `capacity` items with a false positive rate of `error_rate`,
+            e.g. 18MB for 10 million urls at 0.1%. Some new requests are dropped then.
+        :param lease_time: seconds a spider may keep a request before it is given to another one.
+        '''
+        if dedup not in ("set", "bloom"):
+            raise ValueError("dedup must be 'set' or 'bloom'")
+        self.redis = _RedisConnection(url)
+        self.lease_time = lease_time
+        self.queue_key = prefix + ":queue"
+        self.seen_key = prefix + ":seen"
+        self.leases_key = prefix + ":leases"
+        self.k = 0
+        if dedup == "bloom":
+            m = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+            # a Redis string is at most 512MB
+            self.m = min(max(m, 8), 2 ** 32)
+            self.k = max(int(round(self.m / capacity * math.log(2))), 1)
+        self._shas = {}
+
+    def _positions(self, fp):
+        h = hashlib.blake2b(fp, digest_size=16).digest()
+        h1, h2 = int.from_bytes(h[:8], "little"), int.from_bytes(h[8:], "little") | 1
+        return [(h1 + i * h2) % self.m for i in range(self.k)]
+
+    async def _eval(self, script, keys, args):
+        sha = self._shas.get(script)
+        if sha is None:
+            sha = self._shas[script] = hashlib.sha1(script).hexdigest()
+        try:
+            return await self.redis.execute("EVALSHA", sha, len(keys), *keys, *args)
+        except RedisError as e:
+            if not str(e).startswith("NOSCRIPT"):
+                raise
+            return await self.redis.execute("EVAL", script, len(keys), *keys, *args)
+
+    async def push(self, items):
+        args = [self.k]
+        for fp, data in items:
+            args.append(fp or b"")
+            args.append(data)
+            if self.k:
+                args.extend(self._positions(fp) if fp else [0] * self.k)
+        if len(args) == 1:
+            return 0
+        return await self._eval(_PUSH_SCRIPT, (self.queue_key, self.seen_key), args)
+
+    async def lease(self, n):
+        return await self._eval(_LEASE_SCRIPT, (self.queue_key, self.leases_key), (n, self.lease_time))
+
+    async def ack(self, datas):
+        if datas:
+            await self.redis.execute("ZREM", self.leases_key, *datas)
+
+    async def done(self):
+        waiting, leased = await self.redis.pipeline([("LLEN", self.queue_key), ("ZCARD", self.leases_key)])
+        return not waiting and not leased
+
+    async def clear(self):
+        '''
+        delete the keys of this crawl.
+        '''
+        await self.redis.execute("DEL", self.queue_key, self.seen_key, self.leases_key)
+
+    async def close(self):
+        await self.redis.close()
@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+Content-addressable download store.
+Mirrors often serve the same file under many urls. With a store, a download is
+hashed while it is written (by the writer thread), and kept once under its
+digest in `root/objects/`; `dst` is a hard link (or a symlink, or a copy) to
+it. An index maps each url to its digest, so a url downloaded before isn't
+requested again, `dst` is only linked.
+
+    root/objects/ab/ab12...ef   one file per distinct content
+    root/tmp/                   downloads in progress
+    root/index.sqlite           url -> digest, digest -> size
+
+Files are taken as immutable: a url in the index is never downloaded again,
+and writing into a hard linked `dst` changes every copy. Use `link="copy"` if
+files are modified later, only the bandwidth is saved then.
+'''
+import hashlib
+import os
+import shutil
+import sqlite3
+
+__all__ = ["ContentStore"]
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, digest TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER NOT NULL);
+'''
+
+
+class ContentStore:
+
+    def __init__(self, root, link="hard", algorithm="sha256"):
+        '''
+        :param root: directory of the store, created if needed.
+        :param link: how `dst` refers to its content: "hard" link (a copy if root and dst are on
+            different file systems), "symlink" (absolute) or "copy".
+        :param algorithm: a hashlib algorithm.
+        '''
+        if link not in ("hard", "symlink", "copy"):
+            raise ValueError("link must be hard, symlink or copy, not {!r}".format(link))
+        hashlib.new(algorithm)
+        self.root = os.path.abspath(root)
+        self.link_mode = link
+        self.algorithm = algorithm
+        for sub in ("objects", "tmp"):
+            os.makedirs(os.path.join(self.root, sub), exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(self.root, "index.sqlite"))
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        self._db.commit()
+
+    def hasher(self):
+        return hashlib.new(self.algorithm)
+
+    def hash_file(self, path, chunk_size=1024 * 1024):
+        '''
+        digest of a file written without a hasher (ranged downloads), blocking.
+        '''
+        h = self.hasher()
+        with open(path, "rb") as fd:
+            for chunk in iter(lambda: fd.read(chunk_size), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    def tmp_path(self, url, dst=""):
+        '''
+        where url is downloaded to dst before it is added, the same for a url and a dst every time
+        so that `resume` downloads can continue. Downloads of a url to different dsts at once get
+        different paths, and their `.part` files too.
+        '''
+        key = url + "\0" + (os.path.abspath(dst) if dst else "")
+        return os.path.join(self.root, "tmp", hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def lookup(self, url):
+        '''
+        :return: (digest, size) of url's content, None if url is unknown or its blob was removed.
+        '''
+        row = self._db.execute("SELECT u.digest, b.size FROM urls u JOIN blobs b ON u.digest = b.digest "
+                               "WHERE u.url = ?", (url,)).fetchone()
+        if row is None or not os.path.exists(self.blob_path(row[0])):
+            return None
+        return row
+
+    def link(self, url, dst):
+        '''
+        make dst the content of url if it is known.
+        :return: size of the content, None if url is unknown.
+        '''
+        found = self.lookup(url)
+        if found is None:
+            return None
+        self._link(self.blob_path(found[0]), dst)
+        return found[1]
+
+    def add(self, url, tmp, digest, dst=None):
+        '''
+        move the downloaded file tmp to the store, or remove it if its content is there already,
+        and link dst to it.
+        :return: (size, new), new is False if the content was stored before.
+        '''
+        blob = self.blob_path(digest)
+        size = os.path.getsize(tmp)
+        new = not os.path.exists(blob)
+        if new:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.replace(tmp, blob)
+        else:
+            os.remove(tmp)
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO blobs (digest, size) VALUES (?, ?)", (digest, size))
+            self._db.execute("INSERT OR REPLACE INTO urls (url, digest) VALUES (?, ?)", (url, digest))
+        if dst is not None:
+            self._link(blob, dst)
+        return size, new
+
+    def _link(self, blob, dst):
+        try:
+            if os.path.samefile(blob, dst):
+                return
+        except OSError:
+            pass
+        # made beside dst and renamed, so dst is replaced at once.
+        tmp = dst + ".link"
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        if self.link_mode == "hard":
+            try:
+                os.link(blob, tmp)
+            except OSError:
+                shutil.copyfile(blob, tmp)
+        elif self.link_mode == "symlink":
+            os.symlink(blob, tmp)
+        else:
+            shutil.copyfile(blob, tmp)
+        os.replace(tmp, dst)
+
+    def stats(self):
+        '''
+        urls indexed, distinct contents and their bytes.
+        '''
+        urls = self._db.execute("SELECT COUNT(*) FROM urls").fetchone()[0]
+        blobs, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        return {"urls": urls, "blobs": blobs, "bytes": size}
+
+    def close(self):
+        self._db.close()
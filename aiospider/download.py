@@ -0,0 +1,411 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+Download writer.
+Writing files with `open` and `write` in the loop blocks every other request
+while the disk is busy. FileWriter does file I/O in a dedicated thread:
+the loop only hands buffers over, and waits only when `max_buffers` buffers
+are queued and not written yet, so memory is bounded too.
+A download is written to `dst + ".part"` and renamed to `dst` when it is
+complete, so `dst` is never a partial file.
+
+Besides the plain download, there are two download modes using `Range`:
+ - resume   : a partial `.part` file left by an interrupted download is
+              continued from its size, if the ETag or Last-Modified saved
+              beside it still matches.
+ - parallel : a large file is split into ranges downloaded at the same time
+              and written at their offsets into a preallocated file.
+Both fall back to a plain download if the server doesn't support ranges.
+'''
+import asyncio
+import json
+import os
+import queue
+import re
+import threading
+
+__all__ = ["FileWriter", "save_response", "download_resume", "download_parallel",
+           "PART_SUFFIX", "META_SUFFIX"]
+
+PART_SUFFIX = ".part"
+# validators of a partial file, for resuming.
+META_SUFFIX = ".part.meta"
+
+# operations of the writer thread.
+_WRITE, _CLOSE, _ABORT = range(3)
+
+_CONTENT_RANGE = re.compile(r"bytes\s+(\d+)-(\d+)/(\d+|\*)")
+
+
+def _pwrite(fd, buf, offset):
+    if hasattr(os, "pwrite"):
+        return os.pwrite(fd, buf, offset)
+    # only the writer thread writes, seeking is safe.
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.write(fd, buf)
+
+
+class _File:
+    '''
+    One file being written, returned by `FileWriter.open`.
+    '''
+
+    def __init__(self, writer, dst, size=None, offset=0, keep_partial=False, hasher=None):
+        self.writer = writer
+        self.dst = dst
+        self.tmp = dst + PART_SUFFIX
+        self.size = size
+        # where the next `write` without offset goes.
+        self.position = offset
+        self.truncate = offset == 0
+        self.keep_partial = keep_partial
+        # updated with each buffer by the writer thread, for files written in order.
+        self.hasher = hasher
+        # set by the writer thread
+        self.written = 0
+        self.end = offset
+        self.fd = None
+        # error happened in the writer thread, raised by the next `write` or `close`.
+        self.error = None
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    async def write(self, buf, offset=None):
+        '''
+        Queue buf to be written at offset(after the last write by default),
+        wait only if too many buffers are queued.
+        '''
+        self._check()
+        if offset is None:
+            offset = self.position
+            self.position += len(buf)
+        await self.writer._slots.acquire()
+        self.writer._submit(self, _WRITE, (buf, offset), None)
+
+    async def _finish(self, op):
+        future = self.writer._loop.create_future()
+        self.writer._submit(self, op, None, future)
+        await future
+        self._check()
+
+    async def close(self):
+        '''
+        Wait for all buffers written, and move the file to `dst`.
+        '''
+        await self._finish(_CLOSE)
+
+    async def abort(self):
+        '''
+        Drop the file, or keep it as it is for resuming if `keep_partial`.
+        '''
+        await self._finish(_ABORT)
+
+
+class FileWriter:
+
+    def __init__(self, max_buffers=64, *, loop=None):
+        if loop is None:
+            self._loop = asyncio.get_event_loop()
+        else:
+            self._loop = loop
+        self.max_buffers = max_buffers
+        self._slots = asyncio.Semaphore(max_buffers)
+        self._queue = queue.Queue()
+        self._thread = None
+        # bytes written by the thread
+        self.written = 0
+
+    def open(self, dst, size=None, offset=0, keep_partial=False, hasher=None):
+        '''
+        :param size: file size if known, the file is preallocated then.
+        :param offset: where to start writing, an existing `.part` file is kept and
+            continued if it is not 0.
+        :param keep_partial: keep `.part` file when aborted.
+        :param hasher: a hashlib object updated with what is written, only if it is written in order.
+        '''
+        return _File(self, dst, size, offset, keep_partial, hasher)
+
+    def _submit(self, file, op, arg, future):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="aiospider-writer", daemon=True)
+            self._thread.start()
+        self._queue.put((file, op, arg, future))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            file, op, arg, future = item
+            try:
+                if op == _WRITE:
+                    self._write(file, *arg)
+                elif op == _CLOSE:
+                    self._close(file)
+                else:
+                    self._abort(file)
+            except Exception as e:
+                file.error = e
+                self._abort(file)
+            finally:
+                if op == _WRITE:
+                    self._loop.call_soon_threadsafe(self._slots.release)
+                elif future is not None:
+                    self._loop.call_soon_threadsafe(_set_done, future)
+
+    def _open(self, file):
+        flags = os.O_WRONLY | os.O_CREAT
+        if file.truncate:
+            flags |= os.O_TRUNC
+        file.fd = os.open(file.tmp, flags, 0o644)
+        if file.size and file.truncate and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(file.fd, 0, file.size)
+            except OSError:
+                pass
+
+    def _write(self, file, buf, offset):
+        if file.error is not None:
+            return
+        if file.fd is None:
+            self._open(file)
+        view = memoryview(buf)
+        while view:
+            n = _pwrite(file.fd, view, offset)
+            view = view[n:]
+            offset += n
+        if file.hasher is not None:
+            file.hasher.update(buf)
+        file.end = max(file.end, offset)
+        file.written += len(buf)
+        self.written += len(buf)
+
+    def _close(self, file):
+        if file.error is not None:
+            return
+        if file.fd is None:
+            # empty file
+            self._open(file)
+        if file.size and file.end < file.size:
+            # preallocated but shorter than expected
+            os.ftruncate(file.fd, file.end)
+        os.close(file.fd)
+        file.fd = None
+        os.replace(file.tmp, file.dst)
+
+    def _abort(self, file):
+        if file.fd is not None:
+            try:
+                os.close(file.fd)
+            except OSError:
+                pass
+            file.fd = None
+        if file.keep_partial:
+            return
+        try:
+            os.remove(file.tmp)
+        except OSError:
+            pass
+
+    def close(self):
+        '''
+        Stop the writer thread after everything queued is written.
+        '''
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+
+def _set_done(future):
+    if not future.done():
+        future.set_result(None)
+
+
+async def _stream(resp, file, chunk_size, max_chunk_size, offset=None):
+    '''
+    Copy the body of resp into file, at offset if given.
+    Small reads are gathered into chunks, the chunk size is doubled (up to
+    `max_chunk_size`) each time the connection fills a whole chunk at once.
+    '''
+    buf = bytearray()
+    while True:
+        data = await resp.content.read(chunk_size)
+        if not data:
+            break
+        buf += data
+        if len(data) == chunk_size and chunk_size < max_chunk_size:
+            chunk_size *= 2
+        if len(buf) >= chunk_size:
+            await file.write(bytes(buf), offset)
+            if offset is not None:
+                offset += len(buf)
+            buf.clear()
+    if buf:
+        await file.write(bytes(buf), offset)
+
+
+async def _write_all(file, coro):
+    try:
+        await coro
+        await file.close()
+    except BaseException:
+        await asyncio.shield(file.abort())
+        raise
+    return file.written
+
+
+async def save_response(resp, dst, writer, chunk_size=64 * 1024, max_chunk_size=1024 * 1024, hasher=None):
+    '''
+    Stream the body of resp to dst with writer.
+    :param hasher: a hashlib object updated with the body by the writer thread.
+    :return: bytes written.
+    '''
+    file = writer.open(dst, resp.content_length, hasher=hasher)
+    return await _write_all(file, _stream(resp, file, chunk_size, max_chunk_size))
+
+
+def _validator(headers):
+    '''
+    the value of `If-Range` for a response: a strong ETag, else Last-Modified.
+    '''
+    etag = headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
+
+def _read_meta(dst):
+    try:
+        with open(dst + META_SUFFIX) as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_meta(dst, meta):
+    with open(dst + META_SUFFIX, "w") as fd:
+        json.dump(meta, fd)
+
+
+def _remove_meta(dst):
+    try:
+        os.remove(dst + META_SUFFIX)
+    except OSError:
+        pass
+
+
+async def download_resume(session, url, dst, writer, headers=None,
+                          chunk_size=64 * 1024, max_chunk_size=1024 * 1024):
+    '''
+    Download url to dst, continuing `dst.part` left by an interrupted download.
+    The partial file is kept if this download is interrupted again.
+    :return: bytes written.
+    '''
+    headers = dict(headers or {})
+    meta = _read_meta(dst)
+    try:
+        offset = os.path.getsize(dst + PART_SUFFIX)
+    except OSError:
+        offset = 0
+    if not (meta.get("url") == url and meta.get("validator")):
+        offset = 0
+    while True:
+        request_headers = dict(headers)
+        if offset:
+            request_headers["Range"] = "bytes={:d}-".format(offset)
+            request_headers["If-Range"] = meta["validator"]
+        async with session.get(url, headers=request_headers) as resp:
+            if resp.status == 416 and offset and offset == meta.get("size"):
+                # it was complete, only not renamed.
+                file = writer.open(dst, offset=offset)
+                await file.close()
+                _remove_meta(dst)
+                return 0
+            resp.raise_for_status()
+            validator = _validator(resp.headers)
+            if resp.status == 206:
+                match = _CONTENT_RANGE.match(resp.headers.get("Content-Range", ""))
+                if not match or int(match.group(1)) != offset:
+                    raise ValueError("Unexpected Content-Range {!r} from {}".format(
+                        resp.headers.get("Content-Range"), url))
+                if validator != meta["validator"]:
+                    # some servers ignore `If-Range`, the file has changed.
+                    offset = 0
+                    continue
+            else:
+                # range not supported or file changed, from the beginning.
+                offset = 0
+            size = resp.content_length
+            if size is not None:
+                size += offset
+            if validator:
+                _write_meta(dst, {"url": url, "validator": validator, "size": size})
+            file = writer.open(dst, offset=offset, keep_partial=bool(validator))
+            written = await _write_all(file, _stream(resp, file, chunk_size, max_chunk_size))
+        _remove_meta(dst)
+        return written
+
+
+class _RangeNotSupported(Exception):
+    pass
+
+
+async def _gather(coros):
+    '''
+    like asyncio.gather, but the others are cancelled and waited if one fails,
+    so nothing is written after the file is aborted.
+    '''
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.wait(tasks)
+        raise
+
+
+async def _download_range(session, url, file, start, end, headers, chunk_size, max_chunk_size):
+    headers = dict(headers)
+    headers["Range"] = "bytes={:d}-{:d}".format(start, end)
+    async with session.get(url, headers=headers) as resp:
+        resp.raise_for_status()
+        match = _CONTENT_RANGE.match(resp.headers.get("Content-Range", ""))
+        if resp.status != 206 or not match or int(match.group(1)) != start:
+            raise _RangeNotSupported()
+        await _stream(resp, file, chunk_size, max_chunk_size, offset=start)
+
+
+async def download_parallel(session, url, dst, writer, parts=4, min_size=8 * 1024 * 1024,
+                            headers=None, chunk_size=64 * 1024, max_chunk_size=1024 * 1024):
+    '''
+    Download url to dst with `parts` concurrent range requests if the server
+    supports ranges and the file is at least `min_size` bytes, otherwise with one request.
+    :return: bytes written.
+    '''
+    headers = dict(headers or {})
+    async with session.head(url, headers=headers, allow_redirects=True) as resp:
+        size = resp.content_length if resp.status == 200 else None
+        ranges = resp.headers.get("Accept-Ranges", "").lower() == "bytes"
+        validator = _validator(resp.headers)
+        url = str(resp.url)
+    if ranges and size and size >= min_size and parts > 1:
+        if validator:
+            # all parts must come from the same version of the file.
+            headers["If-Range"] = validator
+        file = writer.open(dst, size)
+        step = -(-size // parts)
+        try:
+            return await _write_all(file, _gather([
+                _download_range(session, url, file, start, min(start + step, size) - 1,
+                                headers, chunk_size, max_chunk_size)
+                for start in range(0, size, step)]))
+        except _RangeNotSupported:
+            headers.pop("If-Range", None)
+    async with session.get(url, headers=headers) as resp:
+        resp.raise_for_status()
+        return await save_response(resp, dst, writer, chunk_size, max_chunk_size)
@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+Disk frontier.
+Requests over the in-memory window of the scheduler are spilled to a sqlite
+database and read back by priority, then in FIFO order, when the window drains,
+so memory stays flat however many requests are waiting.
+The same database holds checkpoints: the requests in memory (waiting or
+running) and the seen-set, so a crawl can be resumed after a crash.
+
+If the database isn't temporary, spilled rows are not deleted when they are
+read back, only marked, and are removed by the next checkpoint which has them
+in its own table. So a row is always either in the frontier table or in the
+checkpoint table.
+Rows spilled by an earlier crawl are marked read back when the database is
+opened, so only `load_checkpoint` (a resume) reads them, a new crawl starts
+with nothing spilled.
+'''
+import os
+import pickle
+import sqlite3
+import tempfile
+
+__all__ = ["DiskFrontier"]
+
+
+class DiskFrontier:
+
+    def __init__(self, path=None, dumps=pickle.dumps, loads=pickle.loads, commit_every=1000):
+        '''
+        :param path: sqlite file, a temporary one removed on `close` if None.
+        :param dumps: request -> bytes, raise ValueError if request can't be stored.
+        :param loads: bytes -> request
+        '''
+        self._remove_on_close = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="aiospider-frontier-", suffix=".sqlite")
+            os.close(fd)
+        self.path = path
+        self.dumps = dumps
+        self.loads = loads
+        self.commit_every = commit_every
+        # read back rows are kept for checkpoints.
+        self._keep_popped = not self._remove_on_close
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS frontier (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                data BLOB NOT NULL,
+                popped INTEGER NOT NULL DEFAULT 0,
+                priority INTEGER NOT NULL DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS checkpoint (
+                id INTEGER PRIMARY KEY,
+                data BLOB NOT NULL);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value BLOB);
+        ''')
+        self._db.execute("CREATE INDEX IF NOT EXISTS frontier_order ON frontier (popped, priority DESC, id)")
+        # left by an earlier crawl, see `load_checkpoint`.
+        self._db.execute("UPDATE frontier SET popped = 1 WHERE popped = 0")
+        self._db.commit()
+        self._uncommitted = 0
+        self._size = 0
+
+    def __len__(self):
+        '''number of requests spilled and not read back.'''
+        return self._size
+
+    def _maybe_commit(self, n):
+        self._uncommitted += n
+        if self._uncommitted >= self.commit_every:
+            self._db.commit()
+            self._uncommitted = 0
+
+    def push(self, request, priority=0):
+        '''
+        spill one request.
+        raise ValueError if it can't be stored.
+        '''
+        data = self.dumps(request)
+        self._db.execute("INSERT INTO frontier (data, priority) VALUES (?, ?)", (data, priority))
+        self._size += 1
+        self._maybe_commit(1)
+
+    def pop(self, n):
+        '''
+        read back at most n requests, the highest priority first, then the oldest.
+        '''
+        rows = self._db.execute(
+            "SELECT id, data FROM frontier WHERE popped = 0 ORDER BY priority DESC, id LIMIT ?", (n,)).fetchall()
+        if not rows:
+            return []
+        ids = [(row_id,) for row_id, _ in rows]
+        if self._keep_popped:
+            self._db.executemany("UPDATE frontier SET popped = 1 WHERE id = ?", ids)
+        else:
+            self._db.executemany("DELETE FROM frontier WHERE id = ?", ids)
+        self._size -= len(rows)
+        self._maybe_commit(len(rows))
+        return [self.loads(data) for _, data in rows]
+
+    def top_priority(self):
+        '''
+        the highest priority of the requests spilled, None if there are none.
+        '''
+        row = self._db.execute(
+            "SELECT priority FROM frontier WHERE popped = 0 ORDER BY priority DESC, id LIMIT 1").fetchone()
+        return row[0] if row is not None else None
+
+    def save_checkpoint(self, requests, meta):
+        '''
+        Save requests hold in memory and meta data (a dict of picklable values)
+        in one transaction.
+        Requests which can't be stored are skipped.
+        :return: number of requests saved.
+        '''
+        rows = []
+        for request in requests:
+            try:
+                rows.append((self.dumps(request),))
+            except ValueError:
+                pass
+        with self._db:
+            self._db.execute("DELETE FROM checkpoint")
+            self._db.executemany("INSERT INTO checkpoint (data) VALUES (?)", rows)
+            self._db.execute("DELETE FROM frontier WHERE popped = 1")
+            self._db.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                 [(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+                                  for key, value in meta.items()])
+        self._uncommitted = 0
+        return len(rows)
+
+    def has_checkpoint(self):
+        return self._db.execute("SELECT 1 FROM meta LIMIT 1").fetchone() is not None
+
+    def load_checkpoint(self):
+        '''
+        Read everything saved: requests of the last checkpoint and all spilled
+        ones, and the meta data.
+        Requests are expected to be added again and a new checkpoint to be
+        saved at once, which replaces the old rows; until then they are kept,
+        so a crash while resuming loses nothing.
+        :return: (requests, meta)
+        '''
+        rows = self._db.execute("SELECT data FROM checkpoint ORDER BY id").fetchall()
+        rows += self._db.execute("SELECT data FROM frontier ORDER BY priority DESC, id").fetchall()
+        meta = {key: pickle.loads(value)
+                for key, value in self._db.execute("SELECT key, value FROM meta")}
+        self._db.execute("UPDATE frontier SET popped = 1")
+        self._size = 0
+        return [self.loads(data) for data, in rows], meta
+
+    def close(self):
+        if self._db is None:
+            return
+        self._db.commit()
+        self._db.close()
+        self._db = None
+        if self._remove_on_close:
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.remove(self.path + suffix)
+                except FileNotFoundError:
+                    pass
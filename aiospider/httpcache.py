@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+HTTP cache for recrawls.
+Responses to GET requests are stored in a sqlite database by the fingerprint
+of their request, with their validators (ETag, Last-Modified) and freshness
+(Cache-Control max-age, Expires).
+When the same request is sent again:
+ - a fresh entry is used as it is, without any request;
+ - otherwise the request is sent with `If-None-Match` / `If-Modified-Since`,
+   and a `304 Not Modified` is answered with the stored body.
+Callbacks get the same `Response` either way, `response.cached` tells which.
+Entries older than `max_age` are removed, and the least recently used ones
+when the bodies take more than `max_size` bytes.
+Vary is not taken into account: a spider sends the same headers every time.
+'''
+import email.utils
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import time
+from collections import namedtuple
+
+from .response import Response
+
+__all__ = ["HttpCache"]
+
+_Entry = namedtuple("Entry", ["url", "status", "headers", "body", "etag", "last_modified", "expires"])
+
+_MAX_AGE = re.compile(r"(?:^|,)\s*(s-maxage|max-age)\s*=\s*\"?(\d+)", re.I)
+
+
+def _directives(headers):
+    return {d.strip().split("=", 1)[0].lower() for d in headers.get("Cache-Control", "").split(",")}
+
+
+def _http_date(value):
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _expires(headers, now):
+    '''
+    time until which a response is fresh, 0 if it must be revalidated.
+    '''
+    directives = _directives(headers)
+    if "no-cache" in directives or "must-revalidate" in directives:
+        return 0
+    ages = dict((name.lower(), int(value)) for name, value in _MAX_AGE.findall(headers.get("Cache-Control", "")))
+    age = ages.get("s-maxage", ages.get("max-age"))
+    if age is not None:
+        try:
+            age -= int(headers.get("Age", 0))
+        except ValueError:
+            pass
+        return now + age if age > 0 else 0
+    expires = _http_date(headers.get("Expires"))
+    if expires is not None:
+        date = _http_date(headers.get("Date")) or now
+        return now + expires - date if expires > date else 0
+    return 0
+
+
+class HttpCache:
+
+    def __init__(self, path=None, max_size=1024 * 1024 * 1024, max_age=30 * 24 * 3600,
+                 max_entry_size=1024 * 1024, evict_every=1000):
+        '''
+        :param path: sqlite file, a temporary one removed on `close` if None.
+        :param max_size: max bytes of the stored bodies.
+        :param max_age: seconds an entry is kept after it was stored or revalidated.
+        :param max_entry_size: larger bodies are not stored.
+        :param evict_every: evict after that many entries stored.
+        '''
+        self._remove_on_close = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="aiospider-cache-", suffix=".sqlite")
+            os.close(fd)
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.max_entry_size = max_entry_size
+        self.evict_every = evict_every
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS cache (
+                key BLOB PRIMARY KEY,
+                url TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                headers TEXT NOT NULL,
+                body BLOB NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                expires REAL NOT NULL,
+                stored REAL NOT NULL,
+                used REAL NOT NULL,
+                size INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS cache_used ON cache (used);
+            CREATE INDEX IF NOT EXISTS cache_stored ON cache (stored);
+        ''')
+        self._db.commit()
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        self._stored = 0
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    @property
+    def size(self):
+        '''bytes of the stored bodies.'''
+        return self._size
+
+    def get(self, key):
+        '''
+        :return: the entry of key, or None.
+        '''
+        row = self._db.execute(
+            "SELECT url, status, headers, body, etag, last_modified, expires FROM cache "
+            "WHERE key = ? AND stored >= ?", (key, time.time() - self.max_age)).fetchone()
+        if row is None:
+            return None
+        return _Entry(*row)
+
+    def fresh(self, entry):
+        return entry.expires > time.time()
+
+    def conditional_headers(self, entry):
+        '''
+        headers asking the server for the entry's body only if it has changed.
+        '''
+        headers = {}
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def cacheable(self, response):
+        if response.status != 200 or response.spooled or response.size > self.max_entry_size:
+            return False
+        return "no-store" not in _directives(response.headers)
+
+    def put(self, key, response):
+        '''
+        store response if it can be cached.
+        :return: whether it was stored.
+        '''
+        if not self.cacheable(response):
+            return False
+        now = time.time()
+        headers = response.headers
+        body = response.body
+        old = self._db.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+        self._db.execute(
+            "INSERT OR REPLACE INTO cache (key, url, status, headers, body, etag, last_modified, "
+            "expires, stored, used, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, str(response.url), response.status, json.dumps(list(headers.items())), body,
+             headers.get("ETag"), headers.get("Last-Modified"), _expires(headers, now), now, now, len(body)))
+        self._size += len(body) - (old[0] if old else 0)
+        self._db.commit()
+        self._stored += 1
+        if self._stored >= self.evict_every or self._size > self.max_size:
+            self._stored = 0
+            self.evict()
+        return True
+
+    def revalidated(self, key, headers):
+        '''
+        the server answered 304 with headers: the entry is valid again, with the new freshness.
+        '''
+        now = time.time()
+        self._db.execute("UPDATE cache SET expires = ?, stored = ?, used = ?, "
+                         "etag = COALESCE(?, etag) WHERE key = ?",
+                         (_expires(headers, now), now, now, headers.get("ETag"), key))
+        self._db.commit()
+
+    def used(self, key):
+        self._db.execute("UPDATE cache SET used = ? WHERE key = ?", (time.time(), key))
+
+    def response(self, entry, request=None):
+        '''
+        a `Response` made of entry.
+        '''
+        response = Response.from_parts(entry.url, entry.status, json.loads(entry.headers), entry.body,
+                                       reason="OK", request=request)
+        response.cached = True
+        return response
+
+    def evict(self):
+        '''
+        remove entries older than max_age, then the least recently used ones
+        until the bodies take at most max_size bytes.
+        '''
+        self._db.execute("DELETE FROM cache WHERE stored < ?", (time.time() - self.max_age,))
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if self._size > self.max_size:
+            over = self._size - self.max_size
+            freed = 0
+            keys = []
+            for key, size in self._db.execute("SELECT key, size FROM cache ORDER BY used"):
+                if freed >= over:
+                    break
+                keys.append((key,))
+                freed += size
+            self._db.executemany("DELETE FROM cache WHERE key = ?", keys)
+            self._size -= freed
+        self._db.commit()
+
+    def close(self):
+        if self._db is None:
+            return
+        self._db.commit()
+        self._db.close()
+        self._db = None
+        if self._remove_on_close:
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.remove(self.path + suffix)
+                except FileNotFoundError:
+                    pass
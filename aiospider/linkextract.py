@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+Link extractor.
+Finding links with a html parser and resolving them one by one with `urljoin`
+takes most of the CPU of a link-following crawl. LinkExtractor scans the text
+for `href` and `src` attributes with one regex per attribute, in lower and
+upper case: a regex starting with a literal skips to its candidates at C
+speed, a case-insensitive one tries every position. Links are resolved against
+the base url by cheap string operations for the usual forms (absolute,
+`//host/path`, `/path`), `urljoin` is only used for relative paths.
+The scan doesn't parse html: links in comments and scripts are found too,
+mixed case attributes (`Href`) are not, and links are grouped by attribute.
+
+    extractor = LinkExtractor(allow=[r"/page/"], allow_domains=["example.com"])
+    spider.add_requests(extractor.extract(response), parse)
+'''
+import html
+import re
+from urllib.parse import urljoin, urlsplit
+
+__all__ = ["LinkExtractor"]
+
+_VALUE = r'\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'<>`=]+))'
+_BASE = re.compile(r'<base\b[^>]*?\bhref\s*=\s*["\']?([^"\'\s>]+)', re.I)
+_SCHEME = re.compile(r'^([a-zA-Z][a-zA-Z0-9+.-]*):')
+# userinfo, then a host or an ipv6 address in brackets, then a port.
+_NETLOC = re.compile(r'^(?:.*@)?(?:\[[0-9A-Fa-f:.]+\]|[^\[\]:@]*)(?::(\d*))?$')
+
+
+def _host(netloc):
+    return netloc.rpartition("@")[2].partition(":")[0].lower()
+
+
+def _valid_netloc(netloc):
+    '''
+    whether urlsplit can read the host and the port of netloc.
+    '''
+    match = _NETLOC.match(netloc.partition("?")[0])
+    return match is not None and (not match.group(1) or int(match.group(1)) <= 65535)
+
+
+class LinkExtractor:
+
+    def __init__(self, allow=(), deny=(), allow_domains=(), deny_domains=(),
+                 attrs=("href", "src"), schemes=("http", "https"), max_links=0):
+        '''
+        :param allow: regexes, links must match one of them if given.
+        :param deny: regexes, links matching one of them are dropped.
+        :param allow_domains: links must be on one of these domains (or their subdomains) if given.
+        :param deny_domains: links on these domains (or their subdomains) are dropped.
+        :param attrs: attributes holding links.
+        :param schemes: schemes of links kept.
+        :param max_links: stop after that many links of a page, 0 for no limit.
+        '''
+        self.allow = [re.compile(p) for p in allow]
+        self.deny = [re.compile(p) for p in deny]
+        self.allow_domains = tuple(d.lower().lstrip(".") for d in allow_domains)
+        self.deny_domains = tuple(d.lower().lstrip(".") for d in deny_domains)
+        self.schemes = set(schemes)
+        self.max_links = max_links
+        self._attrs = [re.compile(re.escape(name) + _VALUE)
+                       for attr in attrs for name in (attr.lower(), attr.upper())]
+
+    def _on_domains(self, host, domains):
+        for domain in domains:
+            if host == domain or host.endswith("." + domain):
+                return True
+        return False
+
+    def _keep(self, url, host):
+        if self.allow_domains and not self._on_domains(host, self.allow_domains):
+            return False
+        if self.deny_domains and self._on_domains(host, self.deny_domains):
+            return False
+        if self.allow and not any(p.search(url) for p in self.allow):
+            return False
+        if self.deny and any(p.search(url) for p in self.deny):
+            return False
+        return True
+
+    def resolve(self, links, base_url):
+        '''
+        Make links absolute against base_url, drop fragments, links of other schemes, links
+        whose host or port is malformed, the ones filtered out, and duplicates.
+        :return: list of urls, in the order of links.
+        '''
+        base = urlsplit(base_url)
+        scheme, netloc = base.scheme, base.netloc
+        root = "{}://{}".format(scheme, netloc)
+        base_host = _host(netloc)
+        result, seen = [], set()
+        for link in links:
+            link = link.strip()
+            if "&" in link:
+                link = html.unescape(link)
+            link = link.partition("#")[0]
+            if not link:
+                continue
+            # like urljoin, only paths relative to base_url have their dot segments removed.
+            if link.startswith("//"):
+                url, host = scheme + ":" + link, None
+            elif link[0] == "/":
+                url = root + link if "/." not in link else urljoin(base_url, link)
+                host = base_host
+            else:
+                match = _SCHEME.match(link)
+                if match:
+                    if match.group(1).lower() not in self.schemes:
+                        continue
+                    url, host = link, None
+                else:
+                    url, host = urljoin(base_url, link), base_host
+            if url in seen:
+                continue
+            seen.add(url)
+            if host is None:
+                parts = url.split("/", 3)
+                if len(parts) < 3 or parts[0][:-1].lower() not in self.schemes or not _valid_netloc(parts[2]):
+                    continue
+                host = _host(parts[2])
+            if self._keep(url, host):
+                result.append(url)
+                if self.max_links and len(result) >= self.max_links:
+                    break
+        return result
+
+    def links(self, text):
+        '''
+        values of link attributes in text, not resolved.
+        '''
+        for pattern in self._attrs:
+            for double, single, bare in pattern.findall(text):
+                yield double or single or bare
+
+    def extract(self, response, base_url=None):
+        '''
+        :param response: a `Response`, or html text.
+        :param base_url: url of the page, `response.url` by default. A `<base href>` in the page is used first.
+        :return: list of absolute urls.
+        '''
+        if isinstance(response, str):
+            text = response
+        else:
+            text = response.unicode_body
+            if base_url is None:
+                base_url = str(response.url)
+        match = _BASE.search(text, 0, 4096)
+        if match:
+            base_url = urljoin(base_url, html.unescape(match.group(1)))
+        return self.resolve(self.links(text), base_url)
@@ -1,7 +1,21 @@
 #!/usr/bin/python3
 #-*- coding:utf-8 -*-
 
+'''
+Loggers of aiospider are "aiospider.<class name>", under the "aiospider" logger.
+The library never configures logging, the application does, e.g.
+
+    logging.basicConfig(format=LOGGING_FORMAT, level=logging.INFO)
+
+Until then nothing is printed: a NullHandler keeps logging's last resort
+handler from printing warnings.
+'''
 import logging
 
 LOGGING_FORMAT = '%(asctime)-15s [%(name)s] %(levelname)s  %(message)s'
-logging.basicConfig(format=LOGGING_FORMAT,level=logging.DEBUG)
\ No newline at end of file
+
+logging.getLogger("aiospider").addHandler(logging.NullHandler())
+
+
+def get_logger(name):
+    return logging.getLogger("aiospider." + name)
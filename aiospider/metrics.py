@@ -0,0 +1,244 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+Crawl metrics.
+Counters, gauges and histograms cheap enough to be updated on every request:
+recording a value is a few integer operations and one dict update, nothing is
+formatted until a snapshot is taken.
+Histograms are log-linear like HDR histograms: values are kept in
+microseconds with 64 sub-buckets per power of two, so percentiles are within
+about 1.5% of the real value whatever the range.
+'''
+import asyncio
+import json
+import time
+
+from aiohttp import TraceConfig
+
+__all__ = ["Counter", "Histogram", "Metrics", "monitor_loop_lag"]
+
+# values under 2 ** _LINEAR_BITS are exact
+_LINEAR_BITS = 7
+_SUB_BITS = _LINEAR_BITS - 1
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @staticmethod
+    def _index(v):
+        bits = v.bit_length()
+        if bits <= _LINEAR_BITS:
+            return v
+        shift = bits - _LINEAR_BITS
+        return (shift << _SUB_BITS) + (v >> shift)
+
+    @staticmethod
+    def _value(idx):
+        if idx < 1 << _LINEAR_BITS:
+            return idx
+        shift = (idx >> _SUB_BITS) - 1
+        sub = (idx & ((1 << _SUB_BITS) - 1)) + (1 << _SUB_BITS)
+        # middle of the bucket
+        return (sub << shift) + (1 << (shift - 1))
+
+    def record(self, seconds):
+        v = int(seconds * 1000000)
+        if v < 0:
+            v = 0
+        idx = self._index(v)
+        counts = self.counts
+        counts[idx] = counts.get(idx, 0) + 1
+        self.count += 1
+        self.total += v
+        if v > self.max:
+            self.max = v
+
+    def percentile(self, p):
+        '''
+        :param p: 0 ~ 1
+        :return: seconds
+        '''
+        if not self.count:
+            return 0.0
+        rank = max(1, int(round(p * self.count)))
+        seen = 0
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            if seen >= rank:
+                return min(self._value(idx), self.max) / 1000000.0
+        return self.max / 1000000.0
+
+    def merge(self, other):
+        '''
+        add the values of other, e.g. a histogram of another process.
+        '''
+        for idx, n in other.counts.items():
+            self.counts[idx] = self.counts.get(idx, 0) + n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count / 1000000.0 if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "max": self.max / 1000000.0,
+        }
+
+
+class Metrics:
+    '''
+    A registry of named counters, histograms and gauges (functions returning a number).
+    '''
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.started = time.time()
+
+    def counter(self, name):
+        c = self.counters.get(name)
+        if c is None:
+            c = self.counters[name] = Counter()
+        return c
+
+    def histogram(self, name):
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram()
+        return h
+
+    def inc(self, name, n=1):
+        self.counter(name).value += n
+
+    def observe(self, name, seconds):
+        self.histogram(name).record(seconds)
+
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    def merge(self, other):
+        '''
+        add the counters and histograms of other, gauges are not merged.
+        '''
+        for name, c in other.counters.items():
+            self.counter(name).value += c.value
+        for name, h in other.histograms.items():
+            self.histogram(name).merge(h)
+
+    def __getstate__(self):
+        # gauges are functions of a spider, they stay in its process.
+        state = self.__dict__.copy()
+        state["gauges"] = {}
+        return state
+
+    def snapshot(self):
+        return {
+            "uptime": time.time() - self.started,
+            "counters": {name: c.value for name, c in self.counters.items()},
+            "gauges": {name: func() for name, func in self.gauges.items()},
+            "histograms": {name: h.summary() for name, h in self.histograms.items()},
+        }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+    def to_prometheus(self, prefix="aiospider_"):
+        '''
+        Prometheus text format, histograms are exported as summaries in seconds.
+        '''
+        lines = []
+        for name, c in sorted(self.counters.items()):
+            lines.append("# TYPE {}{}_total counter".format(prefix, name))
+            lines.append("{}{}_total {}".format(prefix, name, c.value))
+        for name, func in sorted(self.gauges.items()):
+            lines.append("# TYPE {}{} gauge".format(prefix, name))
+            lines.append("{}{} {}".format(prefix, name, func()))
+        for name, h in sorted(self.histograms.items()):
+            metric = prefix + name + "_seconds"
+            lines.append("# TYPE {} summary".format(metric))
+            for q in (0.5, 0.9, 0.99):
+                lines.append('{}{{quantile="{}"}} {:.6f}'.format(metric, q, h.percentile(q)))
+            lines.append("{}_sum {:.6f}".format(metric, h.total / 1000000.0))
+            lines.append("{}_count {}".format(metric, h.count))
+        return "\n".join(lines) + "\n"
+
+    def trace_config(self):
+        '''
+        An aiohttp TraceConfig timing dns, connect and time to first byte,
+        and counting connections.
+        '''
+        trace = TraceConfig()
+        now = time.perf_counter
+
+        async def on_request_start(session, ctx, params):
+            ctx.start = now()
+
+        async def on_request_end(session, ctx, params):
+            self.observe("ttfb", now() - ctx.start)
+
+        async def on_request_exception(session, ctx, params):
+            self.inc("request_errors")
+
+        async def on_dns_start(session, ctx, params):
+            ctx.dns_start = now()
+
+        async def on_dns_end(session, ctx, params):
+            self.observe("dns", now() - ctx.dns_start)
+
+        async def on_connection_start(session, ctx, params):
+            ctx.connect_start = now()
+
+        async def on_connection_end(session, ctx, params):
+            self.inc("connections_created")
+            self.observe("connect", now() - ctx.connect_start)
+
+        async def on_connection_reuse(session, ctx, params):
+            self.inc("connections_reused")
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_request_end.append(on_request_end)
+        trace.on_request_exception.append(on_request_exception)
+        trace.on_dns_resolvehost_start.append(on_dns_start)
+        trace.on_dns_resolvehost_end.append(on_dns_end)
+        trace.on_connection_create_start.append(on_connection_start)
+        trace.on_connection_create_end.append(on_connection_end)
+        trace.on_connection_reuseconn.append(on_connection_reuse)
+        return trace
+
+
+async def monitor_loop_lag(metrics, interval=0.1):
+    '''
+    Record how late a timer of `interval` seconds fires, in histogram `loop_lag`.
+    '''
+    lag = metrics.histogram("loop_lag")
+    now = time.perf_counter
+    try:
+        while True:
+            start = now()
+            await asyncio.sleep(interval)
+            lag.record(now() - start - interval)
+    except asyncio.CancelledError:
+        pass
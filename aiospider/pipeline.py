@@ -0,0 +1,340 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+Item pipeline.
+Items are what callbacks and parsers return or yield, except requests. Writing
+each item to a file or a database in the callback blocks the loop on every
+item. With an `ItemPipeline` passed by `pipeline`, items go through a chain of
+processors (in the loop, cheap: validation, transforms, dedup), and are kept
+in a buffer handed over in batches to one writer thread, which writes each
+batch to every sink at once: one write for a JSON lines or CSV file, one
+`executemany` in one transaction for sqlite.
+A batch is handed over when it has `batch_size` items, or `flush_interval`
+seconds after the last one. When more than `max_pending` items wait for the
+writer, callbacks adding items wait, so the workers fetch slower until the
+sinks catch up.
+
+    pipeline = ItemPipeline([JsonLinesSink("items.jsonl"), SqliteSink("items.db")],
+                            processors=[require("url", "title"), Dedup("url")])
+    with Spider(pipeline=pipeline) as ss:
+        ...
+
+A processor is `processor(item)` (a function or a coroutine function), it returns
+the item, changed or not, or None to drop it. A sink has `write(items)` and
+`close()`, both called in the writer thread.
+'''
+import asyncio
+import csv
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .seen import MemorySeenSet
+from .log import get_logger
+
+__all__ = ["ItemPipeline", "Sink", "JsonLinesSink", "SqliteSink", "CsvSink", "require", "Dedup"]
+
+
+def require(*fields):
+    '''
+    a processor dropping items (dicts) which miss one of fields or have it empty.
+    '''
+    def check(item):
+        for field in fields:
+            if item.get(field) in (None, "", [], {}):
+                return None
+        return item
+    return check
+
+
+class Dedup:
+    '''
+    a processor dropping items whose key was seen before.
+    :param key: a field name, or a function item -> key.
+    :param seen: a `SeenSet`, e.g. a BloomSeenSet for many items. A MemorySeenSet by default.
+    '''
+
+    def __init__(self, key, seen=None):
+        self.key = key if callable(key) else lambda item: item.get(key)
+        self.seen = seen if seen is not None else MemorySeenSet()
+
+    def __call__(self, item):
+        key = self.key(item)
+        if key is None:
+            return item
+        if not isinstance(key, (str, bytes)):
+            key = str(key)
+        return item if self.seen.add(key) else None
+
+
+class Sink:
+    '''
+    Interface of sinks, called in the writer thread only.
+    '''
+
+    def write(self, items):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def _json(value):
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+class JsonLinesSink(Sink):
+    '''
+    one json object per line, appended.
+    '''
+
+    def __init__(self, path, mode="a"):
+        self.path = path
+        self.mode = mode
+        self._fd = None
+
+    def write(self, items):
+        if self._fd is None:
+            self._fd = open(self.path, self.mode, encoding="utf-8")
+        self._fd.write("".join(_json(item) + "\n" for item in items))
+        self._fd.flush()
+
+    def close(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+
+class SqliteSink(Sink):
+    '''
+    one row per item in `table`, a batch in one transaction.
+    Columns are `columns`, or the fields of the first item; other fields are ignored, values
+    which aren't numbers, strings or bytes are stored as json.
+    '''
+
+    def __init__(self, path, table="items", columns=None):
+        self.path = path
+        self.table = table
+        self.columns = list(columns) if columns else None
+        self._db = None
+        self._insert = None
+
+    def _open(self, item):
+        if self.columns is None:
+            self.columns = list(item)
+        # made in the writer thread, used by it only.
+        self._db = sqlite3.connect(self.path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute('CREATE TABLE IF NOT EXISTS "{}" ({})'.format(
+            self.table, ", ".join('"{}"'.format(column) for column in self.columns)))
+        self._insert = 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+            self.table, ", ".join('"{}"'.format(column) for column in self.columns),
+            ", ".join("?" * len(self.columns)))
+
+    @staticmethod
+    def _value(value):
+        if value is None or isinstance(value, (int, float, str, bytes)):
+            return value
+        return _json(value)
+
+    def write(self, items):
+        if self._db is None:
+            self._open(items[0])
+        value = self._value
+        with self._db:
+            self._db.executemany(self._insert, [[value(item.get(column)) for column in self.columns]
+                                                for item in items])
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class CsvSink(Sink):
+    '''
+    one row per item, columns are `fields` or the fields of the first item, a header is
+    written in a new file.
+    '''
+
+    def __init__(self, path, fields=None, **fmtparams):
+        self.path = path
+        self.fields = list(fields) if fields else None
+        self.fmtparams = fmtparams
+        self._fd = None
+        self._writer = None
+
+    def write(self, items):
+        if self._fd is None:
+            if self.fields is None:
+                self.fields = list(items[0])
+            new = not os.path.exists(self.path) or not os.path.getsize(self.path)
+            self._fd = open(self.path, "a", newline="", encoding="utf-8")
+            self._writer = csv.DictWriter(self._fd, self.fields, extrasaction="ignore", **self.fmtparams)
+            if new:
+                self._writer.writeheader()
+        self._writer.writerows(items)
+        self._fd.flush()
+
+    def close(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+
+class ItemPipeline:
+
+    def __init__(self, sinks, processors=(), batch_size=500, flush_interval=1.0, max_pending=10000):
+        '''
+        :param sinks: `Sink`s every batch is written to.
+        :param processors: run on each item in order, see the module's doc.
+        :param batch_size: items handed to the writer at once.
+        :param flush_interval: max seconds an item waits in the buffer.
+        :param max_pending: items waiting for the writer over which adding items waits.
+        '''
+        self.sinks = list(sinks)
+        self.processors = list(processors)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.metrics = None
+        self.logger = get_logger(self.__class__.__name__)
+        self._buffer = []
+        # items handed to the writer and not written yet
+        self._pending = 0
+        self._batches = None
+        self._room = None
+        self._tasks = []
+        self._executor = None
+
+    def start(self, metrics=None):
+        '''
+        start the writer, in the running loop. `put` starts it if needed.
+        :param metrics: a `Metrics` counting items written, dropped and write errors.
+        '''
+        if metrics is not None:
+            self.metrics = metrics
+        if self._tasks:
+            return
+        self._batches = asyncio.Queue()
+        self._room = asyncio.Event()
+        self._room.set()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="aiospider-items")
+        self._tasks = [asyncio.ensure_future(self._write_batches()),
+                       asyncio.ensure_future(self._flush_periodically())]
+
+    def _inc(self, name, n=1):
+        if self.metrics is not None:
+            self.metrics.inc(name, n)
+
+    def pending(self):
+        '''
+        items not written yet.
+        '''
+        return len(self._buffer) + self._pending
+
+    async def put(self, item):
+        '''
+        process item and buffer it, wait if the writer is `max_pending` items behind.
+        '''
+        if not self._tasks:
+            self.start()
+        for processor in self.processors:
+            item = processor(item)
+            if asyncio.iscoroutine(item):
+                item = await item
+            if item is None:
+                self._inc("items_dropped")
+                return
+        self._buffer.append(item)
+        if len(self._buffer) >= self.batch_size:
+            self._flush()
+        if not self._room.is_set():
+            self._inc("items_waits")
+            await self._room.wait()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        self._pending += len(batch)
+        if self._pending >= self.max_pending:
+            self._room.clear()
+        self._batches.put_nowait(batch)
+
+    async def _flush_periodically(self):
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                self._flush()
+        except asyncio.CancelledError:
+            pass
+
+    def _write(self, batch):
+        '''
+        in the writer thread.
+        :return: (seconds, names of the sinks which failed)
+        '''
+        start = time.perf_counter()
+        failed = []
+        for sink in self.sinks:
+            try:
+                sink.write(batch)
+            except Exception:
+                failed.append(type(sink).__name__)
+                self.logger.error("Error happened when %d items were written to %r.", len(batch), sink,
+                                  exc_info=True)
+        return time.perf_counter() - start, failed
+
+    async def _write_batches(self):
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                batch = await self._batches.get()
+                try:
+                    elapsed, failed = await loop.run_in_executor(self._executor, self._write, batch)
+                    self._inc("items_written", len(batch))
+                    self._inc("item_write_errors", len(failed))
+                    if self.metrics is not None:
+                        self.metrics.observe("item_write", elapsed)
+                finally:
+                    self._pending -= len(batch)
+                    if self._pending < self.max_pending:
+                        self._room.set()
+                    self._batches.task_done()
+        except asyncio.CancelledError:
+            pass
+
+    async def drain(self):
+        '''
+        hand over the buffer and wait until everything is written.
+        '''
+        if not self._tasks:
+            return
+        self._flush()
+        await self._batches.join()
+
+    async def close(self):
+        '''
+        write what is left and close the sinks.
+        '''
+        await self.drain()
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._executor is not None:
+            for sink in self.sinks:
+                await asyncio.get_event_loop().run_in_executor(self._executor, sink.close)
+            # its thread has nothing left to do, it isn't joined on the loop.
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        else:
+            for sink in self.sinks:
+                sink.close()
@@ -3,4 +3,126 @@
 
 '''
 Request object
-'''
\ No newline at end of file
+'''
+from collections import namedtuple
+import hashlib
+import json
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+DEFAULT_HEADER = {'user-agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.87 Safari/537.36',
+                  'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8'
+                  }
+# kwargs: other arguments of `ClientSession.request` (proxy, timeout, compress, params, json...), or None.
+# priority: higher first. depth: links followed from a start url, None until the spider sets it.
+# fingerprint: see `fingerprint`, set by the spider when the request is added so it is computed once.
+_Request = namedtuple(
+    "Request", ["method", "url", "header", "data", "callback", "kwargs", "priority", "depth", "fingerprint"],
+    defaults=(None, 0, None, None))
+# `Request` is the factory function below, let pickle find the class by its own name.
+_Request.__qualname__ = "_Request"
+
+
+def Request(method, url, header=DEFAULT_HEADER, data=None, callback=None, priority=0, depth=None, **kwargs):
+    '''
+    :param header: headers sent, `headers` (aiohttp's name) is taken too. They replace DEFAULT_HEADER.
+    :param priority: requests of higher priority are sent first.
+    :param depth: by default, the depth of the request whose callback adds it plus one, 0 out of callbacks.
+    :param kwargs: passed to `ClientSession.request`, e.g. proxy, timeout (seconds or a ClientTimeout),
+        compress, params, json, cookies, allow_redirects.
+    '''
+    if "headers" in kwargs:
+        header = kwargs.pop("headers")
+    return _Request(method, url, header, data, callback, kwargs or None, priority, depth)
+
+
+DEFAULT_PORTS = {"http": 80, "https": 443, "ws": 80, "wss": 443, "ftp": 21}
+# size of fingerprints in bytes
+FINGERPRINT_SIZE = 16
+
+
+def canonicalize_url(url, strip_trailing_slash=True):
+    '''
+    Normalize url, so that different spellings of one page are equal.
+     - scheme and host are lower-cased, default port is removed.
+     - query parameters are sorted.
+     - fragment is removed.
+     - empty path becomes `/`, and the trailing slash of other paths is removed
+       if `strip_trailing_slash`.
+    A malformed url (a bad port, an unclosed ipv6 bracket) is returned stripped only.
+    '''
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+        host, port = parts.hostname or "", parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc
+    if netloc:
+        userinfo, _, hostport = netloc.rpartition("@")
+        if ":" in host:
+            # ipv6
+            host = "[" + host + "]"
+        if port is not None and DEFAULT_PORTS.get(scheme) != port:
+            host = "{}:{:d}".format(host, port)
+        netloc = userinfo + "@" + host if userinfo else host
+    path = parts.path or "/"
+    if strip_trailing_slash and len(path) > 1 and path.endswith("/"):
+        path = path.rstrip("/") or "/"
+    query = parts.query
+    if query:
+        query = urlencode(sorted(parse_qsl(query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, path, query, ""))
+
+
+def _field_key(field):
+    # keys and values of any types (1 and "b") are sent as text, so they are compared as text.
+    return tuple(str(part) for part in field) if isinstance(field, (list, tuple)) else str(field)
+
+
+def _body_bytes(data):
+    if data is None:
+        return b""
+    if isinstance(data, bytes):
+        return data
+    if isinstance(data, str):
+        return data.encode("utf-8")
+    if isinstance(data, dict):
+        return urlencode(sorted(data.items(), key=_field_key)).encode("utf-8")
+    if isinstance(data, (list, tuple)):
+        return urlencode(sorted(data, key=_field_key)).encode("utf-8")
+    # streams, FormData ... can't be read here.
+    return None
+
+
+def request_fingerprint(method, url, data=None, strip_trailing_slash=True):
+    '''
+    A compact fixed-size digest identifying a request: the method, the
+    canonical url and the body are hashed together.
+    :return: `FINGERPRINT_SIZE` bytes, None if the body can't be read (a stream, a FormData):
+        such a request has no fingerprint and is never taken as a duplicate.
+    '''
+    body = _body_bytes(data)
+    if body is None:
+        return None
+    h = hashlib.blake2b(digest_size=FINGERPRINT_SIZE)
+    h.update(method.upper().encode("ascii"))
+    h.update(b"\0")
+    h.update(canonicalize_url(url, strip_trailing_slash).encode("utf-8"))
+    h.update(b"\0")
+    h.update(body)
+    return h.digest()
+
+
+def fingerprint(request: _Request, strip_trailing_slash=True):
+    '''
+    fingerprint of a `Request`, its `params` and `json` are taken as part of its url and body.
+    '''
+    url, data = request.url, request.data
+    if request.kwargs:
+        params = request.kwargs.get("params")
+        if params:
+            url += ("&" if "?" in url else "?") + (params if isinstance(params, str) else urlencode(params, doseq=True))
+        if data is None and request.kwargs.get("json") is not None:
+            data = json.dumps(request.kwargs["json"], sort_keys=True)
+    return request_fingerprint(request.method, url, data, strip_trailing_slash)
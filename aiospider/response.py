@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+Response given to callbacks.
+The body of an aiohttp response is gone once its connection is released, so
+every callback had to read and decode it itself, before returning.
+`Response` reads the body once, while the connection is held, and keeps it:
+text, json and the parsed document are made from it when first asked for and
+cached, and the response stays valid after the request is finished, in sync
+callbacks and in other threads too.
+A body over `spool_size` bytes is moved to a temporary file while it is read,
+and one over `max_size` is not read at all (`ResponseTooLarge`).
+It has the `text`, `json` and `read` coroutines of aiohttp's response, so
+callbacks written for it still work.
+'''
+import codecs
+import io
+import json
+import re
+import tempfile
+
+import aiohttp
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+__all__ = ["Response", "ResponseTooLarge"]
+
+_META_CHARSET = re.compile(br'<meta[^>]+charset\s*=\s*["\']?\s*([\w.:-]+)', re.I)
+
+
+class ResponseTooLarge(Exception):
+    def __init__(self, url, size, max_size):
+        super().__init__("Body of {} is larger than {} bytes ({}).".format(url, max_size, size))
+        self.url = url
+        self.size = size
+        self.max_size = max_size
+
+
+def _lookup(encoding):
+    try:
+        return codecs.lookup(encoding).name
+    except (LookupError, TypeError):
+        return None
+
+
+class Response:
+
+    def __init__(self, url, status, headers, body=b"", file=None, size=None, *,
+                 method="GET", reason=None, charset=None, content_type=None,
+                 history=(), cookies=None, request_info=None, request=None):
+        '''
+        Usually made by `Response.read_from`.
+        :param body: the body, if it is in memory.
+        :param file: a file holding the body, if it has been spooled.
+        '''
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.method = method
+        self.charset = charset
+        self.content_type = content_type
+        self.history = history
+        self.cookies = cookies
+        self.request_info = request_info
+        # the `Request` sent, set by spider.
+        self.request = request
+        # served by the HttpCache, see httpcache.py.
+        self.cached = False
+        # see `keep`.
+        self.kept = False
+        self._body = body
+        self._file = file
+        self.size = len(body) if size is None else size
+        self._encoding = None
+        self._text = None
+        self._json = None
+        self._document = None
+
+    @classmethod
+    async def read_from(cls, resp, request=None, max_size=0, spool_size=1024 * 1024, chunk_size=64 * 1024):
+        '''
+        Read the body of an aiohttp response.
+        :param max_size: raise ResponseTooLarge if the body is larger, 0 for no limit.
+        :param spool_size: a body larger than this is kept in a temporary file.
+        '''
+        if max_size and resp.content_length is not None and resp.content_length > max_size:
+            raise ResponseTooLarge(resp.url, resp.content_length, max_size)
+        chunks, size, file = [], 0, None
+        try:
+            while True:
+                data = await resp.content.read(chunk_size)
+                if not data:
+                    break
+                size += len(data)
+                if max_size and size > max_size:
+                    raise ResponseTooLarge(resp.url, size, max_size)
+                if file is not None:
+                    file.write(data)
+                    continue
+                chunks.append(data)
+                if spool_size and size > spool_size:
+                    file = tempfile.TemporaryFile(prefix="aiospider-body-")
+                    file.writelines(chunks)
+                    chunks = None
+        except BaseException:
+            if file is not None:
+                file.close()
+            raise
+        return cls(resp.url, resp.status, resp.headers, b"".join(chunks) if file is None else None,
+                   file, size, method=resp.method, reason=resp.reason, charset=resp.charset,
+                   content_type=resp.content_type, history=resp.history, cookies=resp.cookies,
+                   request_info=resp.request_info, request=request)
+
+    @classmethod
+    def from_parts(cls, url, status, headers, body, reason=None, request=None, file=None, size=None):
+        '''
+        Make a response of stored parts, content type and charset are read from headers.
+        :param headers: a multidict, or a list of (name, value).
+        :param file: a file holding the body instead, of `size` bytes.
+        '''
+        if not isinstance(headers, CIMultiDictProxy):
+            headers = CIMultiDictProxy(CIMultiDict(headers))
+        value = headers.get("Content-Type", "application/octet-stream")
+        content_type, _, params = value.partition(";")
+        charset = None
+        for param in params.split(";"):
+            name, _, v = param.partition("=")
+            if name.strip().lower() == "charset":
+                charset = v.strip().strip('"')
+        return cls(url if isinstance(url, URL) else URL(url), status, headers, body, file, size, reason=reason,
+                   charset=charset, content_type=content_type.strip().lower(), request=request)
+
+    def __repr__(self):
+        return "<Response [{} {}] {} {} bytes>".format(self.status, self.reason, self.url, self.size)
+
+    @property
+    def ok(self):
+        return self.status < 400
+
+    @property
+    def content_length(self):
+        return self.size
+
+    @property
+    def spooled(self):
+        '''
+        Whether the body is in a temporary file.
+        '''
+        return self._file is not None
+
+    @property
+    def file(self):
+        '''
+        A binary file of the body, at its beginning. Read a large body from it by parts.
+        '''
+        if self._file is None:
+            return io.BytesIO(self._body)
+        self._file.seek(0)
+        return self._file
+
+    @property
+    def body(self):
+        '''
+        The body as bytes. A spooled body is read from its file each time.
+        '''
+        if self._file is None:
+            return self._body
+        return self.file.read()
+
+    @property
+    def encoding(self):
+        '''
+        charset of Content-Type, else of a `<meta>` tag in an html body, else utf-8.
+        '''
+        if self._encoding is None:
+            encoding = _lookup(self.charset)
+            if encoding is None and self.content_type in ("text/html", "application/xhtml+xml"):
+                match = _META_CHARSET.search(self.file.read(2048))
+                if match:
+                    encoding = _lookup(match.group(1).decode("ascii"))
+            self._encoding = encoding or "utf-8"
+        return self._encoding
+
+    @property
+    def unicode_body(self):
+        '''
+        The decoded body, undecodable bytes are replaced.
+        '''
+        if self._text is None:
+            self._text = self.body.decode(self.encoding, "replace")
+        return self._text
+
+    @property
+    def json_body(self):
+        if self._json is None:
+            self._json = json.loads(self.unicode_body)
+        return self._json
+
+    @property
+    def document(self):
+        '''
+        The body parsed by lxml.html, links can be made absolute by `make_links_absolute()`.
+        '''
+        if self._document is None:
+            if lxml is None:
+                raise ImportError("lxml is needed to parse documents.")
+            self._document = lxml.html.document_fromstring(self.body, base_url=str(self.url))
+        return self._document
+
+    # aiohttp.ClientResponse compatible.
+
+    async def read(self):
+        return self.body
+
+    async def text(self, encoding=None, errors="replace"):
+        if (encoding is None or _lookup(encoding) == self.encoding) and errors == "replace":
+            return self.unicode_body
+        return self.body.decode(encoding or self.encoding, errors)
+
+    async def json(self, *, encoding=None, loads=None, content_type="application/json"):
+        if content_type and self.content_type != content_type:
+            raise aiohttp.ContentTypeError(
+                self.request_info, self.history, status=self.status,
+                message="Attempt to decode JSON with unexpected mimetype: {}".format(self.content_type),
+                headers=self.headers)
+        if loads is not None:
+            return loads(await self.text(encoding))
+        if encoding is not None:
+            return json.loads(await self.text(encoding))
+        return self.json_body
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise aiohttp.ClientResponseError(
+                self.request_info, self.history, status=self.status,
+                message=self.reason, headers=self.headers)
+
+    def release(self):
+        pass
+
+    def keep(self):
+        '''
+        Spider closes the response once its callback has returned. A callback using it later
+        (in a task it starts) calls this, and closes it itself.
+        '''
+        self.kept = True
+        return self
+
+    def close(self):
+        '''
+        Remove the temporary file of a spooled body.
+        '''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._body = b""
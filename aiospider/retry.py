@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+Retries and circuit breakers.
+RetryPolicy tells whether a failed request (an exception, or a status such as
+503) is tried again, and after how long: exponential backoff with full jitter,
+or the server's `Retry-After` if it is longer. The request is put back into
+the scheduler after the delay, the worker doesn't wait for it.
+HostBreakers counts the failures of each host in a row: requests without
+response, and responses telling the host is overloaded (429, 503), not errors
+of single pages such as a 500. After `failure_threshold` of them the host's
+breaker opens: its requests are paused in the scheduler for `reset_timeout`
+seconds instead of taking workers, then the host is tried again, and paused
+twice as long if it still fails. A host still failing after `max_opens`
+pauses is down: its requests are dropped.
+'''
+import asyncio
+import collections
+import email.utils
+import random
+import time
+
+import aiohttp
+
+__all__ = ["RetryPolicy", "HostBreakers"]
+
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+class RetryPolicy:
+
+    def __init__(self, max_retries=3, backoff=0.5, max_backoff=60.0, statuses=RETRY_STATUSES,
+                 exceptions=(aiohttp.ClientError, asyncio.TimeoutError), respect_retry_after=True):
+        '''
+        :param max_retries: retries of a request, 0 to never retry.
+        :param backoff: delay before the first retry, doubled for each other one.
+        :param max_backoff: max delay, `Retry-After` included.
+        :param statuses: statuses of responses retried.
+        :param exceptions: exception classes retried.
+        '''
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = frozenset(statuses)
+        self.exceptions = tuple(exceptions)
+        self.respect_retry_after = respect_retry_after
+
+    def retry_status(self, status, retries):
+        '''
+        :param retries: retries done already.
+        '''
+        return status in self.statuses and retries < self.max_retries
+
+    def retry_exception(self, error, retries):
+        return isinstance(error, self.exceptions) and retries < self.max_retries
+
+    def delay(self, retries, headers=None):
+        '''
+        seconds before the next try.
+        '''
+        # full jitter: uniform between 0 and the exponential backoff.
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** retries))
+        if self.respect_retry_after and headers is not None and "Retry-After" in headers:
+            delay = max(delay, min(self.max_backoff, _retry_after(headers["Retry-After"])))
+        return delay
+
+
+def _retry_after(value):
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return 0.0
+
+
+class _Breaker:
+    __slots__ = ("failures", "opened", "timeout", "until")
+
+    def __init__(self):
+        self.failures = 0
+        # times opened in a row.
+        self.opened = 0
+        self.timeout = 0.0
+        # monotonic time the host is paused until.
+        self.until = 0.0
+
+
+class HostBreakers:
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, max_timeout=600.0, max_opens=3,
+                 statuses=(429, 503), max_hosts=10000):
+        '''
+        :param failure_threshold: failures in a row opening the breaker of a host, 0 to never open.
+        :param reset_timeout: seconds a host is paused when its breaker opens the first time.
+        :param max_timeout: max seconds a host is paused.
+        :param max_opens: a host failing again after that many pauses is down, 0 for never.
+        :param statuses: statuses of responses counted as failures.
+        :param max_hosts: hosts remembered, the least recently failed are forgotten.
+        '''
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_timeout = max_timeout
+        self.max_opens = max_opens
+        self.statuses = frozenset(statuses)
+        self.max_hosts = max_hosts
+        self._hosts = collections.OrderedDict()
+        # hosts down.
+        self.dead = set()
+
+    def success(self, host):
+        # only failing hosts are remembered.
+        self._hosts.pop(host, None)
+
+    def failure(self, host):
+        '''
+        :return: seconds to pause host if its breaker opens now, else 0.
+        '''
+        breaker = self._hosts.get(host)
+        if breaker is None:
+            breaker = self._hosts[host] = _Breaker()
+            if len(self._hosts) > self.max_hosts:
+                self._hosts.popitem(last=False)
+        else:
+            self._hosts.move_to_end(host)
+        now = time.monotonic()
+        if breaker.until > now:
+            # a request sent before the pause, the host is paused already.
+            return 0
+        breaker.failures += 1
+        if not self.failure_threshold or breaker.failures < self.failure_threshold:
+            return 0
+        if self.max_opens and breaker.opened >= self.max_opens:
+            del self._hosts[host]
+            self.dead.add(host)
+            return 0
+        # open, the next failure after the pause opens it again.
+        breaker.failures = self.failure_threshold - 1
+        breaker.timeout = min(self.max_timeout, self.reset_timeout * 2 ** breaker.opened)
+        breaker.opened += 1
+        breaker.until = now + breaker.timeout
+        return breaker.timeout
+
+    def open_hosts(self):
+        '''
+        hosts whose breaker has opened and which didn't succeed since.
+        '''
+        return {host: b.timeout for host, b in self._hosts.items() if b.opened}
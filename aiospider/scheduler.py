@@ -0,0 +1,375 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+Per-host scheduler.
+With one FIFO queue, when a slow host dominates the queue all the workers wait
+on it while the other hosts starve.
+HostScheduler keeps one sub-queue per host and hands requests out round-robin
+over the hosts which are ready, i.e. have queued requests, run less than
+`concurrent_per_host` requests and have waited `delay` seconds since their
+last request started.
+Requests have a priority: a sub-queue is a heap giving its highest priority
+first, and ready hosts are in a heap by the priority of their first request,
+so the next request is the one of highest priority among ready hosts. Hosts
+of equal priority take turns, requests of equal priority are FIFO.
+It has the same methods as asyncio.Queue that spider uses, except that
+`task_done` takes the finished request.
+If a `controller` (see adaptive.py) is set, its global limit caps the running
+requests of all hosts and its host limits cap the ones of each host.
+If a `spill` store (see frontier.py) is set, at most `max_memory` requests wait
+in memory, the others wait in the store. A request of higher priority than all
+the spilled ones stays in memory if there is room, and a spilled request of
+higher priority than all the ones in memory is read back at the next `get`, so
+spilling doesn't change the order of priorities.
+If `metrics` (see metrics.py) is set, how long each request waited in memory
+is recorded in its `queue_wait` histogram.
+`put_later` puts a request back after a delay (a retry), it is counted as
+unfinished meanwhile so that `join` still waits for it. `pause` keeps a host
+from being picked until a time (its circuit breaker is open, see retry.py).
+'''
+import collections
+import heapq
+import itertools
+import re
+from asyncio import events, QueueEmpty
+from urllib.parse import urlsplit
+
+__all__ = ["HostScheduler", "host_of"]
+
+
+_NETLOC = re.compile(r"[a-zA-Z][a-zA-Z0-9+.-]*://([^/?#]*)")
+
+
+def host_of(url):
+    '''
+    the key of sub-queues: host and port of url.
+    '''
+    # a regex is much cheaper than urlsplit, which is called for each request.
+    match = _NETLOC.match(url)
+    netloc = match.group(1) if match else urlsplit(url).netloc
+    return netloc.rpartition("@")[2].lower()
+
+
+class _Host:
+    __slots__ = ("name", "queue", "active", "next_time", "ready", "timer")
+
+    def __init__(self, name):
+        self.name = name
+        # heap of (-priority, seq, enqueue time, request)
+        self.queue = []
+        self.active = 0
+        self.next_time = 0.0
+        # its entry in the ready heap, None if it isn't ready.
+        self.ready = None
+        self.timer = None
+
+
+class HostScheduler:
+
+    def __init__(self, concurrent_per_host=0, delay=0, *, controller=None,
+                 spill=None, max_memory=0, metrics=None, loop=None):
+        '''
+        :param concurrent_per_host: max running requests of one host, 0 for no limit.
+        :param delay: min seconds between two requests to one host.
+        :param controller: an `AIMDController`, optional.
+        :param spill: a `DiskFrontier`, optional.
+        :param max_memory: max requests waiting in memory when spill is set.
+        :param metrics: a `Metrics`, optional.
+        '''
+        if loop is None:
+            self._loop = events.get_event_loop()
+        else:
+            self._loop = loop
+        self.concurrent_per_host = concurrent_per_host
+        self.delay = delay
+        self._hosts = {}
+        # hosts can be picked now: a heap of (-priority of their first request, seq, host). Entries
+        # of hosts not ready any more or with a new first request are left in it, `_nready` counts valid ones.
+        self._ready = []
+        self._nready = 0
+        # ties are broken by order of arrival.
+        self._seq = itertools.count()
+        # Futures.
+        self._getters = collections.deque()
+        self._joiners = []
+        self._size = 0
+        self._unfinished = 0
+        # requests waiting for `put_later`'s delay, by id.
+        self._delayed = {}
+        # running requests of all hosts.
+        self._running = {}
+        self.spill = spill if max_memory > 0 else None
+        self.max_memory = max_memory
+        # number of requests of each priority waiting in memory, and the highest priority spilled,
+        # None if nothing is.
+        self._priorities = collections.Counter()
+        self._spill_top = self.spill.top_priority() if self.spill is not None and len(self.spill) else None
+        self.controller = controller
+        if controller is not None:
+            controller.on_change = self._on_limit_change
+        self._queue_wait = metrics.histogram("queue_wait") if metrics is not None else None
+
+    def _wakeup_next(self, waiters):
+        # Wake up the next waiter (if any) that isn't cancelled.
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def _host_limit(self, host):
+        if self.controller is None:
+            return self.concurrent_per_host
+        limit = self.controller.limit_of(host.name)
+        if self.concurrent_per_host:
+            limit = min(limit, self.concurrent_per_host)
+        return limit
+
+    def _global_full(self):
+        return self.controller is not None and len(self._running) >= self.controller.limit
+
+    def _on_limit_change(self):
+        # hosts blocked by their old limit are checked again.
+        for host in list(self._hosts.values()):
+            self._check_ready(host)
+        if not self._global_full():
+            self._wakeup_next(self._getters)
+
+    def _check_ready(self, host):
+        if host.ready or host.timer is not None or not host.queue:
+            return
+        limit = self._host_limit(host)
+        if limit and host.active >= limit:
+            return
+        if host.next_time > self._loop.time():
+            host.timer = self._loop.call_at(host.next_time, self._on_timer, host)
+            return
+        self._nready += 1
+        self._push_ready(host)
+        if not self._global_full():
+            self._wakeup_next(self._getters)
+
+    def _push_ready(self, host):
+        host.ready = (host.queue[0][0], next(self._seq), host)
+        heapq.heappush(self._ready, host.ready)
+
+    def _unready(self, host):
+        host.ready = None
+        self._nready -= 1
+        if not self._nready:
+            # only stale entries are left.
+            self._ready.clear()
+
+    def _on_timer(self, host):
+        host.timer = None
+        self._check_ready(host)
+
+    def _forget(self, host):
+        # idle hosts are dropped, so a crawl over millions of hosts keeps few entries.
+        if host.queue or host.active or host.timer is not None \
+                or self._hosts.get(host.name) is not host:
+            return
+        if host.next_time > self._loop.time():
+            # keep it until its delay passed.
+            self._loop.call_at(host.next_time, self._forget, host)
+            return
+        del self._hosts[host.name]
+
+    def __repr__(self):
+        return '<{} at {:#x} {}>'.format(
+            type(self).__name__, id(self), self._format())
+
+    def _format(self):
+        return 'size={} hosts={} ready={} running={} unfinished={}'.format(
+            self.qsize(), len(self._hosts), self._nready, len(self._running), self._unfinished)
+
+    def qsize(self):
+        """Number of requests waiting in all sub-queues(and the spill store, and for a retry)."""
+        if self.spill is not None:
+            return self._size + len(self._delayed) + len(self.spill)
+        return self._size + len(self._delayed)
+
+    def empty(self):
+        return not self.qsize()
+
+    def depths(self):
+        '''
+        number of waiting requests of each host, spilled ones are not counted.
+        '''
+        return {name: len(host.queue) for name, host in self._hosts.items() if host.queue}
+
+    def active(self):
+        '''
+        number of running requests of each host.
+        '''
+        return {name: host.active for name, host in self._hosts.items() if host.active}
+
+    def put_nowait(self, request):
+        self._unfinished += 1
+        self._put(request)
+
+    def put_later(self, request, delay):
+        '''
+        put request after delay seconds, without waiting for it.
+        '''
+        self._unfinished += 1
+        self._delayed[id(request)] = request
+        self._loop.call_later(delay, self._put_delayed, request)
+
+    def _put_delayed(self, request):
+        if self._delayed.pop(id(request), None) is not None:
+            self._put(request)
+
+    def _put(self, request):
+        # once something is spilled, new ones go after it to keep the order, unless they come before
+        # all of it anyway.
+        if self.spill is not None and (self._size >= self.max_memory
+                                       or len(self.spill) and request.priority <= self._spill_top):
+            try:
+                self.spill.push(request, request.priority)
+                if len(self.spill) == 1 or request.priority > self._spill_top:
+                    self._spill_top = request.priority
+                return
+            except ValueError:
+                # can't be stored, keep it in memory.
+                pass
+        self._enqueue(request)
+
+    def _enqueue(self, request):
+        name = host_of(request.url)
+        host = self._hosts.get(name)
+        if host is None:
+            host = self._hosts[name] = _Host(name)
+        heapq.heappush(host.queue, (-request.priority, next(self._seq), self._loop.time(), request))
+        self._size += 1
+        self._priorities[request.priority] += 1
+        if host.ready and host.queue[0][0] < host.ready[0]:
+            # a new first request, of higher priority.
+            self._push_ready(host)
+        self._check_ready(host)
+
+    def pause(self, name, until):
+        '''
+        host `name` isn't picked before `until` (loop time), running requests go on.
+        '''
+        host = self._hosts.get(name)
+        if host is None:
+            host = self._hosts[name] = _Host(name)
+        if until <= host.next_time:
+            return
+        host.next_time = until
+        if host.ready:
+            self._unready(host)
+        if host.timer is not None:
+            host.timer.cancel()
+            host.timer = None
+        self._check_ready(host)
+        self._forget(host)
+
+    def _refill(self):
+        if self.spill is None or not len(self.spill):
+            return
+        if self._size <= self.max_memory // 2:
+            n = self.max_memory - self._size
+        elif self._size <= self.max_memory and self._spill_top > max(self._priorities):
+            # the best spilled request comes before all the ones in memory. One at a time, as
+            # requests are got, so memory stays within one request of `max_memory`.
+            n = 1
+        else:
+            return
+        for request in self.spill.pop(n):
+            self._enqueue(request)
+        self._spill_top = self.spill.top_priority() if len(self.spill) else None
+
+    def running(self):
+        '''
+        number of running requests of all hosts.
+        '''
+        return len(self._running)
+
+    def requests(self):
+        '''
+        all requests in memory, running ones first.
+        '''
+        result = list(self._running.values())
+        result.extend(self._delayed.values())
+        for host in self._hosts.values():
+            result.extend(entry[3] for entry in host.queue)
+        return result
+
+    def get_nowait(self):
+        if not self._nready or self._global_full():
+            raise QueueEmpty
+        while True:
+            entry = heapq.heappop(self._ready)
+            host = entry[2]
+            if host.ready is entry:
+                break
+        self._unready(host)
+        _, _, queued, request = heapq.heappop(host.queue)
+        self._size -= 1
+        self._priorities[request.priority] -= 1
+        if not self._priorities[request.priority]:
+            del self._priorities[request.priority]
+        if self._queue_wait is not None:
+            self._queue_wait.record(self._loop.time() - queued)
+        self._running[id(request)] = request
+        host.active += 1
+        if self.delay:
+            host.next_time = self._loop.time() + self.delay
+        # back to the tail if it can run one more.
+        self._check_ready(host)
+        self._refill()
+        return request
+
+    async def get(self):
+        '''
+        Remove and return a request of the next ready host.
+        If no host is ready, wait until one is.
+        '''
+        self._refill()
+        while not self._nready or self._global_full():
+            getter = self._loop.create_future()
+            self._getters.append(getter)
+            try:
+                await getter
+            except:
+                getter.cancel()  # Just in case getter is not done yet.
+                try:
+                    self._getters.remove(getter)
+                except ValueError:
+                    pass
+                if self._nready and not self._global_full() and not getter.cancelled():
+                    self._wakeup_next(self._getters)
+                raise
+        return self.get_nowait()
+
+    def task_done(self, request):
+        '''
+        Tell the scheduler request got by `get` is finished,
+        so its host can run another one.
+        '''
+        if self._unfinished <= 0:
+            raise ValueError('task_done() called too many times')
+        host = self._hosts.get(host_of(request.url))
+        if host is not None and host.active > 0:
+            host.active -= 1
+            self._running.pop(id(request), None)
+            self._check_ready(host)
+            self._forget(host)
+        if self._nready and not self._global_full():
+            self._wakeup_next(self._getters)
+        self._unfinished -= 1
+        if self._unfinished == 0:
+            for joiner in self._joiners:
+                if not joiner.done():
+                    joiner.set_result(None)
+            self._joiners = []
+
+    async def join(self):
+        """Block until all requests have been got and processed."""
+        if self._unfinished > 0:
+            joiner = self._loop.create_future()
+            self._joiners.append(joiner)
+            await joiner
@@ -0,0 +1,282 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+Seen-sets remember which requests have been added to the spider already.
+A plain `set` is fine for small crawls, but it grows with every url and is the
+biggest object in the process of a long crawl. So the spider accepts any object
+implementing `SeenSet`, and three backends are shipped here:
+ 1. MemorySeenSet : exact, fastest, the most memory.
+ 2. BloomSeenSet  : scalable bloom filter, a few bytes per key, false positives
+                    (some new urls are thought as seen) at a configurable rate.
+ 3. SqliteSeenSet : exact, keys are kept on disk, little memory.
+'''
+import hashlib
+import math
+import os
+import sqlite3
+import tempfile
+
+__all__ = ["SeenSet", "MemorySeenSet", "BloomSeenSet", "SqliteSeenSet"]
+
+# max keys in one sqlite query, sqlite's default limit of variables is 999.
+_BATCH = 900
+
+
+def _to_bytes(key):
+    if isinstance(key, str):
+        return key.encode("utf-8")
+    return bytes(key)
+
+
+class SeenSet:
+    '''
+    Interface of seen-set backends.
+    Keys are `str` or `bytes`.
+    '''
+
+    def add(self, key):
+        '''
+        Remember key.
+        :return: True if key wasn't seen before.
+        '''
+        raise NotImplementedError
+
+    def add_many(self, keys):
+        '''
+        Remember all keys, a key repeated in keys is new only the first time.
+        Backends override it when a batch is cheaper than single adds.
+        :return: list of bools, True for keys which weren't seen before.
+        '''
+        return [self.add(key) for key in keys]
+
+    def __contains__(self, key):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def close(self):
+        '''
+        release resources hold by the backend.
+        '''
+        pass
+
+
+class MemorySeenSet(SeenSet):
+    '''
+    The old behaviour, a python set.
+    '''
+
+    def __init__(self):
+        self._keys = set()
+
+    def add(self, key):
+        if key in self._keys:
+            return False
+        self._keys.add(key)
+        return True
+
+    def add_many(self, keys):
+        seen, add = self._keys, self._keys.add
+        result = []
+        for key in keys:
+            if key in seen:
+                result.append(False)
+            else:
+                add(key)
+                result.append(True)
+        return result
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class _BloomFilter:
+    '''
+    A fixed-size bloom filter, `m` bits and `k` hash functions derived from
+    one blake2b digest by double hashing.
+    '''
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.count = 0
+        m = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.m = max(m, 8)
+        self.k = max(int(round(self.m / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.m + 7) // 8)
+
+    def contains(self, h1, h2):
+        bits, m = self.bits, self.m
+        for i in range(self.k):
+            idx = (h1 + i * h2) % m
+            if not bits[idx >> 3] & (1 << (idx & 7)):
+                return False
+        return True
+
+    def add(self, h1, h2):
+        bits, m = self.bits, self.m
+        for i in range(self.k):
+            idx = (h1 + i * h2) % m
+            bits[idx >> 3] |= 1 << (idx & 7)
+        self.count += 1
+
+
+class BloomSeenSet(SeenSet):
+    '''
+    Scalable bloom filter.
+    When the current filter is full, a new one `growth` times larger is added
+    whose error rate is `tightening` times the previous one, so the overall
+    false positive rate stays under `error_rate` however many keys are added.
+    '''
+
+    def __init__(self, error_rate=0.001, initial_capacity=100000, growth=2, tightening=0.5):
+        if not 0 < error_rate < 1:
+            raise ValueError("error_rate must be between 0 and 1")
+        if initial_capacity <= 0:
+            raise ValueError("initial_capacity must be positive")
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening = tightening
+        self._filters = []
+        self._count = 0
+        self._grow(initial_capacity, error_rate * (1 - tightening))
+
+    def _grow(self, capacity, error_rate):
+        self._filters.append(_BloomFilter(capacity, error_rate))
+
+    @staticmethod
+    def _hash(key):
+        digest = hashlib.blake2b(_to_bytes(key), digest_size=16).digest()
+        return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+
+    def _contains(self, h1, h2):
+        for f in reversed(self._filters):
+            if f.contains(h1, h2):
+                return True
+        return False
+
+    def add(self, key):
+        h1, h2 = self._hash(key)
+        if self._contains(h1, h2):
+            return False
+        current = self._filters[-1]
+        if current.count >= current.capacity:
+            self._grow(current.capacity * self.growth,
+                       self._error_rate_of(len(self._filters)))
+            current = self._filters[-1]
+        current.add(h1, h2)
+        self._count += 1
+        return True
+
+    def _error_rate_of(self, n):
+        return self.error_rate * (1 - self.tightening) * (self.tightening ** n)
+
+    def __contains__(self, key):
+        return self._contains(*self._hash(key))
+
+    def __len__(self):
+        # approximate: keys which collided with a false positive are not counted.
+        return self._count
+
+    @property
+    def nbytes(self):
+        '''
+        memory hold by the bit arrays.
+        '''
+        return sum(len(f.bits) for f in self._filters)
+
+
+class SqliteSeenSet(SeenSet):
+    '''
+    Exact seen-set stored in a sqlite database.
+    Only sqlite's page cache is kept in memory.
+    Commits are batched every `commit_every` new keys, so a crash may forget
+    the last few keys, which only causes a few duplicated requests.
+    If no path is given, a temporary file is used and removed on `close`.
+    '''
+
+    def __init__(self, path=None, commit_every=1000, cache_size_kb=8192):
+        self._remove_on_close = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="aiospider-seen-", suffix=".sqlite")
+            os.close(fd)
+        self.path = path
+        self.commit_every = commit_every
+        self._db = sqlite3.connect(path, isolation_level="DEFERRED")
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute("PRAGMA cache_size=-{:d}".format(cache_size_kb))
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS seen (key BLOB PRIMARY KEY) WITHOUT ROWID")
+        self._uncommitted = 0
+        self._count = self._db.execute("SELECT COUNT(*) FROM seen").fetchone()[0]
+
+    def add(self, key):
+        cur = self._db.execute(
+            "INSERT OR IGNORE INTO seen (key) VALUES (?)", (_to_bytes(key),))
+        if cur.rowcount <= 0:
+            return False
+        self._count += 1
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self._db.commit()
+            self._uncommitted = 0
+        return True
+
+    def add_many(self, keys):
+        '''
+        one query finds the keys already stored (by parts of `_BATCH`), one executemany inserts the others.
+        '''
+        keys = [_to_bytes(key) for key in keys]
+        unique = list(dict.fromkeys(keys))
+        stored = set()
+        for i in range(0, len(unique), _BATCH):
+            part = unique[i:i + _BATCH]
+            stored.update(row[0] for row in self._db.execute(
+                "SELECT key FROM seen WHERE key IN ({})".format(",".join("?" * len(part))), part))
+        new = [key for key in unique if key not in stored]
+        self._db.executemany("INSERT OR IGNORE INTO seen (key) VALUES (?)", ((key,) for key in new))
+        self._count += len(new)
+        self._uncommitted += len(new)
+        if self._uncommitted >= self.commit_every:
+            self._db.commit()
+            self._uncommitted = 0
+        new = set(new)
+        result = []
+        for key in keys:
+            result.append(key in new)
+            new.discard(key)
+        return result
+
+    def __getstate__(self):
+        # pickled by path, for checkpoints.
+        self._db.commit()
+        return {"path": self.path, "commit_every": self.commit_every}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["commit_every"])
+        self._remove_on_close = False
+
+    def __contains__(self, key):
+        return self._db.execute(
+            "SELECT 1 FROM seen WHERE key = ?", (_to_bytes(key),)).fetchone() is not None
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        if self._db is None:
+            return
+        self._db.commit()
+        self._db.close()
+        self._db = None
+        if self._remove_on_close:
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.remove(self.path + suffix)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,311 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+Sharded crawl over several processes.
+One spider runs on one loop, so one core. ShardedSpider starts `shards`
+processes, each with its own loop and `Spider`, and gives each one the hosts
+whose hash falls in its shard: politeness, the seen-set and the frontier of a
+host all stay in one process.
+A request found by a shard for a host of another shard is sent to it. Requests
+are pickled like spilled ones (callbacks by name) and sent in batches of
+`batch_size`, or every `flush_interval` seconds, through one multiprocessing
+queue per shard.
+The crawl is over when every shard is idle and all the requests sent have
+been received, twice in a row with the same counts. Then shards are stopped,
+run their `after_spider` functions and send their metrics back, which are
+merged in `metrics`.
+
+Shards can't share objects with the parent: callbacks, parsers and
+`on_item` functions are set up in each shard by `setup(spider, shard)`, a
+module level function. Paths in config may contain `{shard}`, e.g.
+`"frontier_path": "crawl-{shard}.sqlite"`.
+
+    def setup(spider, shard):
+        spider.register_callback(parse)
+
+    ShardedSpider(shards=4, setup=setup, config={"concurrent": 50}).start(urls, parse)
+'''
+import asyncio
+import multiprocessing
+import os
+import queue
+import threading
+import zlib
+
+from .spider import Spider
+from .scheduler import host_of
+from .metrics import Metrics
+from .log import logging, get_logger
+
+__all__ = ["ShardedSpider", "shard_of"]
+
+
+def shard_of(url, shards):
+    '''
+    shard of url's host, the same in every process (unlike `hash`).
+    '''
+    return zlib.crc32(host_of(url).encode("utf-8")) % shards
+
+
+class _ShardSpider(Spider):
+    '''
+    A spider of one shard: requests of other shards are sent to them, and it
+    runs until the parent stops it instead of until its queue is empty.
+    '''
+
+    def __init__(self, shard, shards, inboxes, control, batch_size, flush_interval, **kwargs):
+        super().__init__(**kwargs)
+        # the same logger as a plain spider, the process name tells the shard.
+        self.logger = get_logger("Spider")
+        self.shard = shard
+        self.shards = shards
+        self._inboxes = inboxes
+        self._control = control
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._outbox = [[] for _ in range(shards)]
+        self._sent = 0
+        self._received = 0
+        self._stopped = asyncio.Event()
+
+    def _enqueue(self, request):
+        shard = shard_of(request.url, self.shards)
+        if shard == self.shard:
+            super()._enqueue(request)
+        else:
+            self._route(shard, request)
+
+    def _enqueue_many(self, requests):
+        local = []
+        for request in requests:
+            shard = shard_of(request.url, self.shards)
+            if shard == self.shard:
+                local.append(request)
+            else:
+                self._route(shard, request)
+        if local:
+            super()._enqueue_many(local)
+
+    def _route(self, shard, request):
+        try:
+            self._outbox[shard].append(self._dump_request(request))
+        except ValueError as e:
+            self.log(logging.WARNING, "Request [%s] `%s` can't be sent to shard %d: %s",
+                     request.method, request.url, shard, e)
+            return
+        if len(self._outbox[shard]) >= self._batch_size:
+            self._flush(shard)
+
+    def _flush(self, shard):
+        batch = self._outbox[shard]
+        if batch:
+            self._outbox[shard] = []
+            self._inboxes[shard].put(batch)
+            self._sent += len(batch)
+            self.metrics.inc("shard_sent", len(batch))
+
+    def _receive(self, batch):
+        self._received += len(batch)
+        self.metrics.inc("shard_received", len(batch))
+        # the seen-set of this shard decides, like for local requests.
+        super()._enqueue_many([self._load_request(data) for data in batch])
+
+    def _read_inbox(self):
+        # in a thread, the loop is woken up by each batch.
+        while True:
+            batch = self._inboxes[self.shard].get()
+            try:
+                if batch is None:
+                    self.loop.call_soon_threadsafe(self._stopped.set)
+                    return
+                self.loop.call_soon_threadsafe(self._receive, batch)
+            except RuntimeError:
+                # the loop is closed, the shard finished on its own.
+                return
+
+    def _idle(self):
+        return not self.pending.qsize() and not self.pending.running() and not self.download_pending.qsize()
+
+    async def _join(self):
+        threading.Thread(target=self._read_inbox, daemon=True).start()
+        while not self._stopped.is_set():
+            for shard in range(self.shards):
+                self._flush(shard)
+            self._control.put(("status", self.shard, self._idle(), self._sent, self._received))
+            try:
+                await asyncio.wait_for(self._stopped.wait(), self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+def _run_shard(shard, shards, inboxes, control, setup, config, urls, callbacks, batch_size, flush_interval):
+    '''
+    main function of a shard process.
+    '''
+    config = {key: value.format(shard=shard) if isinstance(value, str) and "{shard}" in value else value
+              for key, value in config.items()}
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    # a stuck parent must not keep a finished shard alive.
+    for inbox in inboxes:
+        inbox.cancel_join_thread()
+    metrics, stats = None, None
+    try:
+        with _ShardSpider(shard, shards, inboxes, control, batch_size, flush_interval, config=config) as ss:
+            if setup is not None:
+                setup(ss, shard)
+            ss.start(urls, callbacks)
+            metrics, stats = ss.metrics, ss.stats()
+    finally:
+        control.put(("done", shard, metrics, stats))
+
+
+class ShardedSpider:
+    '''
+    Runs a crawl in `shards` processes, see the module's doc.
+    '''
+
+    def __init__(self, shards=None, setup=None, config=None, batch_size=256, flush_interval=0.05):
+        '''
+        :param shards: number of processes, the number of cpus if None.
+        :param setup: `setup(spider, shard)` called in each shard before it starts.
+        :param config: config of the spiders, see `Spider.default_config`.
+        :param batch_size: requests sent to another shard at once.
+        :param flush_interval: max seconds a request waits to be sent to another shard.
+        '''
+        self.shards = shards or os.cpu_count() or 1
+        self.setup = setup
+        self.config = dict(config or {})
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.before_start_funcs = []
+        self.after_crawl_funcs = []
+        self.will_continue = True
+        # merged metrics of all shards, and the last `stats()` of each shard.
+        self.metrics = Metrics()
+        self.shard_stats = [None] * self.shards
+        self.running = False
+        self.logger = get_logger(self.__class__.__name__)
+
+    def log(self, lvl, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(lvl):
+            self.logger.log(lvl, msg, *args, **kwargs)
+
+    def before_start(self, func):
+        '''
+        add function called with the ShardedSpider before shards start, in this process.
+        '''
+        self.before_start_funcs.append(func)
+        return func
+
+    def after_spider(self, func):
+        '''
+        add function called with the ShardedSpider after all shards finished, in this process.
+        '''
+        self.after_crawl_funcs.append(func)
+        return func
+
+    def stats(self):
+        return {
+            "shards": self.shards,
+            "visited": sum(stats["visited"] for stats in self.shard_stats if stats),
+            "metrics": self.metrics.snapshot(),
+            "per_shard": self.shard_stats,
+        }
+
+    def _partition(self, urls, callbacks):
+        if isinstance(urls, str):
+            urls = [urls]
+        if isinstance(callbacks, (list, tuple)):
+            pairs = zip(urls, list(callbacks) + [None] * (len(urls) - len(callbacks)))
+        else:
+            pairs = ((url, callbacks) for url in urls)
+        parts = [([], []) for _ in range(self.shards)]
+        for url, callback in pairs:
+            part = parts[shard_of(url, self.shards)]
+            part[0].append(url)
+            part[1].append(callback)
+        return parts
+
+    def start(self, urls, callbacks):
+        if self.running:
+            self.log(logging.WARNING, "Spider is running now.")
+            return
+        self.running = True
+        for func in self.before_start_funcs:
+            func(self)
+        if self.will_continue:
+            self._run(self._partition(urls, callbacks))
+        else:
+            self.log(logging.WARNING, "Spider canceled by the last `before_start_function`.")
+        self.running = False
+        for func in self.after_crawl_funcs:
+            func(self)
+        self.log(logging.INFO, "Spider shutdown.")
+
+    def _run(self, parts):
+        inboxes = [multiprocessing.Queue() for _ in range(self.shards)]
+        control = multiprocessing.Queue()
+        processes = [multiprocessing.Process(
+            target=_run_shard, name="aiospider-shard-{}".format(shard),
+            args=(shard, self.shards, inboxes, control, self.setup, self.config, urls, callbacks,
+                  self.batch_size, self.flush_interval))
+            for shard, (urls, callbacks) in enumerate(parts)]
+        for process in processes:
+            process.start()
+        self.log(logging.INFO, "%d shards started.", self.shards)
+        try:
+            self._wait(processes, inboxes, control)
+        finally:
+            for process in processes:
+                process.join(5)
+                if process.is_alive():
+                    process.terminate()
+
+    def _wait(self, processes, inboxes, control):
+        reports = {}
+        fresh = set()
+        last = None
+        stopping = False
+        done = set()
+        while len(done) < self.shards:
+            try:
+                message = control.get(timeout=1)
+            except queue.Empty:
+                dead = [shard for shard, process in enumerate(processes)
+                        if shard not in done and not process.is_alive()]
+                if dead:
+                    self.log(logging.ERROR, "Shards %s exited without finishing.", dead)
+                    done.update(dead)
+                    if not stopping:
+                        stopping = self._stop(inboxes)
+                continue
+            if message[0] == "done":
+                _, shard, metrics, stats = message
+                done.add(shard)
+                if metrics is not None:
+                    self.metrics.merge(metrics)
+                self.shard_stats[shard] = stats
+                if not stopping:
+                    # finished on its own (crawl_timeout, an error), the others stop too.
+                    stopping = self._stop(inboxes)
+                continue
+            _, shard, idle, sent, received = message
+            reports[shard] = (idle, sent, received)
+            fresh.add(shard)
+            if stopping or len(fresh) < self.shards:
+                continue
+            # every shard reported since the last check.
+            state = tuple(reports[shard] for shard in range(self.shards))
+            fresh.clear()
+            if all(idle for idle, _, _ in state) and \
+                    sum(sent for _, sent, _ in state) == sum(received for _, _, received in state) \
+                    and state == last:
+                self.log(logging.INFO, "All shards are idle, stopping them.")
+                stopping = self._stop(inboxes)
+            last = state
+
+    def _stop(self, inboxes):
+        for inbox in inboxes:
+            inbox.put(None)
+        return True
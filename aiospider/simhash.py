@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+Near-duplicate pages.
+The seen-set only knows urls, but one article is often served under many:
+session ids, print views, mirrors. A SimHash is a 64 bits fingerprint of the
+text of a page, where similar texts differ by a few bits only. Each shingle
+(3 words in a row) is hashed, and bit i of the SimHash is set if it is set in
+more than half of the shingle hashes.
+`SimHashIndex` finds a SimHash within `distance` bits of one added before
+without comparing them all: the 64 bits are cut in `distance + 1` bands, two
+SimHashes differing by at most `distance` bits have at least one band equal,
+so only the ones sharing a band with the query are compared.
+'''
+import hashlib
+import re
+from collections import Counter
+
+__all__ = ["text_of", "simhash", "hamming", "SimHashIndex"]
+
+_SKIP = re.compile(r"<(script|style|noscript)\b.*?</\1\s*>|<!--.*?-->", re.I | re.S)
+_TAG = re.compile(r"<[^>]*>")
+_WORD = re.compile(r"\w+")
+# bits set in each byte value
+_BITS = [[bit for bit in range(8) if value >> bit & 1] for value in range(256)]
+
+
+def text_of(html):
+    '''
+    the words of an html page, without tags, scripts, styles and comments.
+    '''
+    return _TAG.sub(" ", _SKIP.sub(" ", html))
+
+
+def simhash(text, shingle=3, min_words=0):
+    '''
+    :param shingle: words per feature.
+    :return: a 64 bits int, None if text has less than `min_words` words.
+    '''
+    words = _WORD.findall(text.lower())
+    if not words or len(words) < min_words:
+        return None
+    if len(words) <= shingle:
+        features = [" ".join(words)]
+    else:
+        features = [" ".join(words[i:i + shingle]) for i in range(len(words) - shingle + 1)]
+    digests = b"".join(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest() for feature in features)
+    # bits are counted by byte value: one Counter per byte of the digests instead of 64 steps per feature.
+    weights = [0] * 64
+    for i in range(8):
+        for value, count in Counter(digests[i::8]).items():
+            for bit in _BITS[value]:
+                weights[i * 8 + bit] += count
+    half = len(features) / 2
+    h = 0
+    for pos, weight in enumerate(weights):
+        if weight > half:
+            h |= 1 << pos
+    return h
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class SimHashIndex:
+
+    def __init__(self, distance=3):
+        '''
+        :param distance: max different bits of near duplicates, queries get slower as it grows
+            (bands get shorter and match more often), keep it under 10.
+        '''
+        if not 0 <= distance < 64:
+            raise ValueError("distance must be between 0 and 63")
+        self.distance = distance
+        bands = distance + 1
+        bounds = [64 * i // bands for i in range(bands + 1)]
+        # (shift, mask) of each band
+        self._bands = [(start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])]
+        self._tables = [{} for _ in self._bands]
+        self._count = 0
+
+    def query(self, h):
+        '''
+        :return: the key of a SimHash within `distance` bits of h, None if there is none.
+        '''
+        for table, (shift, mask) in zip(self._tables, self._bands):
+            for other, key in table.get(h >> shift & mask, ()):
+                if hamming(h, other) <= self.distance:
+                    return key
+        return None
+
+    def add(self, h, key):
+        for table, (shift, mask) in zip(self._tables, self._bands):
+            table.setdefault(h >> shift & mask, []).append((h, key))
+        self._count += 1
+
+    def check(self, h, key):
+        '''
+        add h unless it is a near duplicate.
+        :return: the key of the near duplicate, None if h was added.
+        '''
+        found = self.query(h)
+        if found is None:
+            self.add(h, key)
+        return found
+
+    def __len__(self):
+        return self._count
@@ -4,26 +4,105 @@
 main part
 '''
 import asyncio
+import contextlib
+import contextvars
+import inspect
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import sys
 from itertools import zip_longest
-from collections import namedtuple
-import traceback
+import pickle
 
 import aiohttp
 
-from .taskqueue import TaskQueue, makeTask
-from .log import logging
+from .taskqueue import TaskQueue, Budget, makeTask
+from .seen import SeenSet, MemorySeenSet
+from .scheduler import HostScheduler, host_of
+from .adaptive import AIMDController
+from .frontier import DiskFrontier
+from .httpcache import HttpCache
+from .archive import Archive, NotInArchive
+from .castore import ContentStore
+from .simhash import SimHashIndex, simhash, text_of
+from .download import FileWriter, save_response, download_resume, download_parallel
+from .metrics import Metrics, monitor_loop_lag
+from .retry import RetryPolicy, HostBreakers
+from .backend import FrontierBackend, RedisError
+from .pipeline import ItemPipeline
+from .response import Response, ResponseTooLarge
+from .request import DEFAULT_HEADER, Request, _Request, fingerprint
+from .log import logging, get_logger
 
-DEFAULT_HEADER = {'user-agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.87 Safari/537.36',
-                  'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8'
-                  }
-_Request = namedtuple(
-    "Request", ["method", "url", "header", "data", "callback"])
 
+# the request whose callback is running, requests it adds are one level deeper.
+_parent = contextvars.ContextVar("aiospider_parent", default=None)
 
-def Request(method, url, header=DEFAULT_HEADER, data=None, callback=None):
-    return _Request(method, url, header, data, callback)
+
+def _run_parser(parser, url, body, encoding):
+    '''
+    Run in the parse executor. Results are collected into a list, since a generator can't be sent back.
+    '''
+    return list(parser(url, body, encoding) or ())
+
+
+class _DownloadSession:
+    '''
+    The session as range downloads see it: their requests are sent with the options and the download
+    timeout of request, and counted in the metrics, the breakers and the controller of spider.
+    '''
+
+    def __init__(self, spider, request):
+        self.spider = spider
+        self.request = request
+
+    def get(self, url, **kwargs):
+        return self._request("GET", url, kwargs)
+
+    def head(self, url, **kwargs):
+        return self._request("HEAD", url, kwargs)
+
+    @contextlib.asynccontextmanager
+    async def _request(self, method, url, kwargs):
+        spider = self.spider
+        options = spider._request_options(self.request, kwargs.pop("headers", None), spider._download_timeout)
+        options.update(kwargs)
+        start, responded = spider.loop.time(), False
+        spider.metrics.inc("requests")
+        try:
+            async with spider.session.request(method, url, **options) as resp:
+                responded = True
+                spider._responded(self.request, resp, spider.loop.time() - start)
+                yield resp
+        except Exception:
+            if not responded:
+                spider._failed(self.request, spider.loop.time() - start)
+            raise
+
+
+def make_session(config=None, resolver=None, metrics=None, loop=None):
+    '''
+    A session with the connection pool and timeouts of config (see `Spider.default_config`), as spiders make
+    their own. Pass it to several spiders by `session` to share one pool, and close it after them.
+    :param metrics: a `Metrics` whose trace config times dns, connect and time to first byte.
+    '''
+    config = dict(Spider.default_config, **(config or {}))
+    keepalive = config["keepalive_timeout"]
+    connector = aiohttp.TCPConnector(limit=config["connection_limit"],
+                                     limit_per_host=config["connection_limit_per_host"],
+                                     use_dns_cache=config["dns_cache_ttl"] != 0,
+                                     ttl_dns_cache=config["dns_cache_ttl"] or None,
+                                     keepalive_timeout=keepalive if keepalive else None,
+                                     force_close=not keepalive,
+                                     resolver=resolver, loop=loop)
+    # the default is the downloads' one, requests have their own total limit.
+    options = {"connector": connector,
+               "timeout": aiohttp.ClientTimeout(total=None, connect=config["connect_timeout"],
+                                                sock_read=config["read_timeout"])}
+    trace = metrics.trace_config() if metrics is not None else None
+    if trace is not None:
+        options["trace_configs"] = [trace]
+    return aiohttp.ClientSession(loop=loop, **options)
 
 
 class Spider:
@@ -42,14 +121,109 @@ class Spider:
         "concurrent": 5,
         # How many download requests can be run in parallel
         "download_concurrent": 5,
-        # How long to wait after each request
+        # How many requests to one host can be run in parallel, 0 for no limit
+        "concurrent_per_host": 0,
+        # How long to wait after each request (to one host)
         "delay": 0,
         # A stream to where internal logs are sent, optional
         "logs": sys.stdout,
         # Re - visit visited URLs, false by default
         "allowDuplicates": False,
-        #
-        "chunk_size": 1024,
+        # Size of the first chunk read by downloads, it grows up to `max_chunk_size`
+        # while the connection is fast enough to fill whole chunks.
+        "chunk_size": 64 * 1024,
+        "max_chunk_size": 1024 * 1024,
+        # Max bytes of a response body, larger responses are ignored. 0 for no limit.
+        "max_body_size": 0,
+        # Bodies larger than this are kept in a temporary file instead of memory.
+        "spool_size": 1024 * 1024,
+        # How many chunks can wait for the writer thread, downloads wait when more.
+        "writer_buffers": 64,
+        # "single": one request per download.
+        # "resume": continue partial files left by interrupted downloads.
+        # "parallel": files over `parallel_min_size` bytes are downloaded in `download_parts` ranges at the same time.
+        "download_mode": "single",
+        "download_parts": 4,
+        "parallel_min_size": 8 * 1024 * 1024,
+        # Take `/a/` and `/a` as the same page when checking duplicates.
+        "strip_trailing_slash": True,
+        # Budgets of the crawl, requests over them are dropped when added: requests deeper than `max_depth`
+        # links from a start url (None for no limit), requests of a host after `max_pages_per_host`
+        # (0 for no limit), and every request once `max_bytes` bytes were received (0 for no limit).
+        "max_depth": None,
+        "max_pages_per_host": 0,
+        "max_bytes": 0,
+        # An html page whose text is within `near_duplicate_distance` bits (of its 64 bits SimHash) of a page
+        # fetched before is a near duplicate (session ids, print views, mirrors...): its callback isn't called,
+        # so its links aren't followed either. None to not check, 0 for the same text only.
+        # Pages of less than `near_duplicate_min_words` words are not checked.
+        "near_duplicate_distance": None,
+        "near_duplicate_min_words": 50,
+        # Change the limit of parallel requests with latency and error rate.
+        # `concurrent` is the limit at start then.
+        "adaptive": False,
+        "adaptive_min_concurrent": 1,
+        "adaptive_max_concurrent": 50,
+        # Seconds, if None, twice the lowest latency seen.
+        "target_latency": None,
+        # How many waiting requests are kept in memory, the others are spilled to disk. 0 for no limit.
+        "max_pending_in_memory": 0,
+        # Where spilled requests and checkpoints are saved, a temporary file if None.
+        "frontier_path": None,
+        # Seconds between two checkpoints, 0 for checkpoints only when spider exits.
+        # Checkpoints need `frontier_path`.
+        "checkpoint_interval": 0,
+        # Where parsers registered by `register_parser` run: "thread" or "process" pool.
+        "parse_executor": "thread",
+        # Workers of the parse executor, the number of cpus if None.
+        "parse_workers": None,
+        # Seconds between two progress lines logged, 0 for none.
+        "progress_interval": 0,
+        # Seconds between two checks of the loop's lag, 0 to not check it.
+        "loop_lag_interval": 0.1,
+        # Where metrics are written at each progress line and at the end, optional.
+        # "prometheus" text (for node_exporter's textfile collector) or "json".
+        "metrics_path": None,
+        "metrics_format": "prometheus",
+        # Every request is logged at DEBUG, and one in `log_sample` at INFO, 0 for none.
+        # See `progress_interval` for a summary instead.
+        "log_sample": 0,
+        # "record": responses are saved in `archive_path`.
+        # "replay": responses are read from `archive_path` instead of the network, downloads are skipped.
+        "archive_mode": None,
+        "archive_path": None,
+        # Seconds a request may take (body included), to connect, and to wait for each read. None for no limit.
+        # Downloads only have the last two limits.
+        "timeout": 60,
+        "connect_timeout": 10,
+        "read_timeout": 30,
+        # Seconds the whole crawl may take, 0 for no limit. What remains is saved if `frontier_path` is set.
+        "crawl_timeout": 0,
+        # Requests failed by a network error or answered with a status of `retry_statuses` are tried again
+        # up to `max_retries` times, after `retry_backoff` seconds doubled at each retry (with jitter),
+        # at most `retry_max_backoff`. Pass a `RetryPolicy` by `retry_policy` to choose exceptions too.
+        "max_retries": 3,
+        "retry_backoff": 0.5,
+        "retry_max_backoff": 60,
+        "retry_statuses": (408, 429, 500, 502, 503, 504),
+        # A host failing `breaker_failures` times in a row is paused for `breaker_reset` seconds,
+        # twice as long each time it fails again. 0 to never pause.
+        "breaker_failures": 5,
+        "breaker_reset": 30,
+        # A host still failing after `breaker_max_opens` pauses is down, its requests are ignored. 0 for never.
+        "breaker_max_opens": 3,
+        # Connection pool of the session made by spider: max open connections (0 for no limit), max
+        # connections to one host (0 for no limit), seconds DNS answers are cached (None for ever,
+        # 0 for no cache) and seconds an idle connection is kept open (0 to close it after each request).
+        # A resolver (e.g. `aiohttp.AsyncResolver()`, shared by spiders) can be passed by `resolver`.
+        "connection_limit": 100,
+        "connection_limit_per_host": 0,
+        "dns_cache_ttl": 10,
+        "keepalive_timeout": 15,
+        # With a `frontier_backend`, requests found are pushed to it every `backend_interval` seconds, and
+        # requests are leased from it `backend_batch` at a time while less than `backend_batch` wait here.
+        "backend_batch": 100,
+        "backend_interval": 0.05,
     }
 
     def __init__(self, **kwargs):
@@ -68,9 +242,47 @@ class Spider:
         Providing a session is convenient when you spider some that you need to login, you can just pass a logged-in session.
         Of course, you can provide a function which will be call before all spider requests to log in.
         '''
+        '''
+        Counters and timings of the crawl, see `stats`. dns, connect and time to first byte are
+        timed by a TraceConfig, which only a session made by spider has.
+        Add `spider.metrics.trace_config()` to the `trace_configs` of your own session to get them.
+        '''
+        self.metrics = kwargs.get("metrics", None)
+        if self.metrics is None or not isinstance(self.metrics, Metrics):
+            self.metrics = Metrics()
+        self._timeout = aiohttp.ClientTimeout(total=self.config["timeout"], connect=self.config["connect_timeout"],
+                                              sock_read=self.config["read_timeout"])
+        # downloads have no total limit, it would cut large files.
+        self._download_timeout = aiohttp.ClientTimeout(total=None, connect=self.config["connect_timeout"],
+                                                       sock_read=self.config["read_timeout"])
         self.session = kwargs.get("session", None)
-        if self.session is None or not isinstance(self.session, aiohttp.ClientSession):
-            self.session = aiohttp.ClientSession(loop=self.loop)
+        # a session passed is closed by its owner, except by `__exit__` which closes the loop too.
+        self._own_session = self.session is None or not isinstance(self.session, aiohttp.ClientSession)
+        if self._own_session:
+            self.session = make_session(self.config, kwargs.get("resolver", None), self.metrics, self.loop)
+        '''
+        A `Budget` passed by `budget` limits the requests sent at once by all the spiders sharing it.
+        '''
+        self.budget = kwargs.get("budget", None)
+        if self.budget is not None and not isinstance(self.budget, Budget):
+            self.budget = None
+        '''
+        When and how soon failed requests are tried again, and which hosts are paused because they keep failing.
+        '''
+        self.retry_policy = kwargs.get("retry_policy", None)
+        if self.retry_policy is None or not isinstance(self.retry_policy, RetryPolicy):
+            self.retry_policy = RetryPolicy(max_retries=self.config["max_retries"],
+                                            backoff=self.config["retry_backoff"],
+                                            max_backoff=self.config["retry_max_backoff"],
+                                            statuses=self.config["retry_statuses"])
+        self.breakers = HostBreakers(failure_threshold=self.config["breaker_failures"],
+                                     reset_timeout=self.config["breaker_reset"],
+                                     max_opens=self.config["breaker_max_opens"])
+        # retries done of the requests being retried, by fingerprint.
+        self._retries = {}
+        # requests added of each host, for `max_pages_per_host`.
+        self._host_pages = {}
+        self._bytes_exhausted = False
 
         '''
          The methods contained here will be called before any requests.
@@ -84,22 +296,107 @@ class Spider:
          For example,if spider need to logout, you may need provide logout method.
         '''
         self.after_crawl_funcs = []
+        '''
+         Callbacks by name. Requests spilled to disk or saved in checkpoints refer to their callback by name.
+         Callbacks are registered with their `__qualname__` when needed, but after a restart, the ones not
+         passed to `start` must be registered again with `register_callback`.
+        '''
+        self.callbacks = {}
+        self._callback_names = {}
+        '''
+         Parsers are callbacks run in the parse executor, see `register_parser`.
+         Things they return are passed to the methods contained in `item_funcs`, except requests which are added.
+        '''
+        self.parsers = set()
+        self.parse_executor = None
+        self.item_funcs = []
         '''
         spider's logger
         '''
-        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger = get_logger(self.__class__.__name__)
 
         '''
         The reasons that only sipder's download_pending uses TaskQueue are:
-         1. TaskQueue is still not stable.
-         2. When there are too many request waited to send, it has to keep many contexts for each waiting request
-            including the method request_with_callback. So the request queue still use asyncio.Queue.
+         1. TaskQueue runs any task, but requests are all the same task.
+         2. The request queue is a scheduler of plain requests, which keeps one queue per host
+            so that a slow host can't hold all workers.
         '''
-        self.pending = asyncio.Queue()
+        self.controller = None
+        if self.config["adaptive"]:
+            self.controller = AIMDController(initial=self.config["concurrent"],
+                                             minimum=self.config["adaptive_min_concurrent"],
+                                             maximum=self.config["adaptive_max_concurrent"],
+                                             target_latency=self.config["target_latency"])
+        self.frontier = None
+        if self.config["max_pending_in_memory"] or self.config["frontier_path"]:
+            self.frontier = DiskFrontier(self.config["frontier_path"],
+                                         dumps=self._dump_request, loads=self._load_request)
+        self.pending = HostScheduler(concurrent_per_host=self.config["concurrent_per_host"],
+                                     delay=self.config["delay"], controller=self.controller,
+                                     spill=self.frontier, max_memory=self.config["max_pending_in_memory"],
+                                     metrics=self.metrics, loop=self.loop)
         # downloading concurrent should not be too large.
         self.download_pending = TaskQueue(
-            maxsize=self.config["download_concurrent"])
-        self.visited = set()
+            maxsize=self.config["download_concurrent"], metrics=self.metrics)
+        # downloads are written to disk by a thread.
+        self.writer = FileWriter(max_buffers=self.config["writer_buffers"], loop=self.loop)
+        '''
+        Fingerprints of requests which have been added. Any `SeenSet` can be passed by `seen`,
+        for example a `BloomSeenSet` for a very large crawl.
+        '''
+        self.visited = kwargs.get("seen", None)
+        if self.visited is None or not isinstance(self.visited, SeenSet):
+            self.visited = MemorySeenSet()
+        self.metrics.gauge("pending", self.pending.qsize)
+        self.metrics.gauge("in_flight", self.pending.running)
+        self.metrics.gauge("downloading", self.download_pending.qsize)
+        self.metrics.gauge("visited", lambda: len(self.visited))
+        self.metrics.gauge("concurrency", lambda: self.controller.limit if self.controller is not None
+                           else self.config["concurrent"])
+        self.metrics.gauge("bytes_written", lambda: self.writer.written)
+        '''
+        A `FrontierBackend` passed by `frontier_backend` is shared with the spiders of other processes or
+        machines: requests found are pushed to it and the ones to send are leased from it, see backend.py.
+        '''
+        self.frontier_backend = kwargs.get("frontier_backend", None)
+        if self.frontier_backend is not None and not isinstance(self.frontier_backend, FrontierBackend):
+            self.frontier_backend = None
+        # (fingerprint, data) of requests to push, datas of leased requests done, and leased datas by fingerprint.
+        self._outgoing = []
+        self._acks = []
+        self._leases = {}
+        self.metrics.gauge("leased", lambda: len(self._leases))
+        '''
+        An `HttpCache` passed by `http_cache` is used for GET requests: fresh responses are not requested
+        again, and stale ones are revalidated with their ETag or Last-Modified.
+        '''
+        self.http_cache = kwargs.get("http_cache", None)
+        if self.http_cache is not None and not isinstance(self.http_cache, HttpCache):
+            self.http_cache = None
+        '''
+        A `ContentStore` passed by `store` keeps each downloaded content once and links the downloaded
+        files to it, urls downloaded before are only linked, see castore.py.
+        '''
+        self.store = kwargs.get("store", None)
+        if self.store is not None and not isinstance(self.store, ContentStore):
+            self.store = None
+        '''
+        An `ItemPipeline` passed by `pipeline` gets every item after `item_funcs`: processed, and written
+        to its sinks in batches by a thread, see pipeline.py. Callbacks wait when it falls behind.
+        '''
+        self.pipeline = kwargs.get("pipeline", None)
+        if self.pipeline is not None and not isinstance(self.pipeline, ItemPipeline):
+            self.pipeline = None
+        if self.pipeline is not None:
+            self.metrics.gauge("items_pending", self.pipeline.pending)
+        # SimHashes of the pages fetched, see `near_duplicate_distance`.
+        self.near_duplicates = None
+        if self.config["near_duplicate_distance"] is not None:
+            self.near_duplicates = SimHashIndex(self.config["near_duplicate_distance"])
+        self.archive = None
+        if self.config["archive_mode"] in ("record", "replay"):
+            self.archive = Archive(self.config["archive_path"],
+                                   "w" if self.config["archive_mode"] == "record" else "r")
         # you cannot call method `start` twice.
         self.running = False
         # active tasks
@@ -109,53 +406,497 @@ class Spider:
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._cancel()
         if not self.session.closed:
+            # the loop is closed below, a session passed couldn't be used any more.
             self.loop.run_until_complete(self.session.close())
+        self.loop.run_until_complete(self.close(interrupted=exc_type is not None))
         if not self.loop.is_closed():
             self.loop.stop()
             self.loop.run_forever()
             self.loop.close()
 
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close(interrupted=exc_type is not None)
+
+    async def close(self, interrupted=False):
+        '''
+        Release what spider holds, the loop is left as it is. A session or a budget passed is not closed,
+        the other objects passed (seen-set, frontier backend, cache, store, pipeline) are.
+        Threads are joined in an executor, so a running loop isn't blocked meanwhile.
+        :param interrupted: save a checkpoint in `frontier_path` to resume later.
+        '''
+        if interrupted and self.config["frontier_path"]:
+            self.checkpoint()
+        await self._stop_tasks()
+        if self._own_session and not self.session.closed:
+            await self.session.close()
+        self.visited.close()
+        if self.frontier_backend is not None:
+            await self.frontier_backend.close()
+        if self.http_cache is not None:
+            self.http_cache.close()
+        if self.archive is not None:
+            self.archive.close()
+        if self.store is not None:
+            self.store.close()
+        if self.pipeline is not None:
+            await self.pipeline.close()
+        if self.parse_executor is not None:
+            await self.loop.run_in_executor(None, self.parse_executor.shutdown, True)
+        await self.loop.run_in_executor(None, self.writer.close)
+        if self.frontier is not None:
+            self.frontier.close()
+
     def _cancel(self):
         for task in self.active:
             task.cancel()
 
-    def log(self, lvl, msg):
-        self.logger.log(lvl, msg)
+    async def _stop_tasks(self):
+        self._cancel()
+        if self.active:
+            await asyncio.gather(*self.active, return_exceptions=True)
+        self.active = []
+        await self.download_pending.cancel()
+
+    def log(self, lvl, msg, *args, **kwargs):
+        '''
+        msg is formatted with args (`%` style) only if lvl is enabled.
+        kwargs are passed to the logger, e.g. `exc_info=True`.
+        '''
+        if self.logger.isEnabledFor(lvl):
+            self.logger.log(lvl, msg, *args, **kwargs)
+
+    def register_callback(self, func, name=None):
+        '''
+        Register callback by name, so that requests using it can be saved on disk,
+        and `add_request` can take the name instead of the function.
+        It can be used as a decorator.
+        :param name: `func.__qualname__` by default
+        '''
+        name = name or func.__qualname__
+        self.callbacks[name] = func
+        self._callback_names[func] = name
+        return func
+
+    def register_parser(self, func, name=None):
+        '''
+        Register a parser: a callback which doesn't get the response, but is called as
+        `func(url, body, encoding)` in the parse executor, so that heavy parsing uses other threads
+        or processes and doesn't block the loop.
+        It returns (or yields) requests made by `Request`, which are added to the spider, and items,
+        which are passed to `item_funcs` and to `pipeline`, like the results of other callbacks.
+        With a process pool, func must be a module level function, and the callbacks of requests
+        returned should be names of registered callbacks.
+        It can be used as a decorator.
+        '''
+        self.register_callback(func, name)
+        self.parsers.add(func)
+        return func
+
+    def on_item(self, func):
+        '''
+        add function called with every item returned or yielded by callbacks and parsers.
+        '''
+        self.item_funcs.append(func)
+        return func
+
+    def _get_parse_executor(self):
+        if self.parse_executor is None:
+            if self.config["parse_executor"] == "process":
+                self.parse_executor = ProcessPoolExecutor(max_workers=self.config["parse_workers"])
+            else:
+                self.parse_executor = ThreadPoolExecutor(max_workers=self.config["parse_workers"])
+        return self.parse_executor
+
+    async def _parse(self, parser, response):
+        '''
+        parse the body in the parse executor.
+        '''
+        start = self.loop.time()
+        results = await self.loop.run_in_executor(
+            self._get_parse_executor(), _run_parser, parser, str(response.url), response.body,
+            response.encoding)
+        self.metrics.observe("parse", self.loop.time() - start)
+        await self._handle_results(results)
+
+    async def _handle_results(self, results):
+        '''
+        results of a callback: an iterable, an async iterable (an async generator callback) or one request
+        or item.
+        '''
+        if hasattr(results, "__aiter__"):
+            async for result in results:
+                await self._handle_result(result)
+            return
+        if isinstance(results, (_Request, dict, str, bytes)) or not hasattr(results, "__iter__"):
+            results = (results,)
+        for result in results:
+            await self._handle_result(result)
+
+    async def _handle_result(self, result):
+        if isinstance(result, _Request):
+            self._enqueue(result)
+            return
+        self.metrics.inc("items")
+        for func in self.item_funcs:
+            if asyncio.iscoroutinefunction(func):
+                await func(result)
+            else:
+                func(result)
+        if self.pipeline is not None:
+            # waits while the sinks are behind, so does the worker.
+            await self.pipeline.put(result)
+
+    def _callback_name(self, callback):
+        if isinstance(callback, str):
+            return callback
+        name = self._callback_names.get(callback)
+        if name is None:
+            name = getattr(callback, "__qualname__", None)
+            if name is None or self.callbacks.setdefault(name, callback) != callback:
+                raise ValueError(
+                    "Callback {!r} can't be referred by name, register it first.".format(callback))
+            self._callback_names[callback] = name
+        return name
+
+    def _dump_request(self, request):
+        '''
+        request -> bytes, callback is saved by name.
+        '''
+        request = request._replace(callback=self._callback_name(request.callback),
+                                   header=None if request.header is DEFAULT_HEADER else request.header)
+        try:
+            return pickle.dumps(tuple(request), pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            raise ValueError(str(e))
+
+    def _load_request(self, data):
+        request = _Request(*pickle.loads(data))
+        if request.header is None:
+            request = request._replace(header=DEFAULT_HEADER)
+        return request
+
+    def checkpoint(self):
+        '''
+        Save waiting and running requests and the seen-set in `frontier_path`.
+        Download tasks are not saved.
+        :return: number of requests saved.
+        '''
+        if self.frontier is None:
+            self.log(logging.WARNING, "No `frontier_path` set, checkpoint is ignored.")
+            return 0
+        num = self.frontier.save_checkpoint(self.pending.requests(), {"visited": self.visited})
+        self.log(logging.INFO, "Checkpoint saved with {num} requests in memory, {spilled} on disk.".format(
+            num=num, spilled=len(self.frontier)))
+        return num
+
+    def resume(self):
+        '''
+        Restore requests and the seen-set from the last checkpoint in `frontier_path`.
+        :return: number of requests restored.
+        '''
+        if self.frontier is None or not self.frontier.has_checkpoint():
+            return 0
+        requests, meta = self.frontier.load_checkpoint()
+        if isinstance(meta.get("visited", None), SeenSet):
+            self.visited.close()
+            self.visited = meta["visited"]
+        for request in requests:
+            self.pending.put_nowait(request)
+        # old rows are replaced at once.
+        self.checkpoint()
+        self.log(logging.INFO, "Resume with {num} requests.".format(num=len(requests)))
+        return len(requests)
+
+    async def _checkpoint_periodically(self):
+        try:
+            while True:
+                await asyncio.sleep(self.config["checkpoint_interval"])
+                self.checkpoint()
+        except asyncio.CancelledError:
+            pass
+
+    def stats(self):
+        '''
+        A snapshot of the spider's state.
+        '''
+        return {
+            "pending": self.pending.qsize(),
+            "hosts": self.pending.depths(),
+            "active": self.pending.active(),
+            "concurrency": self.controller.snapshot() if self.controller is not None
+            else {"limit": self.config["concurrent"]},
+            "visited": len(self.visited),
+            "downloading": self.download_pending.qsize(),
+            "metrics": self.metrics.snapshot(),
+        }
+
+    def write_metrics(self, path=None):
+        '''
+        Write metrics to path(`metrics_path` by default) in `metrics_format`.
+        The file is replaced at once, so a reader never sees half of it.
+        '''
+        path = path or self.config["metrics_path"]
+        if not path:
+            return
+        if self.config["metrics_format"] == "json":
+            text = self.metrics.to_json()
+        else:
+            text = self.metrics.to_prometheus()
+        with open(path + ".tmp", "w") as fd:
+            fd.write(text)
+        os.replace(path + ".tmp", path)
+
+    def _progress(self, last, interval):
+        responses = self.metrics.counter("responses").value
+        ttfb = self.metrics.histogram("ttfb")
+        lag = self.metrics.histogram("loop_lag")
+        self.log(logging.INFO, "Progress: {responses} responses ({rate:.1f}/s), {pending} pending, "
+                               "{running} in flight, {downloading} downloading, {mb:.1f} MB received, "
+                               "ttfb p50 {ttfb:.1f}ms, loop lag p99 {lag:.1f}ms.".format(
+                                   responses=responses, rate=(responses - last) / interval,
+                                   pending=self.pending.qsize(), running=self.pending.running(),
+                                   downloading=self.download_pending.qsize(),
+                                   mb=(self.metrics.counter("bytes_downloaded").value
+                                       + self.writer.written) / 1048576.0,
+                                   ttfb=ttfb.percentile(0.5) * 1000, lag=lag.percentile(0.99) * 1000))
+        return responses
+
+    async def _report_progress(self):
+        interval = self.config["progress_interval"]
+        last = 0
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                last = self._progress(last, interval)
+                self.write_metrics()
+        except asyncio.CancelledError:
+            pass
 
     def add_request(self, url, callback, method="GET", **kwargs):
         '''
         Add request wo queue.
         :param url: request's url
-        :param callback: which will be called after request finished.
+        :param callback: which will be called after request finished, or its registered name.
         :param method: request's method
-        :param kwargs: additional parameters for request
+        :param kwargs: additional parameters for request: priority (higher first), depth (one more than
+            the request whose callback adds it by default), header (or headers), data, and the ones
+            of `ClientSession.request` such as proxy, timeout, compress, params or json.
         :return: None
         '''
-        if url in self.visited:
+        self._enqueue(Request(method, url, callback=callback, **kwargs))
+
+    def _with_depth(self, request):
+        if request.depth is not None:
+            return request
+        parent = _parent.get()
+        return request._replace(depth=(parent.depth or 0) + 1 if parent is not None else 0)
+
+    def _bytes_received(self):
+        return self.metrics.counter("bytes_downloaded").value + self.writer.written
+
+    def _over_bytes(self):
+        if not self.config["max_bytes"] or self._bytes_received() < self.config["max_bytes"]:
+            return False
+        if not self._bytes_exhausted:
+            self._bytes_exhausted = True
+            self.log(logging.WARNING, "%d bytes received, the requests left are dropped.", self._bytes_received())
+        self.metrics.inc("over_max_bytes")
+        return True
+
+    def _in_budget(self, request):
+        '''
+        whether request is within `max_depth` and `max_bytes`.
+        '''
+        max_depth = self.config["max_depth"]
+        if max_depth is not None and request.depth > max_depth:
+            self.metrics.inc("over_max_depth")
+            return False
+        return not self._over_bytes()
+
+    def _in_host_budget(self, request):
+        '''
+        count request against `max_pages_per_host`, only new requests are counted.
+        '''
+        limit = self.config["max_pages_per_host"]
+        if not limit:
+            return True
+        host = host_of(request.url)
+        pages = self._host_pages.get(host, 0)
+        if pages >= limit:
+            self.metrics.inc("over_max_pages_per_host")
+            return False
+        self._host_pages[host] = pages + 1
+        return True
+
+    def _bad_request(self, request, e):
+        self.metrics.inc("bad_requests")
+        self.log(logging.WARNING, "Request [%s] `%s` is malformed: %s %s, Request is ignored.",
+                 request.method, request.url, type(e).__name__, e)
+
+    def _fingerprint(self, request):
+        '''
+        fingerprint of request, kept in it by `_enqueue`. That one computes it anew each time, so
+        a request made from another by `_replace` doesn't keep the other's.
+        '''
+        if request.fingerprint is not None:
+            return request.fingerprint
+        return fingerprint(request, self.config["strip_trailing_slash"])
+
+    def _enqueue(self, request):
+        request = self._with_depth(request)
+        if not self._in_budget(request):
             return
+        key = None
+        if not self.config["allowDuplicates"]:
+            try:
+                key = fingerprint(request, self.config["strip_trailing_slash"])
+            except (ValueError, TypeError, AttributeError) as e:
+                self._bad_request(request, e)
+                return
+            if key is not None:
+                # `add` tells whether the fingerprint is new, one lookup only.
+                if not self.visited.add(key):
+                    self.metrics.inc("duplicates")
+                    return
+                request = request._replace(fingerprint=key)
+        if not self._in_host_budget(request):
+            return
+        self.metrics.inc("enqueued")
+        if self.frontier_backend is not None:
+            self._push_backend(request, key)
+        else:
+            self.pending.put_nowait(request)
+        self.log(logging.DEBUG, "Add url: %s to queue.", request.url)
+
+    def _enqueue_many(self, requests):
+        '''
+        like `_enqueue`, the whole batch is checked against the seen-set at once.
+        '''
+        requests = [request for request in map(self._with_depth, requests) if self._in_budget(request)]
+        keys = [None] * len(requests)
         if not self.config["allowDuplicates"]:
-            self.visited.add(url)
-        request = Request(method, url, callback=callback)
-        self.pending.put_nowait(request)
-        self.log(logging.INFO, "Add url: {} to queue.".format(url))
+            strip = self.config["strip_trailing_slash"]
+            # one by one, a malformed request doesn't lose the others.
+            kept, keys = [], []
+            for request in requests:
+                try:
+                    key = fingerprint(request, strip)
+                except (ValueError, TypeError, AttributeError) as e:
+                    self._bad_request(request, e)
+                    continue
+                keys.append(key)
+                kept.append(request._replace(fingerprint=key) if key is not None else request)
+            requests = kept
+            # requests without a fingerprint are always new.
+            found = iter(self.visited.add_many([key for key in keys if key is not None]))
+            new = [key is None or next(found) for key in keys]
+            requests, keys = [request for request, is_new in zip(requests, new) if is_new], \
+                [key for key, is_new in zip(keys, new) if is_new]
+            self.metrics.inc("duplicates", len(new) - len(requests))
+        if self.config["max_pages_per_host"]:
+            kept = [self._in_host_budget(request) for request in requests]
+            requests = [request for request, ok in zip(requests, kept) if ok]
+            keys = [key for key, ok in zip(keys, kept) if ok]
+        self.metrics.inc("enqueued", len(requests))
+        if self.frontier_backend is not None:
+            for request, key in zip(requests, keys):
+                self._push_backend(request, key)
+        else:
+            for request in requests:
+                self.pending.put_nowait(request)
+        self.log(logging.DEBUG, "Add %d urls to queue.", len(requests))
+
+    def _push_backend(self, request, key):
+        '''
+        request is pushed to the backend at the next sync, the seen-set of this spider only saves a round trip.
+        '''
+        try:
+            self._outgoing.append((key, self._dump_request(request)))
+        except ValueError as e:
+            self.log(logging.WARNING, "Request [%s] `%s` can't be pushed to the frontier backend: %s",
+                     request.method, request.url, e)
+
+    async def _sync_backend(self):
+        '''
+        push requests found, then acknowledge the ones done (so a request done is never lost with the
+        requests it found), and lease requests if few wait here.
+        :return: number of requests leased.
+        '''
+        backend, batch = self.frontier_backend, self.config["backend_batch"]
+        while self._outgoing:
+            items = self._outgoing[:batch]
+            added = await backend.push(items)
+            del self._outgoing[:len(items)]
+            self.metrics.inc("backend_pushed", added)
+            self.metrics.inc("backend_duplicates", len(items) - added)
+        if self._acks:
+            datas = self._acks[:]
+            await backend.ack(datas)
+            del self._acks[:len(datas)]
+        want = batch - self.pending.qsize()
+        if want <= 0:
+            return 0
+        datas = await backend.lease(want)
+        for data in datas:
+            request = self._load_request(data)
+            key = self._fingerprint(request)
+            if key is not None:
+                self._leases[key] = data
+            self.pending.put_nowait(request)
+        self.metrics.inc("backend_leased", len(datas))
+        return len(datas)
+
+    def _ack_backend(self, request):
+        key = self._fingerprint(request)
+        data = self._leases.pop(key, None) if key is not None else None
+        if data is not None:
+            self._acks.append(data)
 
-    def add_requests(self, urls, callbacks):
+    async def _join_backend(self):
+        '''
+        sync with the backend until nobody has anything left: a request in flight anywhere is leased.
+        '''
+        interval = self.config["backend_interval"]
+        while True:
+            try:
+                leased = await self._sync_backend()
+                if not leased and not self._outgoing and not self._acks and not self.pending.qsize() \
+                        and not self.pending.running() and await self.frontier_backend.done():
+                    return
+            except (OSError, asyncio.IncompleteReadError, RedisError) as e:
+                # a connection lost, or an error reply (out of memory, a read-only replica...).
+                self.metrics.inc("backend_errors")
+                self.log(logging.WARNING, "Frontier backend failed: %s %s, trying again in %.1fs.",
+                         type(e).__name__, e, max(interval, 1))
+                await asyncio.sleep(max(interval, 1))
+                continue
+            if not leased:
+                await asyncio.sleep(interval)
+
+    def add_requests(self, urls, callbacks, priority=0):
         '''
         add many targets and callback once.
         if targets are more than callbacks, None will be used to fillup.
         if targets are less than callbacks, callbacks will be cut.
+        With one callback (not in a list), all urls use it, and they are added in one batch,
+        e.g. the links found by a `LinkExtractor`.
+        :param priority: of all the requests, higher first.
         '''
-        if isinstance(urls, (list, tuple)) and isinstance(callbacks, (list, tuple)):
+        if isinstance(urls, (list, tuple)) and (callable(callbacks) or isinstance(callbacks, str)):
+            self._enqueue_many([Request("GET", url, callback=callbacks, priority=priority) for url in urls])
+        elif isinstance(urls, (list, tuple)) and isinstance(callbacks, (list, tuple)):
             if len(urls) >= len(callbacks):
                 pass
             else:
                 callbacks = callbacks[:len(urls)]
             for url, callback in zip_longest(urls, callbacks):
-                self.add_request(url, callback)
+                self.add_request(url, callback, priority=priority)
         elif isinstance(urls, str):
-            self.add_request(urls, callbacks)
+            self.add_request(urls, callbacks, priority=priority)
 
     def before_start(self, func):
         '''
@@ -194,101 +935,495 @@ class Spider:
         try:
             while True:
                 request = await self.pending.get()
-                self.log(logging.INFO,
-                         "Loading url: {} from queue.".format(request.url))
-                await self.request_with_callback(request, request.callback)
-                self.pending.task_done()
+                self.log(logging.DEBUG, "Loading url: %s from queue.", request.url)
+                try:
+                    if self.budget is not None:
+                        async with self.budget:
+                            done = await self.request_with_callback(request, request.callback)
+                    else:
+                        done = await self.request_with_callback(request, request.callback)
+                finally:
+                    self.pending.task_done(request)
+                if self.frontier_backend is not None and done is not False:
+                    self._ack_backend(request)
         except asyncio.CancelledError:
             pass
 
-    async def request_with_callback(self, request: _Request, callback=None):
+    def _responded(self, request, resp, latency):
+        self.metrics.inc("responses")
+        self.metrics.inc("status_{}xx".format(resp.status // 100))
+        host = host_of(request.url)
+        if self.controller is not None:
+            self.controller.record(host, latency, resp.status)
+        if resp.status in self.breakers.statuses:
+            self._host_failed(host)
+        else:
+            self.breakers.success(host)
+
+    def _failed(self, request, latency):
+        # no response at all.
+        host = host_of(request.url)
+        if self.controller is not None:
+            self.controller.record(host, latency, error=True)
+        self._host_failed(host)
+
+    def _host_failed(self, host):
+        if host in self.breakers.dead:
+            return
+        pause = self.breakers.failure(host)
+        if host in self.breakers.dead:
+            self.metrics.inc("hosts_down")
+            self.log(logging.WARNING, "Host %s is down, its requests are ignored.", host)
+        elif pause:
+            self.metrics.inc("hosts_paused")
+            self.pending.pause(host, self.loop.time() + pause)
+            self.log(logging.WARNING, "Host %s keeps failing, it is paused for %.1fs.", host, pause)
+
+    def _request_options(self, request: _Request, headers=None, timeout=None):
+        '''
+        keyword arguments of `session.request` for request.
+        :param headers: added to the request's header.
+        :param timeout: the default timeout, `timeout` config by default.
+        '''
+        header = request.header
+        if headers:
+            header = dict(header or (), **headers)
+        options = {"headers": header, "timeout": timeout or self._timeout}
+        if request.data is not None:
+            options["data"] = request.data
+        if request.kwargs:
+            options.update(request.kwargs)
+            if isinstance(options["timeout"], (int, float)):
+                options["timeout"] = aiohttp.ClientTimeout(total=options["timeout"],
+                                                           connect=self.config["connect_timeout"],
+                                                           sock_read=self.config["read_timeout"])
+        return options
+
+    async def fetch(self, request: _Request):
+        '''
+        Send request and read its body, or read the response from the archive when replaying.
+        :return: a `Response`, which is still valid after the connection is released.
+        '''
+        if self.config["archive_mode"] == "replay":
+            return self.archive.read(self._fingerprint(request), request)
+        response = await self._fetch(request)
+        key = self._fingerprint(request) if self.archive is not None else None
+        if key is not None:
+            self.archive.write(key, response)
+        return response
+
+    async def _fetch(self, request: _Request):
+        key = entry = headers = None
+        if self.http_cache is not None and request.method == "GET":
+            key = self._fingerprint(request)
+            entry = self.http_cache.get(key) if key is not None else None
+            if entry is not None:
+                if self.http_cache.fresh(entry):
+                    self.metrics.inc("cache_hits")
+                    self.http_cache.used(key)
+                    return self.http_cache.response(entry, request)
+                headers = self.http_cache.conditional_headers(entry)
+        start, responded = self.loop.time(), False
+        self.metrics.inc("requests")
+        try:
+            async with self.session.request(request.method, request.url,
+                                            **self._request_options(request, headers)) as resp:
+                responded = True
+                received = self.loop.time()
+                self._responded(request, resp, received - start)
+                if entry is not None and resp.status == 304:
+                    self.metrics.inc("cache_revalidated")
+                    self.http_cache.revalidated(key, resp.headers)
+                    return self.http_cache.response(entry, request)
+                response = await Response.read_from(resp, request, self.config["max_body_size"],
+                                                    self.config["spool_size"], self.config["chunk_size"])
+                self.metrics.observe("body", self.loop.time() - received)
+                self.metrics.inc("bytes_downloaded", response.size)
+                if key is not None:
+                    self.http_cache.put(key, response)
+                return response
+        except Exception:
+            if not responded:
+                self._failed(request, self.loop.time() - start)
+            raise
+
+    async def _fetch_raw(self, request: _Request, callback, retries=0):
+        '''
+        Send request and await callback with aiohttp's response before the connection
+        is released, for downloads which stream the body themselves.
+        :return: the response if it is to be retried instead, else None.
+        '''
+        start, responded = self.loop.time(), False
+        self.metrics.inc("requests")
+        try:
+            async with self.session.request(request.method, request.url,
+                                            **self._request_options(request, timeout=self._download_timeout)) as resp:
+                responded = True
+                self._responded(request, resp, self.loop.time() - start)
+                if self.retry_policy.retry_status(resp.status, retries):
+                    return resp
+                await callback(resp)
+        except Exception:
+            if not responded:
+                self._failed(request, self.loop.time() - start)
+            raise
+
+    async def dispatch(self, callback, response):
+        '''
+        call callback with response: in the parse executor for parsers, awaited for
+        coroutine functions, called directly for the others.
+        What callbacks yield is handled like parsers' results, and what they return too if items
+        are taken (`on_item` functions or a pipeline are set). If not, only requests returned are
+        added, anything else a callback returns is left alone, as before callbacks had items.
+        '''
+        if callback in self.parsers:
+            await self._parse(callback, response)
+            return
+        if asyncio.iscoroutinefunction(callback):
+            results = await callback(response)
+        else:
+            results = callback(response)
+        if results is None:
+            return
+        if self.item_funcs or self.pipeline is not None or inspect.isgenerator(results) \
+                or inspect.isasyncgen(results):
+            await self._handle_results(results)
+        elif isinstance(results, _Request) or isinstance(results, (list, tuple)) \
+                and all(isinstance(result, _Request) for result in results):
+            await self._handle_results(results)
+
+    def _retry_key(self, request):
+        key = self._fingerprint(request)
+        # a request without a fingerprint is put back as it is, the same object is retried.
+        return key if key is not None else id(request)
+
+    def _retries_of(self, request):
+        if not self._retries:
+            return 0
+        return self._retries.get(self._retry_key(request), 0)
+
+    def _retry_later(self, request, callback, raw, retries, headers=None, task=None):
+        '''
+        put request back to be tried again after the policy's delay, the worker doesn't wait for it.
+        :param task: the download task to run again instead, for range downloads.
+        '''
+        delay = self.retry_policy.delay(retries, headers)
+        self._retries[self._retry_key(request)] = retries + 1
+        self.metrics.inc("retries")
+        self.log(logging.DEBUG, "Request [%s] `%s` is tried again in %.1fs.(retry %d)",
+                 request.method, request.url, delay, retries + 1)
+        if task is not None:
+            self.download_pending.add_task_later(task, delay)
+        elif raw:
+            self.download_pending.add_task_later(
+                makeTask(self.request_with_callback, request, callback, raw=True), delay)
+        else:
+            self.pending.put_later(request, delay)
+
+    def _near_duplicate(self, request, response):
+        '''
+        whether response is an html page near a page fetched before, it is remembered if not.
+        '''
+        if response.status != 200 or response.content_type not in ("text/html", "application/xhtml+xml"):
+            return False
+        h = simhash(text_of(response.unicode_body), min_words=self.config["near_duplicate_min_words"])
+        if h is None:
+            return False
+        original = self.near_duplicates.check(h, request.url)
+        if original is None:
+            return False
+        self.metrics.inc("near_duplicates")
+        self.log(logging.DEBUG, "Request [%s] `%s` is a near duplicate of `%s`, its callback is skipped.",
+                 request.method, request.url, original)
+        return True
+
+    async def request_with_callback(self, request: _Request, callback=None, raw=False):
+        '''
+        :param raw: callback gets aiohttp's response, see `_fetch_raw`.
+        A request failed by a network error or answered with a retried status is put back
+        according to `retry_policy`, the callback is only called with its last response.
+        :return: False if request was put back to be tried again.
+        '''
         if not callback:
             callback = request.callback
-        if callable(callback):
-            try:
-                async with self.session.request(request.method, request.url) as resp:
-                    '''
-                    if callback is a coroutine-function, the await is necessary.
-                    if not, call_soon_threadsafe is better.
-                    But why not coroutine ?
-                    '''
-                    if asyncio.iscoroutinefunction(callback):
-                        await callback(resp)
-                    else:
-                        self.loop.call_soon_threadsafe(callback, resp)
-                    self.log(logging.INFO, "Request [{method}] `{url}` finishend.(There are still {num})".format(
-                        method=request.method, url=request.url, num=self.pending.qsize()))
-            except Exception as e:
-                self.log(logging.ERROR, "Error happened in request [{method}] `{url}`, Request is ignored.\n{error}".format(
-                    error=traceback.format_exc(), url=request.url, method=request.method))
-        else:
-            self.log(logging.WARNING, "Callback for request [{method}] `{url}` is not callable. Request is ignored.".format(
-                url=request.url, method=request.method))
+        if isinstance(callback, str):
+            callback = self.callbacks.get(callback, None)
+        if not callable(callback):
+            self.log(logging.WARNING, "Callback for request [%s] `%s` is not callable. Request is ignored.",
+                     request.method, request.url)
+            return
+        if self.breakers.dead and host_of(request.url) in self.breakers.dead:
+            self.metrics.inc("host_down_skipped")
+            self.log(logging.DEBUG, "Host of request [%s] `%s` is down, Request is ignored.",
+                     request.method, request.url)
+            return
+        if self.config["max_bytes"] and self._over_bytes():
+            return
+        # replayed responses don't change.
+        can_retry = self.config["archive_mode"] != "replay"
+        retries = self._retries_of(request)
+        retried = False
+        try:
+            if raw:
+                resp = await self._fetch_raw(request, callback, retries)
+                if resp is not None:
+                    self._retry_later(request, callback, raw, retries, resp.headers)
+                    retried = True
+                    return False
+            else:
+                response = await self.fetch(request)
+                if can_retry and self.retry_policy.retry_status(response.status, retries):
+                    response.close()
+                    self._retry_later(request, callback, raw, retries, response.headers)
+                    retried = True
+                    return False
+                if self.near_duplicates is not None and self._near_duplicate(request, response):
+                    response.close()
+                    return
+                start = self.loop.time()
+                parent = _parent.set(request)
+                try:
+                    await self.dispatch(callback, response)
+                except Exception:
+                    self.metrics.inc("errors")
+                    self.log(logging.ERROR, "Error happened in the callback of request [%s] `%s`.",
+                             request.method, request.url, exc_info=True)
+                    return
+                finally:
+                    _parent.reset(parent)
+                    # a spooled body's temporary file is removed now, not when it is collected.
+                    if not response.kept:
+                        response.close()
+                self.metrics.observe("callback", self.loop.time() - start)
+            sample = self.config["log_sample"]
+            lvl = logging.INFO if sample and self.metrics.counter("responses").value % sample == 0 \
+                else logging.DEBUG
+            self.log(lvl, "Request [%s] `%s` finished.(There are still %d)",
+                     request.method, request.url, self.pending.qsize())
+        except NotInArchive:
+            self.metrics.inc("not_in_archive")
+            self.log(logging.WARNING, "Request [%s] `%s` is not in the archive, Request is ignored.",
+                     request.method, request.url)
+        except ResponseTooLarge as e:
+            self.metrics.inc("too_large")
+            self.log(logging.WARNING, "%s Request is ignored.", e)
+        except Exception as e:
+            if can_retry and self.retry_policy.retry_exception(e, retries):
+                self._retry_later(request, callback, raw, retries)
+                retried = True
+                return False
+            self.metrics.inc("errors")
+            if isinstance(e, self.retry_policy.exceptions):
+                # expected: a host down, a timeout, a connection reset... one line is enough.
+                self.log(logging.WARNING, "Request [%s] `%s` failed after %d retries: %s %s, Request is ignored.",
+                         request.method, request.url, retries, type(e).__name__, e)
+            else:
+                self.log(logging.ERROR, "Error happened in request [%s] `%s`, Request is ignored.",
+                         request.method, request.url, exc_info=True)
+        finally:
+            if retries and not retried:
+                self._retries.pop(self._retry_key(request), None)
 
     async def download(self, src, dst):
         '''
-        async def save(resp, dst=dst):
-            with open(dst, "wb") as fd:
-                while True:
-                    chunk = await resp.content.read()
-                    if not chunk:
-                        break
-                    fd.write(chunk)
-            self.log(logging.INFO, "Target `{src}` download to {dst}".format(src=resp.url, dst=dst))
-        '''
-        #self.log(logging.INFO, "Add download task : {src}".format(src=src))
-        # await self.download_pending.put(makeTask(self.request_with_callback,
-        # Request("GET", src, callback=save)))
-        """
-        Unfortunately, TaskQueue doesn't work well when there too many download tasks.
-        So raw request may be better.
-        """
-        self.add_download(src, dst)
-        # await self.request_with_callback(Request("GET", src, callback=save))
+        add download task, wait if `download_concurrent` downloads are running or waiting.
+        '''
+        if self.config["archive_mode"] == "replay" or self._over_bytes() or self._link_stored(src, dst):
+            return
+        self.log(logging.DEBUG, "Add download task : %s", src)
+        await self.download_pending.put(self._download_task(src, dst))
 
     def add_download(self, src, dst):
         '''
         add download task in  a synchronous way.
+        It waits in the backlog of download_pending if too many downloads are running.
         '''
+        if self.config["archive_mode"] == "replay" or self._over_bytes() or self._link_stored(src, dst):
+            return
+        self.log(logging.DEBUG, "Add download task : %s", src)
+        self.download_pending.add_task(self._download_task(src, dst))
+
+    def _link_stored(self, src, dst):
+        '''
+        link dst to the content of src in the store, if src was downloaded before.
+        '''
+        if self.store is None:
+            return False
+        size = self.store.link(src, dst)
+        if size is None:
+            return False
+        self.metrics.inc("store_hits")
+        self.metrics.inc("store_bytes_skipped", size)
+        self.log(logging.DEBUG, "Target `%s` is in the store, linked to %s", src, dst)
+        return True
+
+    def _add_to_store(self, src, tmp, digest, dst):
+        size, new = self.store.add(src, tmp, digest, dst)
+        if not new:
+            self.metrics.inc("store_duplicates")
+            self.metrics.inc("store_bytes_deduplicated", size)
+            self.log(logging.DEBUG, "Target `%s` has the content of another download.", src)
+
+    def _download_task(self, src, dst):
         async def save(resp, dst=dst):
-            with open(dst, "wb") as fd:
-                while True:
-                    chunk = await resp.content.read(self.config["chunk_size"])
-                    if not chunk:
-                        break
-                    fd.write(chunk)
-            self.log(logging.INFO, "Target `{src}` download to {dst}".format(
-                src=resp.url, dst=dst))
-        self.log(logging.INFO, "Add download task : {src}".format(src=src))
-        self.download_pending.add_task(
-            makeTask(self.request_with_callback, Request("GET", src, callback=save)))
+            if not 200 <= resp.status < 300:
+                # still failing after its retries: an error page isn't the file, nor stored for src.
+                self.metrics.inc("download_errors")
+                self.log(logging.WARNING, "Download `%s` failed: status %d, Download is ignored.",
+                         src, resp.status)
+                return
+            if self.store is None:
+                await save_response(resp, dst, self.writer,
+                                    self.config["chunk_size"], self.config["max_chunk_size"])
+            else:
+                hasher, tmp = self.store.hasher(), self.store.tmp_path(src, dst)
+                await save_response(resp, tmp, self.writer,
+                                    self.config["chunk_size"], self.config["max_chunk_size"], hasher)
+                self._add_to_store(src, tmp, hasher.hexdigest(), dst)
+            self.metrics.inc("downloads")
+            self.log(logging.DEBUG, "Target `%s` download to %s", resp.url, dst)
+        if self.config["download_mode"] in ("resume", "parallel"):
+            return makeTask(self.download_ranged, src, dst)
+        return makeTask(self.request_with_callback, Request("GET", src, callback=save), raw=True)
+
+    async def download_ranged(self, src, dst):
+        '''
+        download with `Range` requests, according to `download_mode`. Failures are retried like
+        requests, a resumed download continues from what it got before.
+        '''
+        request = Request("GET", src)
+        if self.breakers.dead and host_of(src) in self.breakers.dead:
+            self.metrics.inc("host_down_skipped")
+            self.log(logging.DEBUG, "Host of download `%s` is down, Download is ignored.", src)
+            return
+        if self.config["max_bytes"] and self._over_bytes():
+            return
+        retries = self._retries_of(request)
+        retried = False
+        session = _DownloadSession(self, request)
+        # parts are written out of order, a stored file is hashed once complete.
+        target = dst if self.store is None else self.store.tmp_path(src, dst)
+        try:
+            if self.config["download_mode"] == "parallel":
+                await download_parallel(session, src, target, self.writer,
+                                        parts=self.config["download_parts"],
+                                        min_size=self.config["parallel_min_size"],
+                                        chunk_size=self.config["chunk_size"],
+                                        max_chunk_size=self.config["max_chunk_size"])
+            else:
+                await download_resume(session, src, target, self.writer,
+                                      chunk_size=self.config["chunk_size"],
+                                      max_chunk_size=self.config["max_chunk_size"])
+            if self.store is not None:
+                digest = await self.loop.run_in_executor(None, self.store.hash_file, target)
+                self._add_to_store(src, target, digest, dst)
+            self.metrics.inc("downloads")
+            self.log(logging.DEBUG, "Target `%s` download to %s", src, dst)
+        except Exception as e:
+            if isinstance(e, aiohttp.ClientResponseError):
+                # raised for the status, retried like a response of that status.
+                retry = self.retry_policy.retry_status(e.status, retries)
+            else:
+                retry = self.retry_policy.retry_exception(e, retries)
+            if retry:
+                self._retry_later(request, None, True, retries, getattr(e, "headers", None),
+                                  task=makeTask(self.download_ranged, src, dst))
+                retried = True
+                return
+            self.metrics.inc("download_errors")
+            if isinstance(e, self.retry_policy.exceptions):
+                self.log(logging.WARNING, "Download `%s` failed after %d retries: %s %s, Download is ignored.",
+                         src, retries, type(e).__name__, e)
+            else:
+                self.log(logging.ERROR, "Error happened in download `%s`, Download is ignored.", src,
+                         exc_info=True)
+        finally:
+            if retries and not retried:
+                self._retries.pop(self._retry_key(request), None)
+
+    async def _join(self):
+        if self.frontier_backend is not None:
+            await self._join_backend()
+        await self.pending.join()
+        self.log(logging.INFO, "Requests have finished. Waiting for download task.")
+        await self.download_pending.join()
 
     async def __start(self):
-        for _ in range(self.config["concurrent"]):
+        # with adaptive concurrency, workers over the current limit wait in the scheduler.
+        workers = self.config["adaptive_max_concurrent"] if self.controller is not None \
+            else self.config["concurrent"]
+        if self.pipeline is not None:
+            self.pipeline.start(self.metrics)
+        for _ in range(workers):
             self.active.append(asyncio.ensure_future(
                 self.load(), loop=self.loop))
+        if self.config["checkpoint_interval"] and self.config["frontier_path"]:
+            self.active.append(asyncio.ensure_future(
+                self._checkpoint_periodically(), loop=self.loop))
+        if self.config["loop_lag_interval"]:
+            self.active.append(asyncio.ensure_future(
+                monitor_loop_lag(self.metrics, self.config["loop_lag_interval"]), loop=self.loop))
+        if self.config["progress_interval"]:
+            self.active.append(asyncio.ensure_future(
+                self._report_progress(), loop=self.loop))
         self.log(
             logging.INFO, "Spider has been started. Waiting for all requests and download tasks to finish.")
-        await self.pending.join()
-        self.log(logging.INFO, "Requests have finished. Waiting for download task.")
-        await self.download_pending.join()
+        try:
+            await asyncio.wait_for(self._join(), self.config["crawl_timeout"] or None)
+        except asyncio.TimeoutError:
+            self.metrics.inc("crawl_timeouts")
+            self.log(logging.WARNING, "Crawl timeout after %ss, %d requests and %d download tasks are left.",
+                     self.config["crawl_timeout"], self.pending.qsize() + self.pending.running(),
+                     self.download_pending.qsize())
+            self._cancel()
+            await self.download_pending.cancel()
+        if self.pipeline is not None:
+            await self.pipeline.drain()
+        if self.config["frontier_path"]:
+            # a finished crawl keeps its seen-set, resuming it only visits new requests.
+            self.checkpoint()
+        self.write_metrics()
+        # workers are stopped, so that a spider in a running loop leaves nothing behind.
+        await self._stop_tasks()
 
-    def start(self, urls, callbacks):
+    def start(self, urls, callbacks, resume=False):
+        '''
+        Run the crawl until it is over, in spider's loop, see `crawl`.
+        :param resume: continue the crawl saved in `frontier_path`. The urls are added after
+            the saved requests, the ones visited before are ignored.
+        '''
+        self.loop.run_until_complete(self.crawl(urls, callbacks, resume))
+
+    async def crawl(self, urls, callbacks, resume=False):
+        '''
+        The crawl as a coroutine, for a loop which is already running, e.g. several spiders at once
+        sharing one session and one `Budget`:
+
+            async with Spider(session=session, budget=budget) as ss:
+                await ss.crawl(urls, parse)
+        '''
         if self.running:
-            self.log("Warning", "Spider is running now.")
+            self.log(logging.WARNING, "Spider is running now.")
             return
         self.running = True
 
+        for callback in callbacks if isinstance(callbacks, (list, tuple)) else [callbacks]:
+            try:
+                self._callback_name(callback)
+            except ValueError:
+                pass
+        if resume:
+            self.resume()
         self.add_requests(urls, callbacks)
-        self.loop.run_until_complete(self.try_trigger_before_start_functions())
+        await self.try_trigger_before_start_functions()
         # before_start_functions can change will_continue vaule.
         if self.will_continue:
             self.log(logging.INFO, "Spider Start.")
-            self.loop.run_until_complete(self.__start())
+            await self.__start()
         else:
             self.log(logging.WARN,
                      "Spider canceled by the last `before_start_function`.")
         self.running = False
         self.log(logging.INFO, "All tasks done.Spider starts to shutdown.")
-        self.loop.run_until_complete(self.try_trigger_after_crawl_functions())
+        await self.try_trigger_after_crawl_functions()
         self.log(logging.INFO, "Spider shutdown.")
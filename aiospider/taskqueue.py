@@ -4,87 +4,130 @@
 '''
 Asyncio.Queue's task_done only reduce the number of unfinished tasks.
 This spider need a queue which used to contain running-task.
-It need one method to remove finished tasks.So asyncio.Queue is not suitable.
-The big differrence between asyncio.Queue and TaskQueue is the method `task_done`.
- After one task is finished, TaskQueue will automaticlly romove it from TaskQueue with its uuid.
-But inheritance failed me. So I just copy asyncio.Queue and do some changes.
+TaskQueue runs the tasks put in it with at most `maxsize` workers, the other
+tasks wait in a backlog as plain task tuples. So a waiting task costs one
+tuple, not a parked coroutine and its futures, and finishing a task is only a
+counter decrement.
 '''
 import collections
 import asyncio
-import uuid
-from asyncio import events, locks, QueueFull
+import itertools
+from asyncio import events, QueueFull
 import sys
 import traceback
 
-from .log import logging
+from .log import logging, get_logger
 
 _Task = collections.namedtuple(
-    "Task", ["UUID", "task", "args", "kwargs", "exception_handle"])
+    "Task", ["id", "task", "args", "kwargs", "exception_handle"])
+
+_task_ids = itertools.count()
 
 
 def makeTask(task, *args, **kwargs):
     exception_handle = kwargs.pop("exception_handle", None)
-    return _Task(uuid.uuid4(), task, args, kwargs, exception_handle)
+    return _Task(next(_task_ids), task, args, kwargs, exception_handle)
 
 
 class TaskQueue:
 
-    def __init__(self, maxsize=0, *, loop=None):
+    def __init__(self, maxsize=0, *, metrics=None, loop=None):
+        '''
+        :param maxsize: max running tasks, 0 for no limit.
+        :param metrics: a `Metrics`, optional. How long tasks wait and run is recorded in
+            its `task_wait` and `task_time` histograms.
+        '''
         if loop is None:
             self._loop = events.get_event_loop()
         else:
             self._loop = loop
         self._maxsize = maxsize
 
+        # (enqueue time, task) waiting for a worker.
+        self._backlog = collections.deque()
+        # worker tasks, at most maxsize. They are counted apart, since a
+        # worker leaves the set some time after it has stopped taking tasks.
+        self._workers = set()
+        self._nworkers = 0
+        self._running = 0
+        self._unfinished = 0
+        # call_later handles of tasks added by `add_task_later`, by task id.
+        self._later = {}
         # Futures.
         self._putters = collections.deque()
-        self._finished = locks.Event(loop=self._loop)
-        self._finished.set()
-        self._init(maxsize)
+        self._joiners = []
+        self._task_wait = self._task_time = None
+        if metrics is not None:
+            self._task_wait = metrics.histogram("task_wait")
+            self._task_time = metrics.histogram("task_time")
 
         '''
         TaskQueue's logger
         '''
-        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger = get_logger(self.__class__.__name__)
 
-    def log(self, lvl, msg):
-        self.logger.log(lvl, msg)
-
-    def _init(self, maxsize):
-        self._queue = collections.OrderedDict()
+    def log(self, lvl, msg, *args):
+        '''
+        msg is formatted with args (`%` style) only if lvl is enabled.
+        '''
+        if self.logger.isEnabledFor(lvl):
+            self.logger.log(lvl, msg, *args)
+
+    async def _call(self, task: _Task):
+        try:
+            if asyncio.iscoroutinefunction(task.task):
+                await task.task(*task.args, **task.kwargs)
+            else:
+                task.task(*task.args, **task.kwargs)
+        except Exception as e:
+            if task.exception_handle and callable(task.exception_handle):
+                exc_info = sys.exc_info()
+                self.log(logging.WARN, "Error happened in task {id}, try with exception_handle.".format(
+                    id=task.id))
+                try:
+                    task.exception_handle(e)
+                except:
+                    self.log(logging.ERROR, "Error happened in task {id}, but exception_handle not work.\n{old_error} ".format(
+                        old_error="".join(traceback.format_exception(*exc_info)), id=task.id))
+                finally:
+                    del exc_info  # del is necessary ?
+            else:
+                self.log(logging.ERROR, "Error happened in task {id}, but NO handler set.\n{error}".format(
+                    error=traceback.format_exc(), id=task.id))
+
+    async def _work(self):
+        '''
+        Run tasks of the backlog until it is empty.
+        '''
+        try:
+            while self._backlog:
+                queued, task = self._backlog.popleft()
+                started = self._loop.time()
+                if self._task_wait is not None:
+                    self._task_wait.record(started - queued)
+                self._running += 1
+                try:
+                    await self._call(task)
+                finally:
+                    self._running -= 1
+                    if self._task_time is not None:
+                        self._task_time.record(self._loop.time() - started)
+                    self.log(logging.DEBUG, "There are still %d tasks waiting.", len(self._backlog))
+                    self.task_done()
+        finally:
+            self._nworkers -= 1
 
     def _put(self, task: _Task):
         '''
-        Put task in queue and start the task meanwhile.
-        After the task is finished, `task_done` will be called.
+        Put task in the backlog, and start a worker if there are less than maxsize.
         '''
-        async def _call(UUID=task.UUID):
-            try:
-                if asyncio.iscoroutinefunction(task.task):
-                    await task.task(*task.args, **task.kwargs)
-                else:
-                    task.task(*task.args, **task.kwargs)
-            except Exception as e:
-                if task.exception_handle and callable(task.exception_handle):
-                    exc_info = sys.exc_info()
-                    self.log(logging.WARN, "Error happened in task {uuid}, try with exception_handle.".format(
-                        uuid=task.UUID))
-                    try:
-                        task.exception_handle(e)
-                    except:
-                        self.log(logging.ERROR, "Error happened in task {uuid}, but exception_handle not work.\n{old_error} ".format(
-                            old_error="".join(traceback.format_exception(*exc_info)), uuid=task.UUID))
-                    finally:
-                        del exc_info  # del is necessary ?
-                else:
-                    self.log(logging.ERROR, "Error happened in task {uuid}, but NO handler set.\n{error}".format(
-                        error=traceback.format_exc(), uuid=task.UUID))
-            finally:
-                self.log(logging.INFO,"There are still {num} tasks waiting.".format(num=len(self._putters)))
-                self.task_done(str(UUID))
-
-        self._queue.update(
-            {str(task.UUID): asyncio.ensure_future(_call())})
+        self._backlog.append((self._loop.time(), task))
+        self._unfinished += 1
+        if self._maxsize <= 0 or self._nworkers < self._maxsize:
+            self._nworkers += 1
+            worker = asyncio.ensure_future(self._work(), loop=self._loop)
+            self._workers.add(worker)
+            worker.add_done_callback(self._workers.discard)
 
     def _wakeup_next(self, waiters):
         # Wake up the next waiter (if any) that isn't cancelled.
@@ -102,28 +145,27 @@ class TaskQueue:
         return '<{} {}>'.format(type(self).__name__, self._format())
 
     def _format(self):
-        result = 'maxsize={!r}'.format(self._maxsize)
-        if getattr(self, '_queue', None):
-            result += ' _queue={!r}'.format(dict(self._queue))
+        result = 'maxsize={!r} workers={} running={} backlog={}'.format(
+            self._maxsize, self._nworkers, self._running, len(self._backlog))
         if self._putters:
             result += ' _putters[{}]'.format(len(self._putters))
         return result
 
     def qsize(self):
-        """Number of items in the queue."""
-        return len(self._queue)
+        """Number of unfinished tasks, running or waiting."""
+        return self._unfinished
 
     @property
     def maxsize(self):
-        """Number of items allowed in the queue."""
+        """Number of tasks allowed to run at the same time."""
         return self._maxsize
 
     def empty(self):
         """Return True if the queue is empty, False otherwise."""
-        return not self._queue
+        return not self._unfinished
 
     def full(self):
-        """Return True if there are maxsize items in the queue.
+        """Return True if there are maxsize tasks running or tasks waiting.
 
         Note: if the Queue was initialized with maxsize=0 (the default),
         then full() is never True.
@@ -131,13 +173,12 @@ class TaskQueue:
         if self._maxsize <= 0:
             return False
         else:
-            return self.qsize() >= self._maxsize
+            return self._unfinished >= self._maxsize
 
     async def put(self, task: _Task):
-        """Put an item into the queue.
+        """Put a task into the queue.
 
-        Put an item into the queue. If the queue is full, wait until a free
-        slot is available before adding item.
+        If the queue is full, wait until a running task finishes before adding it.
 
         This method is a coroutine.
         """
@@ -149,7 +190,7 @@ class TaskQueue:
             except:
                 putter.cancel()  # Just in case putter is not done yet.
                 if not self.full() and not putter.cancelled():
-                    # We were woken up by get_nowait(), but can't take
+                    # We were woken up by task_done(), but can't take
                     # the call.  Wake up the next in line.
                     self._wakeup_next(self._putters)
                 raise
@@ -157,45 +198,97 @@ class TaskQueue:
 
     def add_task(self, task: _Task):
         '''
-        You can add task in a synchronous way.
+        You can add task in a synchronous way, it waits in the backlog if the queue is full.
+        It must be called in the loop's thread, see `add_task_threadsafe`.
+        '''
+        self._put(task)
+
+    def add_task_later(self, task: _Task, delay):
+        '''
+        add task after delay seconds, without waiting for it. `join` waits for it meanwhile.
+        '''
+        self._unfinished += 1
+        self._later[task.id] = self._loop.call_later(delay, self._put_later, task)
+
+    def _put_later(self, task: _Task):
+        del self._later[task.id]
+        self._unfinished -= 1
+        self._put(task)
+
+    def add_task_threadsafe(self, task: _Task):
+        '''
+        add task from another thread.
         '''
-        asyncio.run_coroutine_threadsafe(self.put(task), loop=self._loop)
+        self._loop.call_soon_threadsafe(self._put, task)
 
     def put_nowait(self, task: _Task):
-        """Put an item into the queue without blocking.
+        """Put a task into the queue without blocking.
 
         If no free slot is immediately available, raise QueueFull.
         """
         if self.full():
             raise QueueFull
         self._put(task)
-        self._finished.clear()
 
-    def task_done(self, tag):
+    def task_done(self):
         '''
-        remove task that the tag stands for from the queue.
-        :param tag : task's uuid
+        Called by workers after one task finished.
         '''
-        if self.qsize() <= 0:
-            raise ValueError('task_done(**) called too many times')
-        if not tag in self._queue:
-            raise KeyError("This task isn't in this queue")
-        # do something you like here, you can change `pop` to other methods you want.
-        # for example ,you can remove the task finished and then send a signal
-        # to a recorder.
-        self._queue.pop(tag)
-
+        if self._unfinished <= 0:
+            raise ValueError('task_done() called too many times')
+        self._unfinished -= 1
         self._wakeup_next(self._putters)
-        if self.qsize() == 0:
-            self._finished.set()
+        if self._unfinished == 0:
+            for joiner in self._joiners:
+                if not joiner.done():
+                    joiner.set_result(None)
+            self._joiners = []
 
     async def join(self):
-        """Block until all items in the queue have been gotten and processed.
+        """Block until all tasks in the queue have been processed."""
+        if self._unfinished > 0:
+            joiner = self._loop.create_future()
+            self._joiners.append(joiner)
+            await joiner
 
-        The count of unfinished tasks goes up whenever an item is added to the
-        queue. The count goes down whenever a consumer calls task_done() to
-        indicate that the item was retrieved and all work on it is complete.
-        When the count of unfinished tasks drops to zero, join() unblocks.
-        """
-        if self.qsize() > 0:
-            await self._finished.wait()
+    async def cancel(self):
+        '''
+        Drop the tasks waiting or added later, cancel the running ones and wait until their workers
+        have stopped. `join` returns then, and the queue can be used again.
+        '''
+        for handle in self._later.values():
+            handle.cancel()
+        self._unfinished -= len(self._later) + len(self._backlog)
+        self._later.clear()
+        self._backlog.clear()
+        workers = list(self._workers)
+        for worker in workers:
+            worker.cancel()
+        if workers:
+            await asyncio.gather(*workers, return_exceptions=True)
+        # a worker cancelled before it started never counted itself out.
+        self._nworkers = 0
+        for putter in self._putters:
+            putter.cancel()
+        self._putters.clear()
+        if self._unfinished <= 0:
+            self._unfinished = 0
+            for joiner in self._joiners:
+                if not joiner.done():
+                    joiner.set_result(None)
+            self._joiners = []
+
+
+class Budget(asyncio.Semaphore):
+    '''
+    Requests which may be sent at once by all the spiders given it by `budget`, in one loop,
+    whatever their own `concurrent`. Spiders waiting for it get it in turn.
+    '''
+
+    def __init__(self, limit):
+        super().__init__(limit)
+        self.limit = limit
+
+    @property
+    def in_use(self):
+        return self.limit - self._value
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+Crawl the local mock site (see mocksite.py) with Spider and report pages per
+second, peak RSS and the spider's own metrics: latency of each phase and event loop lag.
+
+    python3 benchmarks/bench_crawl.py --pages 5000 --latency 20 --latency-dist exp
+    python3 benchmarks/bench_crawl.py --seen bloom --adaptive
+    python3 benchmarks/bench_crawl.py --file-every 10 --file-size 4194304 --download-mode parallel
+
+To measure the callbacks alone, record a crawl once and replay it without network:
+
+    python3 benchmarks/bench_crawl.py --pages 20000 --archive /tmp/site.arc --archive-mode record
+    python3 benchmarks/bench_crawl.py --archive /tmp/site.arc --archive-mode replay
+
+Links are found by a LinkExtractor and added in one batch, files linked by pages are
+downloaded with `add_download` into a temporary directory.
+'''
+import argparse
+import asyncio
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import mocksite
+from aiospider import Spider, LinkExtractor, MemorySeenSet, BloomSeenSet, SqliteSeenSet
+
+
+def make_seen(name):
+    if name == "bloom":
+        return BloomSeenSet()
+    if name == "sqlite":
+        return SqliteSeenSet()
+    return MemorySeenSet()
+
+
+def run(args, base):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    counters = {"pages": 0, "files": 0}
+    workdir = tempfile.mkdtemp(prefix="aiospider-bench-")
+    config = {
+        "concurrent": args.concurrent,
+        "concurrent_per_host": args.concurrent_per_host,
+        "download_concurrent": args.download_concurrent,
+        "adaptive": args.adaptive,
+        "max_pending_in_memory": args.max_pending_in_memory,
+        "download_mode": args.download_mode,
+        "parallel_min_size": 1024 * 1024,
+        "loop_lag_interval": 0.01,
+        "archive_mode": args.archive_mode,
+        "archive_path": args.archive,
+        "max_retries": args.max_retries,
+        "retry_backoff": args.retry_backoff,
+        "breaker_failures": args.breaker_failures,
+    }
+    with Spider(loop=loop, seen=make_seen(args.seen), config=config) as ss:
+        extractor = LinkExtractor()
+
+        def parse(response):
+            counters["pages"] += 1
+            pages = []
+            for url in extractor.extract(response):
+                if "/file/" in url:
+                    counters["files"] += 1
+                    ss.add_download(url, os.path.join(workdir, url.rsplit("/", 1)[1]))
+                else:
+                    pages.append(url)
+            ss.add_requests(pages, parse)
+
+        start = time.perf_counter()
+        ss.start([base + "/page/0"], [parse])
+        elapsed = time.perf_counter() - start
+        histograms = ss.metrics.histograms
+    shutil.rmtree(workdir)
+
+    print("pages {:d} files {:d} in {:.2f}s: {:.1f} pages/s".format(
+        counters["pages"], counters["files"], elapsed, counters["pages"] / elapsed))
+    for name in ("queue_wait", "connect", "ttfb", "callback", "task_wait", "task_time", "loop_lag"):
+        if name in histograms:
+            h = histograms[name].summary()
+            print("{:<10} p50 {:8.2f}ms p99 {:8.2f}ms max {:8.2f}ms".format(
+                name, h["p50"] * 1000, h["p99"] * 1000, h["max"] * 1000))
+    # ru_maxrss is KB on linux
+    print("peak rss {:.1f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    mocksite.add_arguments(parser)
+    parser.add_argument("--concurrent", type=int, default=20)
+    parser.add_argument("--concurrent-per-host", type=int, default=0)
+    parser.add_argument("--download-concurrent", type=int, default=5)
+    parser.add_argument("--adaptive", action="store_true")
+    parser.add_argument("--seen", choices=["memory", "bloom", "sqlite"], default="memory")
+    parser.add_argument("--max-pending-in-memory", type=int, default=0)
+    # mocksite's errors are the same at each try, so retries only cost time here.
+    parser.add_argument("--max-retries", type=int, default=3)
+    parser.add_argument("--retry-backoff", type=float, default=0.5)
+    parser.add_argument("--breaker-failures", type=int, default=5)
+    parser.add_argument("--download-mode", choices=["single", "resume", "parallel"], default="single")
+    parser.add_argument("--archive", help="archive file for --archive-mode")
+    parser.add_argument("--archive-mode", choices=["record", "replay"])
+    args = parser.parse_args()
+    if args.archive_mode and not args.archive:
+        parser.error("--archive-mode needs --archive")
+    # per request logs are not what is measured here.
+    logging.disable(logging.CRITICAL)
+    if args.archive_mode == "replay":
+        # no site, the base url only has to be the recorded one.
+        run(args, "http://{}:{}".format(args.host, args.port))
+    else:
+        site_options = {key: getattr(args, key) for key in mocksite.DEFAULTS}
+        server, base = mocksite.start(**site_options)
+        try:
+            run(args, base)
+        finally:
+            server.terminate()
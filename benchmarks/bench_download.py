@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+Download throughput and event loop latency, writing in the loop (the old way:
+1KB reads and blocking `write`) against FileWriter.
+
+    python3 benchmarks/bench_download.py [files] [MB per file]
+
+The mock site (see mocksite.py) serves the files.
+Loop lag is how late a 1ms timer fires while downloading.
+'''
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import aiohttp
+
+import mocksite
+from aiospider.download import FileWriter, save_response
+
+
+async def measure_lag(lags, stop):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - start - 0.001)
+
+
+async def inline(resp, dst):
+    with open(dst, "wb") as fd:
+        while True:
+            chunk = await resp.content.read(1024)
+            if not chunk:
+                break
+            fd.write(chunk)
+
+
+async def run(name, base, files, size, workdir):
+    lags, stop = [], asyncio.Event()
+    writer = FileWriter()
+    lag_task = asyncio.ensure_future(measure_lag(lags, stop))
+
+    async def one(session, i):
+        dst = os.path.join(workdir, "{}-{}".format(name, i))
+        async with session.get("{}/file/{}".format(base, i)) as resp:
+            if name == "inline":
+                await inline(resp, dst)
+            else:
+                await save_response(resp, dst, writer)
+
+    start = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*[one(session, i) for i in range(files)])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await lag_task
+    writer.close()
+    lags.sort()
+    print("{:<8} {:>8.1f} MB/s  loop lag p50 {:>6.2f}ms p99 {:>6.2f}ms max {:>6.2f}ms".format(
+        name, files * size / elapsed / 2 ** 20, lags[len(lags) // 2] * 1000,
+        lags[int(len(lags) * 0.99)] * 1000, lags[-1] * 1000))
+
+
+if __name__ == "__main__":
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    size = int(float(sys.argv[2]) * 2 ** 20) if len(sys.argv) > 2 else 32 * 2 ** 20
+    server, base = mocksite.start(file_size=size)
+    workdir = tempfile.mkdtemp(prefix="aiospider-bench-")
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        for name in ("inline", "writer"):
+            loop.run_until_complete(run(name, base, files, size, workdir))
+    finally:
+        loop.close()
+        server.terminate()
+        shutil.rmtree(workdir)
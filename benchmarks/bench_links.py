@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+Link discovery: finding the links of a page, making them absolute and adding
+them to the spider.
+
+ bs4       : BeautifulSoup (html.parser), urljoin and add_request one link at a time,
+             as the examples do. Skipped if bs4 is not installed.
+ urljoin   : LinkExtractor's scan, but urljoin and add_request one link at a time.
+ extractor : LinkExtractor.extract and add_requests, the links of a page in one batch.
+
+    python3 benchmarks/bench_links.py --pages 200 --links 2000 --seen sqlite
+'''
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from urllib.parse import urljoin
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from aiospider import Spider, LinkExtractor, MemorySeenSet, BloomSeenSet, SqliteSeenSet
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+BASE = "http://example.com/section/page/{}"
+
+
+def make_page(n, links, rnd):
+    '''
+    a page of about `links` links in the usual forms, with some markup around them.
+    '''
+    parts = ["<html><head><title>page {}</title></head><body>".format(n)]
+    for i in range(links):
+        target = rnd.randrange(links * 50)
+        form = rnd.random()
+        if form < 0.4:
+            href = "/section/page/{}".format(target)
+        elif form < 0.6:
+            href = "page/{}?ref={}&amp;x=1".format(target, n)
+        elif form < 0.8:
+            href = "http://example.com/section/page/{}#frag".format(target)
+        elif form < 0.9:
+            href = "//cdn.example.com/img/{}.png".format(target)
+        else:
+            href = "../other/{}".format(target)
+        tag = '<img src="{}" alt="x">' if href.endswith(".png") else '<a class="link" href="{}">link</a>'
+        parts.append('<div class="item"><span>{}</span>{}</div>'.format(i, tag.format(href)))
+    parts.append("</body></html>")
+    return "\n".join(parts)
+
+
+def make_seen(name):
+    if name == "bloom":
+        return BloomSeenSet()
+    if name == "sqlite":
+        return SqliteSeenSet()
+    return MemorySeenSet()
+
+
+def callback(response):
+    pass
+
+
+def bs4_links(ss, page, url):
+    soup = BeautifulSoup(page, "html.parser")
+    for tag in soup.find_all(["a", "img"]):
+        link = tag.get("href") or tag.get("src")
+        if link:
+            ss.add_request(urljoin(url, link), callback)
+
+
+def urljoin_links(ss, page, url, extractor):
+    for link in extractor.links(page):
+        ss.add_request(urljoin(url, link), callback)
+
+
+def extractor_links(ss, page, url, extractor):
+    ss.add_requests(extractor.extract(page, url), callback)
+
+
+def measure(name, func, pages, links, seen, *args):
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    with Spider(seen=make_seen(seen)) as ss:
+        start = time.perf_counter()
+        for n, page in enumerate(pages):
+            func(ss, page, BASE.format(n), *args)
+        elapsed = time.perf_counter() - start
+        queued = ss.pending.qsize()
+    print("{:<10} {:8.1f} pages/s {:10.0f} links/s {:8d} queued".format(
+        name, len(pages) / elapsed, len(pages) * links / elapsed, queued))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--links", type=int, default=1000)
+    parser.add_argument("--seen", choices=["memory", "bloom", "sqlite"], default="memory")
+    args = parser.parse_args()
+    rnd = random.Random(0)
+    pages = [make_page(n, args.links, rnd) for n in range(args.pages)]
+    print("{} pages of {:.0f} KB, {} links each".format(
+        args.pages, sum(map(len, pages)) / len(pages) / 1024, args.links))
+    extractor = LinkExtractor()
+    if BeautifulSoup is not None:
+        measure("bs4", bs4_links, pages, args.links, args.seen)
+    else:
+        print("bs4        skipped, BeautifulSoup is not installed")
+    measure("urljoin", urljoin_links, pages, args.links, args.seen, extractor)
+    measure("extractor", extractor_links, pages, args.links, args.seen, extractor)
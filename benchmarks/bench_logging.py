@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+Cost of the logs spider writes for every request.
+Each request used to format and log 4 INFO messages (add, load, finished and
+the download queue's "tasks waiting"), with the root logger set to DEBUG by
+aiospider at import. Now they are DEBUG messages formatted only if enabled.
+
+ legacy : old messages, root logger at DEBUG, handler writing to /dev/null.
+ quiet  : new messages, application logging at INFO (the usual setup).
+ debug  : new messages, application logging at DEBUG, handler writing to /dev/null.
+
+    python3 benchmarks/bench_logging.py --requests 200000
+'''
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from aiospider import Spider, LOGGING_FORMAT
+
+
+def configure(level):
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    handler = logging.StreamHandler(open(os.devnull, "w"))
+    handler.setFormatter(logging.Formatter(LOGGING_FORMAT))
+    root.addHandler(handler)
+    root.setLevel(level)
+
+
+def legacy(spider, n):
+    logger = spider.logger
+    url, pending = "http://example.com/page/{}", 1000
+    for i in range(n):
+        logger.log(logging.INFO, "Add url: {} to queue.".format(url))
+        logger.log(logging.INFO, "Loading url: {} from queue.".format(url))
+        logger.log(logging.INFO, "Request [{method}] `{url}` finishend.(There are still {num})".format(
+            method="GET", url=url, num=pending))
+        logger.log(logging.INFO, "There are still {num} tasks waiting.".format(num=pending))
+
+
+def current(spider, n):
+    log, queue = spider.log, spider.download_pending
+    url, pending = "http://example.com/page/{}", 1000
+    for i in range(n):
+        log(logging.DEBUG, "Add url: %s to queue.", url)
+        log(logging.DEBUG, "Loading url: %s from queue.", url)
+        log(logging.DEBUG, "Request [%s] `%s` finished.(There are still %d)", "GET", url, pending)
+        queue.log(logging.DEBUG, "There are still %d tasks waiting.", pending)
+
+
+def measure(name, func, spider, n):
+    start = time.perf_counter()
+    func(spider, n)
+    elapsed = time.perf_counter() - start
+    print("{:<8} {:8.2f} us/request".format(name, elapsed / n * 1e6))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100000)
+    args = parser.parse_args()
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    with Spider() as ss:
+        configure(logging.DEBUG)
+        measure("legacy", legacy, ss, args.requests)
+        configure(logging.INFO)
+        measure("quiet", current, ss, args.requests)
+        configure(logging.DEBUG)
+        measure("debug", current, ss, args.requests)
@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+Connection pool settings: pages per second and how many requests reuse a
+kept-alive connection, against the local mock site (see mocksite.py).
+
+ default      : aiohttp's defaults, 100 connections, DNS cached 10s, keepalive 15s.
+ no-keepalive : a new connection for each request.
+ no-dns-cache : the host is resolved for each new connection.
+ small-pool   : 5 connections for `--concurrent` workers, requests wait for a free connection.
+ per-host     : at most 10 connections to the host.
+
+    python3 benchmarks/bench_pool.py --pages 5000 --concurrent 50 --latency 5
+
+The site is requested as `localhost`, so that new connections resolve a name.
+'''
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import mocksite
+from aiospider import Spider
+
+SETTINGS = [
+    ("default", {}),
+    ("no-keepalive", {"keepalive_timeout": 0}),
+    ("no-dns-cache", {"keepalive_timeout": 0, "dns_cache_ttl": 0}),
+    ("small-pool", {"connection_limit": 5}),
+    ("per-host", {"connection_limit_per_host": 10}),
+]
+
+
+def run(name, settings, base, args):
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    config = {"concurrent": args.concurrent, "loop_lag_interval": 0}
+    config.update(settings)
+    with Spider(config=config) as ss:
+        start = time.perf_counter()
+        ss.start(["{}/page/{}".format(base, n) for n in range(args.pages)], lambda response: None)
+        elapsed = time.perf_counter() - start
+        created = ss.metrics.counter("connections_created").value
+        reused = ss.metrics.counter("connections_reused").value
+        connect = ss.metrics.histogram("connect").percentile(0.5)
+    print("{:<13} {:8.1f} pages/s {:6d} created {:6d} reused {:5.1f}% reuse  connect p50 {:6.2f}ms".format(
+        name, args.pages / elapsed, created, reused, 100.0 * reused / max(created + reused, 1), connect * 1000))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=3000)
+    parser.add_argument("--concurrent", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.0, help="milliseconds")
+    parser.add_argument("--port", type=int, default=mocksite.DEFAULTS["port"])
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    server, base = mocksite.start(pages=args.pages, latency=args.latency, port=args.port, page_size=4096)
+    base = base.replace("127.0.0.1", "localhost")
+    try:
+        for name, settings in SETTINGS:
+            run(name, settings, base, args)
+    finally:
+        server.terminate()
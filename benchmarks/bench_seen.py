@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+Memory per url and lookups per second of the seen-set backends.
+
+    python3 benchmarks/bench_seen.py [number of urls]
+
+Memory is measured with tracemalloc, so the sqlite backend only shows the
+python side; its disk usage is reported as well.
+'''
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from aiospider import MemorySeenSet, BloomSeenSet, SqliteSeenSet
+
+
+def make_urls(n, offset=0):
+    # a generator, so the url strings kept by the backend are counted too.
+    return ("http://host{}.example.com/article/{}?page={}".format(i % 1000, i, i % 7)
+            for i in range(offset, offset + n))
+
+
+def bench(name, factory, n, misses):
+    tracemalloc.start()
+    seen = factory()
+    for url in make_urls(n):
+        seen.add(url)
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    seen.close()
+
+    urls = list(make_urls(n))
+    seen = factory()
+    start = time.perf_counter()
+    for url in urls:
+        seen.add(url)
+    add_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for url in urls:
+        url in seen
+    for url in misses:
+        url in seen
+    lookup_time = time.perf_counter() - start
+    false_positives = sum(1 for url in misses if url in seen)
+
+    disk = ""
+    if isinstance(seen, SqliteSeenSet):
+        seen._db.commit()
+        disk = "disk {:.1f} B/url".format(os.path.getsize(seen.path) / n)
+    print("{:<8} mem {:>7.1f} B/url  add {:>9.0f}/s  lookup {:>9.0f}/s  fp {:.4%}  {}".format(
+        name, used / n, n / add_time,
+        (n + len(misses)) / lookup_time, false_positives / len(misses), disk))
+    seen.close()
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    misses = list(make_urls(min(n, 100000), offset=n))
+    bench("memory", MemorySeenSet, n, misses)
+    bench("bloom", lambda: BloomSeenSet(error_rate=0.001, initial_capacity=n // 4), n, misses)
+    bench("sqlite", SqliteSeenSet, n, misses)
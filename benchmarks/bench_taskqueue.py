@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+Push many tasks through TaskQueue with `add_task`, against the old
+implementation (one uuid, one OrderedDict entry, one parked `put` coroutine
+and its futures per task), reporting tasks per second and peak memory.
+
+    python3 benchmarks/bench_taskqueue.py [tasks] [legacy tasks]
+
+The legacy queue is run with fewer tasks by default, it needs a lot of memory.
+'''
+import asyncio
+import collections
+import logging
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from aiospider import TaskQueue, makeTask
+
+MAXSIZE = 5
+
+
+class LegacyTaskQueue:
+    '''
+    The old TaskQueue, cut down to what `add_task` uses.
+    '''
+
+    def __init__(self, maxsize, loop):
+        self._loop = loop
+        self._maxsize = maxsize
+        self._putters = collections.deque()
+        self._queue = collections.OrderedDict()
+
+    def _put(self, task, args):
+        UUID = uuid.uuid4()
+
+        async def _call():
+            try:
+                await task(*args)
+            finally:
+                self.task_done(str(UUID))
+        self._queue.update({str(UUID): asyncio.ensure_future(_call())})
+
+    def _wakeup_next(self):
+        while self._putters:
+            waiter = self._putters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def full(self):
+        return len(self._queue) >= self._maxsize
+
+    async def put(self, task, args):
+        while self.full():
+            putter = self._loop.create_future()
+            self._putters.append(putter)
+            await putter
+        self._put(task, args)
+
+    def add_task(self, task, *args):
+        asyncio.run_coroutine_threadsafe(self.put(task, args), loop=self._loop)
+
+    def task_done(self, tag):
+        self._queue.pop(tag)
+        self._wakeup_next()
+
+
+async def noop(counter):
+    counter[0] += 1
+    if counter[0] == counter[1]:
+        counter[2].set_result(None)
+
+
+def run(name, n):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    counter = [0, n, loop.create_future()]
+    tracemalloc.start()
+    start = time.perf_counter()
+    if name == "legacy":
+        queue = LegacyTaskQueue(MAXSIZE, loop)
+        for _ in range(n):
+            queue.add_task(noop, counter)
+    else:
+        queue = TaskQueue(maxsize=MAXSIZE, loop=loop)
+        for _ in range(n):
+            queue.add_task(makeTask(noop, counter))
+    loop.run_until_complete(counter[2])
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    loop.close()
+    print("{:<8} {:>8d} tasks {:>10.0f} tasks/s  peak {:>8.1f} MB ({:.0f} B/task)".format(
+        name, n, n / elapsed, peak / 2 ** 20, peak / n))
+
+
+if __name__ == "__main__":
+    # the queue logs every task, that is not what is measured here.
+    logging.disable(logging.CRITICAL)
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    legacy = int(sys.argv[2]) if len(sys.argv) > 2 else min(n, 100000)
+    run("legacy", legacy)
+    run("current", n)
@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+#-*- coding:utf-8 -*-
+
+'''
+A synthetic site for benchmarks, served by aiohttp in another process.
+
+ /page/{n}  html page linking to pages n*fanout+1 ... n*fanout+fanout (up to
+            `pages`), to its parent and to a random page (for dedup), and to
+            /file/{n} every `file_every` pages.
+ /file/{n}  binary file of `file_size` bytes, with Range support.
+
+Latency, page size and error rate are configurable, and everything random is
+seeded by the page number, so the same options give the same site.
+
+    python3 benchmarks/mocksite.py --pages 10000 --latency 20
+'''
+import argparse
+import asyncio
+import multiprocessing
+import random
+import socket
+import time
+
+from aiohttp import web
+
+__all__ = ["SiteOptions", "start", "add_arguments"]
+
+DEFAULTS = {
+    "host": "127.0.0.1",
+    "port": 8790,
+    "pages": 2000,
+    "fanout": 10,
+    "page_size": 16 * 1024,
+    # milliseconds
+    "latency": 0.0,
+    # fixed, uniform, exp or lognormal
+    "latency_dist": "fixed",
+    "error_rate": 0.0,
+    "file_every": 0,
+    "file_size": 1024 * 1024,
+    "seed": 0,
+}
+
+
+class SiteOptions(dict):
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def add_arguments(parser):
+    '''
+    add site options to an argparse parser.
+    '''
+    for key, value in DEFAULTS.items():
+        parser.add_argument("--" + key.replace("_", "-"), type=type(value), default=value)
+
+
+def _latency(options, rnd):
+    mean = options.latency / 1000.0
+    if mean <= 0:
+        return 0
+    dist = options.latency_dist
+    if dist == "uniform":
+        return rnd.uniform(0, 2 * mean)
+    if dist == "exp":
+        return rnd.expovariate(1 / mean)
+    if dist == "lognormal":
+        # sigma 1, scaled to the mean
+        return rnd.lognormvariate(0, 1) * mean / 1.6487
+    return mean
+
+
+def make_app(options):
+    payload = random.Random(options.seed).getrandbits(8 * 64 * 1024).to_bytes(64 * 1024, "little")
+    filler = "<p>" + "lorem ipsum dolor sit amet " * 40 + "</p>\n"
+
+    async def page(request):
+        n = int(request.match_info["n"])
+        rnd = random.Random(options.seed * 1000003 + n)
+        delay = _latency(options, rnd)
+        if delay:
+            await asyncio.sleep(delay)
+        if n >= options.pages or rnd.random() < options.error_rate:
+            raise web.HTTPInternalServerError()
+        links = ['<a href="/page/{}">child</a>'.format(child)
+                 for child in range(n * options.fanout + 1, n * options.fanout + options.fanout + 1)
+                 if child < options.pages]
+        links.append('<a href="/page/{}">parent</a>'.format(max(n - 1, 0) // options.fanout))
+        links.append('<a href="/page/{}#top">random</a>'.format(rnd.randrange(options.pages)))
+        if options.file_every and n % options.file_every == 0:
+            links.append('<a href="/file/{}">file</a>'.format(n))
+        body = "<html><head><title>page {}</title></head><body>\n{}\n".format(n, "\n".join(links))
+        while len(body) < options.page_size:
+            body += filler
+        return web.Response(text=body + "</body></html>", content_type="text/html")
+
+    async def file(request):
+        size = options.file_size
+        start, end = 0, size - 1
+        status = 200
+        rng = request.http_range
+        if rng.start is not None or rng.stop is not None:
+            start = rng.start or 0
+            end = min((rng.stop or size) - 1, size - 1)
+            status = 206
+        headers = {"Accept-Ranges": "bytes", "ETag": '"file-{}"'.format(request.match_info["n"]),
+                   "Content-Length": str(end - start + 1)}
+        if status == 206:
+            headers["Content-Range"] = "bytes {}-{}/{}".format(start, end, size)
+        resp = web.StreamResponse(status=status, headers=headers)
+        await resp.prepare(request)
+        if request.method == "HEAD":
+            return resp
+        pos = start
+        while pos <= end:
+            offset = pos % len(payload)
+            chunk = payload[offset:offset + min(end - pos + 1, len(payload) - offset)]
+            await resp.write(chunk)
+            pos += len(chunk)
+        await resp.write_eof()
+        return resp
+
+    app = web.Application()
+    app.router.add_get("/page/{n}", page)
+    app.router.add_get("/file/{n}", file)
+    return app
+
+
+def serve(options):
+    web.run_app(make_app(options), host=options.host, port=options.port,
+                print=None, access_log=None)
+
+
+def _wait(host, port, timeout=10.0):
+    for _ in range(int(timeout / 0.05)):
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("mock site didn't start on {}:{}".format(host, port))
+
+
+def start(**kwargs):
+    '''
+    Start the site in a daemon process.
+    :return: (process, base url)
+    '''
+    options = SiteOptions(DEFAULTS)
+    options.update((k, v) for k, v in kwargs.items() if k in DEFAULTS)
+    process = multiprocessing.Process(target=serve, args=(options,), daemon=True)
+    process.start()
+    _wait(options.host, options.port)
+    return process, "http://{}:{}".format(options.host, options.port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    serve(SiteOptions(vars(parser.parse_args())))
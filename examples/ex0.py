@@ -5,17 +5,23 @@
 This is a simple usage of sipder.
 '''
 
-from aiospider import Spider
+import logging
+from aiospider import Spider, LOGGING_FORMAT
+
+# aiospider only logs, showing the logs is up to the application.
+logging.basicConfig(format=LOGGING_FORMAT, level=logging.INFO)
+
 with Spider() as ss:
     def parse_page_1(response):
         '''
         callback
-        The response is just an aiohttp.ClientResponse object now.
+        The response is an aiospider.Response, its body is already read.
         The callback will be called when the response is available.
-        If callback is not a coroutine function, it will be called by loop.call_soon_threadsafe.
+        A callback which is not a coroutine function can use the body too,
+        by `response.body`, `response.unicode_body` or `response.json_body`.
         '''
-        print("request url is %s, response status is %d" %
-              (response.url, response.status))
+        print("request url is %s, response status is %d, %d characters" %
+              (response.url, response.status, len(response.unicode_body)))
 
     async def parse_page_2(response):
         '''
@@ -8,10 +8,14 @@ This project get emoji from [face.ersansan.cn]. Each category has one dictionary
 This example will show you how download files with spider.
 '''
 import aiohttp
-from aiospider import Spider
+import logging
+from aiospider import Spider, LOGGING_FORMAT
 import os
 from os.path import splitext, basename, exists, isdir, join
 
+# aiospider only logs, showing the logs is up to the application.
+logging.basicConfig(format=LOGGING_FORMAT, level=logging.INFO)
+
 BASE_URL = "http://face.ersansan.cn/collection/{tid}?r_from=miniapp"
 
 
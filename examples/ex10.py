@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+#-*-coding:utf8-*-
+
+'''
+This example shows how to save items.
+The callback is an async generator yielding requests, which are added, and items, which go through the
+processors of the pipeline and are written to a JSON lines file, a sqlite database and a csv file, in batches
+by a thread. Items without a title and pages seen under another url are dropped.
+'''
+import re
+
+import logging
+from aiospider import Spider, Request, LinkExtractor, ItemPipeline, JsonLinesSink, SqliteSink, CsvSink, \
+    require, Dedup, LOGGING_FORMAT
+
+logging.basicConfig(format=LOGGING_FORMAT, level=logging.INFO)
+
+TITLE = re.compile(r'<title>(.*?)</title>', re.S | re.I)
+extractor = LinkExtractor(allow_domains=["docs.python.org"], allow=[r"/3/library/"])
+
+
+def strip(item):
+    item["title"] = " ".join(item["title"].split())
+    return item
+
+
+pipeline = ItemPipeline([JsonLinesSink("items.jsonl"), SqliteSink("items.db", columns=["url", "title", "size"]),
+                         CsvSink("items.csv", fields=["url", "title"])],
+                        processors=[require("title"), strip, Dedup("title")],
+                        batch_size=100, flush_interval=2)
+
+with Spider(config={"concurrent": 10, "crawl_timeout": 60}, pipeline=pipeline) as ss:
+
+    async def parse(response):
+        title = TITLE.search(response.unicode_body)
+        yield {"url": str(response.url), "title": title.group(1) if title else None, "size": len(response.body)}
+        for url in extractor.extract(response):
+            yield Request("GET", url, callback=parse)
+
+    ss.start(["https://docs.python.org/3/library/index.html"], parse)
+    counters = ss.metrics.snapshot()["counters"]
+    print("items", counters.get("items"), "written", counters.get("items_written"),
+          "dropped", counters.get("items_dropped"))
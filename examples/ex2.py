@@ -5,7 +5,8 @@
 '''
 This example will show you how to add targets while crawling.
 '''
-from aiospider import Spider
+import logging
+from aiospider import Spider, LOGGING_FORMAT
 from urllib.parse import urljoin
 
 from pyquery import PyQuery
@@ -13,6 +14,9 @@ from pyquery import PyQuery
 import os
 from os.path import splitext, basename, exists, isdir, join
 
+# aiospider only logs, showing the logs is up to the application.
+logging.basicConfig(format=LOGGING_FORMAT, level=logging.INFO)
+
 
 def url_resolve(_from, to):
     return urljoin(_from, to)
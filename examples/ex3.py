@@ -7,10 +7,14 @@ To run this example  you need a Zhihu account.
 '''
 
 import aiohttp
-from aiospider import Spider
+import logging
+from aiospider import Spider, LOGGING_FORMAT
 from functools import partial
 from pyquery import PyQuery
 
+# aiospider only logs, showing the logs is up to the application.
+logging.basicConfig(format=LOGGING_FORMAT, level=logging.INFO)
+
 ZHIHU_INDEX = "https://www.zhihu.com/"
 ZHIHU_LOGIN = "https://www.zhihu.com/login/email"
 
@@ -6,7 +6,11 @@ TaskQueue can be used Individually.
 Actually, you don't need to write any code to control TaskQueue. Spider have done that for user.
 '''
 import asyncio
-from aiospider import TaskQueue, makeTask
+import logging
+from aiospider import TaskQueue, makeTask, LOGGING_FORMAT
+
+# aiospider only logs, showing the logs is up to the application.
+logging.basicConfig(format=LOGGING_FORMAT, level=logging.INFO)
 
 
 def exe(a):
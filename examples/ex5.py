@@ -1,7 +1,8 @@
 #!/usr/bin/python3
 # -*-coding:utf8-*-
 
-from aiospider import Spider
+import logging
+from aiospider import Spider, LOGGING_FORMAT
 
 import re
 import os
@@ -11,6 +12,9 @@ from bs4 import BeautifulSoup
 
 import aiohttp
 
+# aiospider only logs, showing the logs is up to the application.
+logging.basicConfig(format=LOGGING_FORMAT, level=logging.INFO)
+
 BASE_URL = "http://www.allitebooks.in/page/{page}/"
 
 
@@ -0,0 +1,41 @@
+#!/usr/bin/python3
+#-*-coding:utf8-*-
+
+'''
+This example shows how to parse pages in other processes.
+A parser gets the url, the body and the charset of response instead of the response itself,
+and runs in the parse executor, so parsing many pages doesn't block the loop.
+Requests it returns are added to spider, other things are items passed to `on_item` functions.
+With a process pool, parsers must be module level functions,
+and callbacks of new requests are given by name.
+'''
+import re
+from urllib.parse import urljoin
+
+import logging
+from aiospider import Spider, Request, LOGGING_FORMAT
+
+# aiospider only logs, showing the logs is up to the application.
+logging.basicConfig(format=LOGGING_FORMAT, level=logging.INFO)
+
+LINK = re.compile(r'<a[^>]+href="(/doc[^"#]*)"')
+TITLE = re.compile(r'<title>(.*?)</title>', re.S)
+
+
+def parse_page(url, body, encoding):
+    text = body.decode(encoding or "utf-8", "replace")
+    title = TITLE.search(text)
+    yield {"url": url, "title": title.group(1).strip() if title else None}
+    for href in LINK.findall(text):
+        yield Request("GET", urljoin(url, href), callback="parse_page")
+
+
+if __name__ == "__main__":
+    with Spider(config={"parse_executor": "process"}) as ss:
+        ss.register_parser(parse_page)
+
+        @ss.on_item
+        def show(item):
+            print(item)
+
+        ss.start(['https://www.python.org/'], [parse_page])
@@ -0,0 +1,37 @@
+#!/usr/bin/python3
+#-*-coding:utf8-*-
+
+'''
+This example shows how to crawl with several processes.
+Each shard process runs its own spider over the hosts of its shard, links to hosts of other shards are
+sent to them. Callbacks are set up in each shard by `setup`, so they must be module level functions,
+and they use the spider of their own process.
+'''
+import logging
+from aiospider import ShardedSpider, LinkExtractor, LOGGING_FORMAT
+
+logging.basicConfig(format=LOGGING_FORMAT + " %(processName)s", level=logging.INFO)
+
+extractor = LinkExtractor(allow_domains=["python.org"])
+spider = None
+
+
+def parse(response):
+    print(response.url, response.status)
+    spider.add_requests(extractor.extract(response), parse)
+
+
+def setup(shard_spider, shard):
+    global spider
+    spider = shard_spider
+    spider.register_callback(parse)
+
+
+if __name__ == "__main__":
+    ss = ShardedSpider(shards=4, setup=setup, config={"concurrent": 20, "crawl_timeout": 60})
+
+    @ss.after_spider
+    def summary(ss):
+        print(ss.stats()["metrics"]["counters"])
+
+    ss.start(['https://www.python.org/', 'https://docs.python.org/3/', 'https://pypi.org/'], parse)
@@ -0,0 +1,31 @@
+#!/usr/bin/python3
+#-*-coding:utf8-*-
+
+'''
+This example shows how to crawl with several machines.
+Run it on each machine with the address of one Redis server: the spiders share its frontier and seen-set,
+so each page is fetched once, and the requests of a spider which dies are given to the others.
+
+    python3 ex8.py redis://10.0.0.5:6379/0
+'''
+import sys
+import logging
+from aiospider import Spider, RedisBackend, LinkExtractor, LOGGING_FORMAT
+
+logging.basicConfig(format=LOGGING_FORMAT, level=logging.INFO)
+
+extractor = LinkExtractor(allow_domains=["python.org"])
+
+
+def parse(response):
+    print(response.url, response.status)
+    spider.add_requests(extractor.extract(response), parse)
+
+
+if __name__ == "__main__":
+    backend = RedisBackend(sys.argv[1] if len(sys.argv) > 1 else "redis://localhost:6379/0",
+                           prefix="python.org", lease_time=120)
+    with Spider(frontier_backend=backend, config={"concurrent": 20}) as spider:
+        # the callback of leased requests is found by name.
+        spider.register_callback(parse)
+        spider.start('https://www.python.org/', parse)
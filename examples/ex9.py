@@ -0,0 +1,39 @@
+#!/usr/bin/python3
+#-*-coding:utf8-*-
+
+'''
+This example shows how to run several spiders at once in one loop.
+They share one connection pool and a budget of 20 requests at once, each one keeps its own queue,
+seen-set and callbacks.
+'''
+import asyncio
+import logging
+from aiospider import Spider, Budget, LinkExtractor, make_session, LOGGING_FORMAT
+
+logging.basicConfig(format=LOGGING_FORMAT, level=logging.INFO)
+
+
+async def crawl_site(start_url, domain, session, budget):
+    extractor = LinkExtractor(allow_domains=[domain])
+    async with Spider(session=session, budget=budget, config={"concurrent": 20}) as ss:
+        def parse(response):
+            print(response.url, response.status)
+            ss.add_requests(extractor.extract(response), parse)
+        await ss.crawl(start_url, parse)
+        return ss.stats()["visited"]
+
+
+async def main():
+    session = make_session({"connection_limit": 50})
+    budget = Budget(20)
+    try:
+        visited = await asyncio.gather(
+            crawl_site("https://docs.python.org/3/", "docs.python.org", session, budget),
+            crawl_site("https://peps.python.org/", "peps.python.org", session, budget))
+        print("visited", visited)
+    finally:
+        await session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
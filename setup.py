@@ -1,8 +1,9 @@
-from distutils.core import setup
+from setuptools import setup
 setup(name='aiospider',
       description='Python asyncio spider',
       author='HeartUnchange',
       author_email='haoxiangzhao@outlook.com',
       version='0.0.1',
       packages=['aiospider',"examples"],
+      python_requires='>=3.7',
       )